@@ -0,0 +1,220 @@
+import math
+import os
+
+import faiss
+import numpy as np
+
+from quantization import MIN_TRAIN, codec_factory, resolve_quantization
+
+# Approximate search alongside a store's flat index. Configs are plain dicts:
+#   {"type": "auto"}                                  -> picked from the corpus size
+#   {"type": "flat"}                                  -> exact search, no extra structure
+#   {"type": "ivf", "nlist": 1024, "nprobe": 32}
+#   {"type": "hnsw", "M": 32, "ef_construction": 200, "ef_search": 256}
+# plus an optional "quantization" (see quantization.py) that the ANN index stores its vectors with.
+ANN_AUTO_FLAT_MAX = int(os.getenv("ANN_AUTO_FLAT_MAX", "20000"))
+ANN_AUTO_IVF_MAX = int(os.getenv("ANN_AUTO_IVF_MAX", "200000"))
+
+# Retrain from the flat vectors once this fraction of labels are tombstones
+ANN_REBUILD_FRACTION = 0.2
+# IVF training uses at most this many points per centroid (faiss wants at least 39)
+IVF_TRAIN_POINTS_PER_LIST = 256
+
+ANN_INDEX_FILE = "ann.faiss"
+ANN_POSITIONS_FILE = "ann_positions.npy"
+
+# Parameters that change the built structure; the rest only affect search
+_BUILD_KEYS = {"ivf": ("nlist", "quantization", "pq_m"), "hnsw": ("M", "ef_construction", "quantization", "pq_m")}
+
+
+def resolve_config(config: dict, n: int) -> dict:
+    """
+    Fill in the index type (for "auto") and any missing parameters for a corpus of n vectors.
+    """
+    config = dict(config or {})
+    kind = config.get("type", "auto")
+    binary = config.get("quantization") == "binary"
+    if kind == "auto":
+        # A Hamming scan over 1-bit codes is already cheap, and IVF/HNSW can't hold them
+        kind = "flat" if n <= ANN_AUTO_FLAT_MAX or binary else "ivf" if n <= ANN_AUTO_IVF_MAX else "hnsw"
+    if kind not in ("flat", "ivf", "hnsw"):
+        raise ValueError(f"Unknown index type '{kind}'")
+    if binary and kind != "flat":
+        raise ValueError("Binary quantization only supports the flat index type")
+    config["type"] = kind
+
+    if kind == "ivf":
+        # ~4*sqrt(n) lists, but never fewer than 39 training points per list
+        nlist = config.get("nlist") or int(4 * math.sqrt(max(n, 1)))
+        config["nlist"] = max(1, min(nlist, n // 39 or 1))
+        config.setdefault("nprobe", max(1, config["nlist"] // 16))
+    elif kind == "hnsw":
+        config.setdefault("M", 32)
+        config.setdefault("ef_construction", 200)
+        config.setdefault("ef_search", 256)
+    return config
+
+
+def same_structure(a: dict, b: dict) -> bool:
+    """
+    True if an index built with config `a` can serve config `b` (search params may differ).
+    """
+    if a.get("type") != b.get("type"):
+        return False
+    return all(a.get(key) == b.get(key) for key in _BUILD_KEYS.get(a.get("type"), ()))
+
+
+def _new_index(config: dict, d: int, train_vectors):
+    codec = codec_factory(resolve_quantization(config, d))
+    if config["type"] == "ivf":
+        index = faiss.index_factory(d, f"IVF{config['nlist']},{codec}")
+    else:
+        index = faiss.index_factory(d, f"HNSW{config['M']}" + ("" if codec == "Flat" else f"_{codec}"))
+        faiss.downcast_index(index).hnsw.efConstruction = config["ef_construction"]
+
+    if not index.is_trained:
+        sample = train_vectors
+        limit = max(config.get("nlist", 0) * IVF_TRAIN_POINTS_PER_LIST, MIN_TRAIN["pq"])
+        if len(sample) > limit:
+            rng = np.random.RandomState(0)
+            sample = sample[rng.choice(len(sample), limit, replace=False)]
+        index.train(np.ascontiguousarray(sample, dtype="float32"))
+    return index
+
+
+class AnnIndex:
+    """
+    IVF or HNSW search structure over the vectors of a store's flat index.
+
+    The flat index stays the source of truth: in-place updates, snapshots and exact
+    scores all come from it. This only answers "which positions are probably nearest".
+    Labels inside the ANN index are append-only, so a replaced or deleted position just
+    tombstones its label (HNSW can't remove vectors at all). Once tombstones pass
+    ANN_REBUILD_FRACTION the structure is retrained from the flat vectors.
+    """
+
+    def __init__(self, config: dict, index, positions=None):
+        self.config = config
+        self.index = index
+        n = index.ntotal
+        self._positions = np.full(max(16, n), -1, dtype="int64")  # label -> position (-1 = tombstone)
+        if positions is not None:
+            self._positions[:n] = positions
+        else:
+            self._positions[:n] = np.arange(n)
+        self._label_by_position = {int(p): label for label, p in enumerate(self._positions[:n]) if p >= 0}
+        self.tombstones = n - len(self._label_by_position)
+
+    @classmethod
+    def build(cls, config: dict, vectors) -> "AnnIndex":
+        vectors = np.ascontiguousarray(vectors, dtype="float32")
+        index = _new_index(config, vectors.shape[1], vectors)
+        if len(vectors):
+            index.add(vectors)
+        return cls(config, index)
+
+    def __len__(self) -> int:
+        return len(self._label_by_position)
+
+    def _grow(self, needed: int):
+        if needed > len(self._positions):
+            grown = np.full(max(needed, 2 * len(self._positions)), -1, dtype="int64")
+            grown[:len(self._positions)] = self._positions
+            self._positions = grown
+
+    def add(self, positions, vectors):
+        vectors = np.ascontiguousarray(np.asarray(vectors, dtype="float32").reshape(len(positions), -1))
+        start = self.index.ntotal
+        self.index.add(vectors)
+        self._grow(start + len(positions))
+        for offset, pos in enumerate(positions):
+            self.remove(pos)
+            self._positions[start + offset] = pos
+            self._label_by_position[int(pos)] = start + offset
+
+    def remove(self, position):
+        label = self._label_by_position.pop(int(position), None)
+        if label is not None:
+            self._positions[label] = -1
+            self.tombstones += 1
+
+    def move(self, old_position, new_position):
+        # The flat index moved a vector (delete swaps the last one into the hole); same vector, new position
+        self.remove(new_position)
+        label = self._label_by_position.pop(int(old_position), None)
+        if label is not None:
+            self._positions[label] = new_position
+            self._label_by_position[int(new_position)] = label
+
+    def needs_rebuild(self) -> bool:
+        return self.tombstones > ANN_REBUILD_FRACTION * max(len(self), 1)
+
+    def _search_params(self, fetch: int):
+        if self.config["type"] == "ivf":
+            return faiss.SearchParametersIVF(nprobe=self.config["nprobe"])
+        return faiss.SearchParametersHNSW(efSearch=max(self.config["ef_search"], fetch))
+
+    def search(self, queries, k: int):
+        """
+        (distances, positions) like faiss' search, with tombstoned labels filtered out.
+        """
+        queries = np.ascontiguousarray(np.asarray(queries, dtype="float32").reshape(-1, self.index.d))
+        fetch = min(k + self.tombstones, self.index.ntotal)
+        if fetch == 0:
+            return np.empty((len(queries), 0), "float32"), np.empty((len(queries), 0), "int64")
+        distances, labels = self.index.search(queries, fetch, params=self._search_params(fetch))
+
+        positions = np.where(labels >= 0, self._positions[np.clip(labels, 0, None)], -1)
+        out_d = np.full((len(queries), k), np.inf, dtype="float32")
+        out_p = np.full((len(queries), k), -1, dtype="int64")
+        for row in range(len(queries)):
+            keep = positions[row] >= 0
+            found = positions[row][keep][:k]
+            out_p[row, :len(found)] = found
+            out_d[row, :len(found)] = distances[row][keep][:k]
+        return out_d, out_p
+
+    def clone(self) -> "AnnIndex":
+        n = self.index.ntotal
+        return AnnIndex(dict(self.config), faiss.clone_index(self.index), self._positions[:n].copy())
+
+    def write(self, folder) -> list:
+        """
+        Write into a snapshot folder; returns the file names (save_snapshot checksums them).
+        """
+        faiss.write_index(self.index, os.path.join(str(folder), ANN_INDEX_FILE))
+        np.save(os.path.join(str(folder), ANN_POSITIONS_FILE), self._positions[:self.index.ntotal])
+        return [ANN_INDEX_FILE, ANN_POSITIONS_FILE]
+
+    def describe(self) -> dict:
+        return {**self.config, "labels": int(self.index.ntotal), "tombstones": int(self.tombstones)}
+
+
+def read_ann(folder, manifest: dict, config: dict):
+    """
+    The AnnIndex saved in a (verified) snapshot, or None if there is none or it was
+    built with a different structure than `config`.
+    """
+    saved = manifest.get("ann")
+    if not saved or not same_structure(saved, config):
+        return None
+    index = faiss.read_index(os.path.join(str(folder), ANN_INDEX_FILE))
+    positions = np.load(os.path.join(str(folder), ANN_POSITIONS_FILE))
+    if len(positions) != index.ntotal:
+        return None
+    return AnnIndex(config, index, positions)
+
+
+def build_ann(config: dict, vectors):
+    """
+    Build the ANN structure a resolved config asks for over a store's vectors (position
+    order, see vectorstore_utils.store_vectors), or None for "flat".
+    """
+    if config["type"] == "flat":
+        return None
+    if config["type"] == "ivf" and len(vectors) < 39 * config["nlist"]:
+        # Too few vectors to train the coarse quantizer; exact search is fast at this size anyway
+        return None
+    if len(vectors) < MIN_TRAIN[config.get("quantization", "none")]:
+        return None
+    return AnnIndex.build(config, vectors)
@@ -1,10 +1,6 @@
 
 import re
-import pdfplumber
-from PIL import Image
 from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
-import pytesseract
 import ast
 import random
 import os
@@ -19,6 +15,8 @@ def generate_unique_question_id(existing_ids, max_tries=10):
 
 # Extract text from PDF pages
 def extract_text_from_pdf(file_path):
+    import pdfplumber  # slow to import; only needed here
+
     images = []
     with pdfplumber.open(file_path) as pdf:
         for i, page in enumerate(pdf.pages):
@@ -31,6 +29,8 @@ def extract_text_from_pdf(file_path):
     return images
 
 def extract_lines_with_coordinates(pil_img):
+    import pytesseract
+
     ocr_data = pytesseract.image_to_data(pil_img, output_type=pytesseract.Output.DICT)
     lines = []
     current_line = ""
@@ -65,6 +65,8 @@ def extract_lines_with_coordinates(pil_img):
 
 
 def extract_question_coordinates_from_lines(lines, openai_api_key):
+    from langchain_openai import ChatOpenAI
+
     chat = ChatOpenAI(model_name="gpt-4", temperature=0, openai_api_key=openai_api_key)
     prompt = (
         "You are given a list of lines with their Y-coordinates from the top of a page.\n"
@@ -104,12 +106,31 @@ def crop_image_by_y_coords(img, y_start, y_end):
     return img.crop((0, y_start, img.width, y_end))
 
 def extract_text_with_ocr(pil_image):
+    import pytesseract
+
     return pytesseract.image_to_string(pil_image)
 
 def _to_rgb(img):
     return img.convert("RGB") if img.mode != "RGB" else img
 
+def downscale_base64_png(image_base64, max_side):
+    """
+    The same image as a base64 PNG whose longer side is at most max_side pixels.
+    """
+    import base64
+    import io
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(base64.b64decode(image_base64)))
+    if max(img.size) <= max_side:
+        return image_base64
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
+
 def _resize_to_height(img, target_h):
+    from PIL import Image
     w, h = img.size
     if h == target_h:
         return img
@@ -121,6 +142,7 @@ def _stitch_double_spreads(pages, gap=32, bg_color="white"):
     Arrange pages as 2 columns per row (double-page spreads), stacked into one image.
     Odd final page is centered in its row.
     """
+    from PIL import Image
     pages = [_to_rgb(p) for p in pages]
 
     # Build row images (each row has up to 2 pages)
@@ -167,26 +189,6 @@ def _stitch_double_spreads(pages, gap=32, bg_color="white"):
 
     return canvas
 
-from collections import Counter
-
-def tally_topics(corrections_context: str):
-    """
-    Extracts all topic names from the corrections context string and counts frequency.
-    Returns a Counter object sorted by most common.
-    """
-    topics_list = []
-
-    # Regex to find anything inside "['...']" or list-like parts
-    matches = re.findall(r"\['([^]]+)'\]", corrections_context)
-    for match in matches:
-        # match could be "MA-F1: ..., 'MA-C3: ...'"
-        for topic in [t.strip().strip("'").strip('"') for t in match.split(",")]:
-            if topic:
-                topics_list.append(topic)
-
-    return Counter(topics_list)
-
-
 # NOTE: This function contains the cropping logic which we've decided to remove for now
 # def extract_images_from_pdf(file_path, openai_api_key):
 #     images = []
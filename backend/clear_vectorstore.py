@@ -3,6 +3,7 @@ import shutil
 from dotenv import load_dotenv
 from langchain_community.vectorstores import FAISS
 from langchain_openai import OpenAIEmbeddings
+from vectorstore_utils import MANIFEST_FILE, load_snapshot, read_manifest
 
 load_dotenv()
 
@@ -50,26 +51,34 @@ def print_all_faiss_vectorstores(root_path):
 
         index_file = os.path.join(subdir, "index.faiss")
         store_file = os.path.join(subdir, "index.pkl")
+        manifest_file = os.path.join(subdir, MANIFEST_FILE)
 
-        if os.path.isdir(subdir) and os.path.exists(index_file) and os.path.exists(store_file):
+        if os.path.isdir(subdir) and os.path.exists(manifest_file):
 
             print(f"\n🔍 Vectorstore: {root_path}/{name}")
 
+            db = load_snapshot(subdir, embeddings, read_manifest(subdir)["model"])
+
+        elif os.path.isdir(subdir) and os.path.exists(index_file) and os.path.exists(store_file):
+
+            print(f"\n🔍 Vectorstore (legacy): {root_path}/{name}")
+
             db = FAISS.load_local(
                 subdir,
                 embeddings,
                 allow_dangerous_deserialization=True
             )
 
-            for i, (doc_id, doc) in enumerate(db.docstore._dict.items()):
-                print(f"  Document {i+1} - ID: {doc_id}")
-                print(f"    {doc.page_content[:150]}...")
-
-                if i >= 4:
-                    break
-
         else:
             print(f"\n⚠️ No FAISS index found in {subdir}")
+            continue
+
+        for i, (doc_id, doc) in enumerate(db.docstore._dict.items()):
+            print(f"  Document {i+1} - ID: {doc_id}")
+            print(f"    {doc.page_content[:150]}...")
+
+            if i >= 4:
+                break
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    """
+    Any number of readers or a single writer. Waiting writers block new readers, so a
+    steady stream of searches can't starve a correction. Not reentrant.
+
+    Time spent waiting to acquire is recorded per mode (see stats()).
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+        self._stats = {mode: {"acquired": 0, "contended": 0, "wait_total": 0.0, "wait_max": 0.0}
+                       for mode in ("read", "write")}
+
+    def _record(self, mode: str, waited: float):
+        # Called with self._cond held
+        s = self._stats[mode]
+        s["acquired"] += 1
+        if waited > 0:
+            s["contended"] += 1
+            s["wait_total"] += waited
+            s["wait_max"] = max(s["wait_max"], waited)
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            started = None
+            while self._writer or self._waiting_writers:
+                started = started or time.perf_counter()
+                self._cond.wait()
+            self._readers += 1
+            self._record("read", time.perf_counter() - started if started else 0.0)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            started = None
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    started = started or time.perf_counter()
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+            self._record("write", time.perf_counter() - started if started else 0.0)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                mode: {
+                    "acquired": s["acquired"],
+                    "contended": s["contended"],
+                    "wait_ms_total": round(s["wait_total"] * 1000, 3),
+                    "wait_ms_mean": round(s["wait_total"] * 1000 / s["contended"], 3) if s["contended"] else 0.0,
+                    "wait_ms_max": round(s["wait_max"] * 1000, 3),
+                }
+                for mode, s in self._stats.items()
+            }
+
+
+class SubjectLocks:
+    """
+    One ReadWriteLock per key (a subject, or e.g. "solutions:Biology"), created on first use.
+
+        with subject_locks.read(subject):   # searches, duplicate lookups
+        with subject_locks.write(subject):  # QuestionIndex mutations
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def get(self, key) -> ReadWriteLock:
+        with self._guard:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = ReadWriteLock()
+            return lock
+
+    def read(self, key):
+        return self.get(key).read()
+
+    def write(self, key):
+        return self.get(key).write()
+
+    def stats(self) -> dict:
+        with self._guard:
+            locks = dict(self._locks)
+        return {key: lock.stats() for key, lock in locks.items()}
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from db_utils import topic_ids_from_names
+
+# Per subject, e.g. CONFIDENCE_GATE_CONFIG='{"Biology": {"threshold": 0.7}}'. When the stored
+# neighbours of an upload agree on a topic set by at least `threshold` (its vote share minus the
+# runner-up's, see topic_votes.TopicMatrix.vote) that set is used as is and GPT isn't called.
+# Subjects without a threshold always go to GPT. Pick thresholds with
+#     python diagnostics.py gate --path faiss_indexes/biology --subject Biology
+CONFIDENCE_GATE_CONFIG = json.loads(os.getenv("CONFIDENCE_GATE_CONFIG", "{}"))
+
+GATE_DEFAULTS = {
+    "threshold": None,
+    "min_voters": 5,        # fewer close neighbours than this -> always GPT
+    "min_similarity": 0.5,  # ...and the nearest one backing the consensus must be this close
+}
+
+
+def gate_config(subject: str) -> dict:
+    return {**GATE_DEFAULTS, **CONFIDENCE_GATE_CONFIG.get(subject, {})}
+
+
+def confidence(vote: dict, config: dict) -> float:
+    """
+    Margin of the winning topic set, or 0 when too few or too distant neighbours back it.
+    """
+    if not vote["consensus"] or vote["voters"] < config["min_voters"]:
+        return 0.0
+    if vote["similarity"] < config["min_similarity"]:
+        return 0.0
+    return vote["margin"]
+
+
+def decide(vote: dict, config: dict):
+    """
+    The neighbours' consensus topics if confident enough to skip GPT, else None.
+    """
+    if config["threshold"] is None:
+        return None
+    return vote["consensus"] if confidence(vote, config) >= config["threshold"] else None
+
+
+class GateStats:
+    """
+    Per-subject counts of how uploads were classified: "model" (topic_classifier),
+    "neighbours" (this gate) or "gpt".
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, subject: str, source: str):
+        with self._lock:
+            counts = self._counts.setdefault(subject, {"model": 0, "neighbours": 0, "gpt": 0})
+            counts[source] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                subject: {**c, "skip_rate": round(1 - c["gpt"] / sum(c.values()), 4)}
+                for subject, c in self._counts.items()
+            }
+
+
+def evaluate(vs, matrix, truth_by_qid: dict, config: dict, k: int, thresholds,
+             sample: int = None, seed: int = 0):
+    """
+    Leave-one-out run of the gate over a store: every question with known topics (truth_by_qid:
+    question_id -> set of TopicIds, e.g. from the classification collection) is searched with its
+    own stored vector, minus itself. Returns one row per threshold:
+        (threshold, skip rate, precision of the skipped uploads, skipped count)
+    where a skipped upload is correct if its consensus topic ids equal the truth exactly.
+    """
+    from vectorstore_utils import search_store, store_vectors
+
+    vectors = store_vectors(vs)
+    positions = [
+        pos for pos in range(vs.index.ntotal)
+        if str(vs.docstore._dict[vs.index_to_docstore_id[pos]].metadata.get("question_id")) in truth_by_qid
+    ]
+    if sample and len(positions) > sample:
+        positions = sorted(np.random.RandomState(seed).choice(positions, sample, replace=False))
+
+    scores, correct = [], []
+    for pos in positions:
+        qid = str(vs.docstore._dict[vs.index_to_docstore_id[pos]].metadata["question_id"])
+        hits = [
+            (doc, distance) for doc, distance in search_store(vs, vectors[pos], k + 1)
+            if str(doc.metadata.get("question_id")) != qid
+        ][:k]
+        vote = matrix.vote(hits)
+        scores.append(confidence(vote, config))
+        correct.append(set(topic_ids_from_names(vote["consensus"])) == truth_by_qid[qid])
+
+    scores, correct = np.array(scores), np.array(correct, dtype=bool)
+    rows = []
+    for threshold in thresholds:
+        skipped = scores >= threshold
+        n = int(skipped.sum())
+        rows.append((
+            threshold,
+            n / len(scores) if len(scores) else 0.0,
+            float(correct[skipped].mean()) if n else float("nan"),
+            n,
+        ))
+    return rows
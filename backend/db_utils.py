@@ -2,6 +2,12 @@
 from typing import List, Dict, Any
 import random
 
+def topic_ids_from_names(topics: List[str]) -> List[str]:
+    """
+    "MA-C1: Introduction to Differentiation (Year 11)" -> "MA-C1" (bare ids pass through)
+    """
+    return [topic.split(":")[0].strip() for topic in topics]
+
 def insert_classified_question(question_obj, db):
     """
     question_obj: {
@@ -30,7 +36,7 @@ def insert_classified_question(question_obj, db):
         print(f"DB: Skipped — Question {question_obj['id']} already exists.")
 
     # Normalize topic strings to just "MA-XX" codes
-    topic_ids = [topic.split(":")[0].strip() for topic in question_obj["topics"]]
+    topic_ids = topic_ids_from_names(question_obj["topics"])
 
     # Remove any existing mappings for this question
     classifications_col.delete_many({"QuestionId": question_obj["id"]})
@@ -0,0 +1,332 @@
+import base64
+import hashlib
+import io
+import os
+import re
+import unicodedata
+import zlib
+
+import numpy as np
+
+# Characters Tesseract commonly emits for the same glyph on different scans
+_OCR_TRANSLATIONS = str.maketrans({
+    "‘": "'", "’": "'", "‚": "'", "′": "'", "`": "'",
+    "“": '"', "”": '"', "„": '"', "″": '"',
+    "‐": "-", "‑": "-", "‒": "-", "–": "-", "—": "-", "−": "-",
+    "×": "x", "•": "*", "·": "*",
+    " ": " ", "​": "", "‌": "", "‍": "", "﻿": "",
+})
+
+
+def normalize_ocr_text(text: str) -> str:
+    """
+    Canonical form of OCR output for duplicate detection: NFKC (ligatures, full-width
+    digits), lowercase, common OCR look-alikes folded, hyphenated line breaks joined,
+    spacing around punctuation and runs of whitespace collapsed.
+    """
+    text = unicodedata.normalize("NFKC", text or "").translate(_OCR_TRANSLATIONS).lower()
+    text = re.sub(r"-\s*\n\s*", "", text)          # "differ-\nentiate" -> "differentiate"
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s*([.,;:!?()\[\]=+*/<>])\s*", r"\1", text)
+    return text.strip()
+
+
+def text_fingerprint(text: str) -> str:
+    return hashlib.sha256(normalize_ocr_text(text).encode("utf-8")).hexdigest()
+
+
+class ExactTextIndex:
+    """
+    normalized OCR text hash -> question_id, for constant-time exact duplicate lookups.
+    Registered as a QuestionIndex observer so it follows every add/upsert/delete.
+    """
+
+    def __init__(self):
+        self._qids_by_hash = {}   # fingerprint -> [question_id, ...] (first one wins lookups)
+        self._hash_by_qid = {}
+
+    def clear(self):
+        self._qids_by_hash.clear()
+        self._hash_by_qid.clear()
+
+    def on_add(self, question_id: str, doc):
+        # A re-added question (new text) drops its old fingerprint, even if the new text is blank
+        self.on_remove(question_id)
+        if not normalize_ocr_text(doc.page_content):
+            return
+        fp = text_fingerprint(doc.page_content)
+        self._qids_by_hash.setdefault(fp, []).append(question_id)
+        self._hash_by_qid[question_id] = fp
+
+    def on_remove(self, question_id: str):
+        fp = self._hash_by_qid.pop(question_id, None)
+        if fp is None:
+            return
+        qids = self._qids_by_hash[fp]
+        qids.remove(question_id)
+        if not qids:
+            del self._qids_by_hash[fp]
+
+    def lookup(self, text: str):
+        """
+        question_id of a stored question with the same normalized text, or None.
+        Blank OCR output never matches.
+        """
+        if not normalize_ocr_text(text):
+            return None
+        qids = self._qids_by_hash.get(text_fingerprint(text))
+        return qids[0] if qids else None
+
+    def __len__(self) -> int:
+        return len(self._hash_by_qid)
+
+
+# ---- Near-duplicates: MinHash + LSH over character shingles ----
+
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.7"))
+MINHASH_PERMUTATIONS = 128
+SHINGLE_SIZE = 5
+
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+def shingles(text: str, k: int = SHINGLE_SIZE) -> set:
+    """
+    Character k-grams of the normalized text. Characters (not words) keep a single
+    misread glyph from changing more than k shingles.
+    """
+    text = normalize_ocr_text(text)
+    if not text:
+        return set()
+    if len(text) <= k:
+        return {text}
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+def _lsh_bands(threshold: float, num_perm: int, recall: float = 0.95):
+    """
+    (bands, rows) with the most rows per band (fewest false candidates) that still makes
+    a pair at the threshold a candidate with probability >= recall.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** rows) ** bands >= recall:
+            best = (bands, rows)
+    return best
+
+
+class MinHashLSHIndex:
+    """
+    Approximate Jaccard similarity over OCR shingles, for catching re-scans of the
+    same question whose Tesseract output differs slightly. A QuestionIndex observer.
+    """
+
+    def __init__(self, threshold: float = NEAR_DUPLICATE_THRESHOLD,
+                 num_perm: int = MINHASH_PERMUTATIONS, seed: int = 1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands, self.rows = _lsh_bands(threshold, num_perm)
+
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, _MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, _MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+
+        self._buckets = [dict() for _ in range(self.bands)]  # band -> key -> {qid}
+        self._signatures = {}
+
+    def signature(self, text: str):
+        grams = shingles(text)
+        if not grams:
+            return None
+        x = np.fromiter(
+            (zlib.crc32(g.encode("utf-8")) % _MERSENNE_PRIME for g in grams),
+            dtype=np.uint64, count=len(grams),
+        )
+        # (a*x + b) mod p for every permutation x shingle; a, x < 2^31 so nothing overflows
+        hashed = (np.outer(self._a, x) + self._b[:, None]) % _MERSENNE_PRIME
+        return hashed.min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, sig):
+        r = self.rows
+        return [sig[i * r:(i + 1) * r].tobytes() for i in range(self.bands)]
+
+    def clear(self):
+        for bucket in self._buckets:
+            bucket.clear()
+        self._signatures.clear()
+
+    def on_add(self, question_id: str, doc):
+        sig = self.signature(doc.page_content)
+        if sig is None:
+            return
+        self.on_remove(question_id)
+        self._signatures[question_id] = sig
+        for bucket, key in zip(self._buckets, self._band_keys(sig)):
+            bucket.setdefault(key, set()).add(question_id)
+
+    def on_remove(self, question_id: str):
+        sig = self._signatures.pop(question_id, None)
+        if sig is None:
+            return
+        for bucket, key in zip(self._buckets, self._band_keys(sig)):
+            qids = bucket.get(key)
+            if qids is not None:
+                qids.discard(question_id)
+                if not qids:
+                    del bucket[key]
+
+    def query(self, text: str):
+        """
+        (question_id, estimated Jaccard) of the closest stored question at or above the
+        threshold, or None.
+        """
+        sig = self.signature(text)
+        if sig is None:
+            return None
+
+        candidates = set()
+        for bucket, key in zip(self._buckets, self._band_keys(sig)):
+            candidates.update(bucket.get(key, ()))
+
+        best = None
+        for qid in candidates:
+            similarity = float(np.mean(self._signatures[qid] == sig))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (qid, similarity)
+        return best
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+
+# ---- Repeat uploads: perceptual (difference) hash of the rendered page ----
+
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "4"))
+PHASH_BITS = 64
+# A dHash match is only a candidate: pages from one paper share headers, margins and layout,
+# so 64 bits of a mostly-white page can match a different question. Candidates are confirmed
+# against their stored image (see page_change); at most this many are tried per upload
+PHASH_CANDIDATES = 3
+# Of the pixels inked in either page's thumbnail, the share that may differ on a repeat
+PHASH_CONFIRM_MAX_CHANGE = float(os.getenv("PHASH_CONFIRM_MAX_CHANGE", "0.1"))
+PAGE_THUMBNAIL_WIDTH = 128
+
+
+def image_dhash(image) -> str:
+    """
+    64-bit difference hash of a PIL image, as 16 hex chars. The image is box-averaged
+    down to 9x8 grey pixels first, so a 30 dpi preview and the 200 dpi render of the
+    same page hash (almost) identically.
+    """
+    from PIL import Image
+    small = image.convert("L").resize((9, 8), Image.BOX)
+    pixels = np.asarray(small).ravel().tolist()
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+
+def image_from_base64(image_base64: str):
+    from PIL import Image
+    return Image.open(io.BytesIO(base64.b64decode(image_base64)))
+
+
+def dhash_from_base64(image_base64: str) -> str:
+    return image_dhash(image_from_base64(image_base64))
+
+
+def page_change(image, other, width: int = PAGE_THUMBNAIL_WIDTH) -> float:
+    """
+    How different two renders of a page are, from 0 (same page) to 1: both are box-averaged
+    to `width` grey pixels across, and this is the share of pixels inked in either that
+    differ by more than a quarter of the grey range. A different question on the same exam
+    template differs in its body text, which is most of the ink. Pages of different shapes
+    are 1.0.
+    """
+    ratio, other_ratio = image.width / image.height, other.width / other.height
+    if abs(ratio - other_ratio) > 0.02 * ratio:
+        return 1.0
+    # Never wider than the smaller render, which upsampling would only blur
+    from PIL import Image
+    width = min(width, image.width, other.width)
+    size = (width, max(1, round(width / ratio)))
+    a = np.asarray(image.convert("L").resize(size, Image.BOX), dtype=np.int16)
+    b = np.asarray(other.convert("L").resize(size, Image.BOX), dtype=np.int16)
+    inked = (a < 192) | (b < 192)
+    if not inked.any():
+        return 0.0
+    return float((np.abs(a - b) > 64).sum() / inked.sum())
+
+
+class PerceptualHashIndex:
+    """
+    Multi-index hash table over 64-bit dHashes: the hash is split into max_distance + 1
+    chunks, so (pigeonhole) anything within max_distance bits shares at least one chunk
+    exactly. Lookups touch only those buckets. A QuestionIndex observer that reads
+    metadata["phash"].
+    """
+
+    def __init__(self, max_distance: int = PHASH_MAX_DISTANCE):
+        self.max_distance = max_distance
+        chunks = max_distance + 1
+        bounds = [round(i * PHASH_BITS / chunks) for i in range(chunks + 1)]
+        self._chunks = list(zip(bounds[:-1], bounds[1:]))
+        self._tables = [dict() for _ in self._chunks]  # chunk -> value -> {qid}
+        self._hashes = {}
+
+    def _chunk_values(self, h: int):
+        return [(h >> start) & ((1 << (end - start)) - 1) for start, end in self._chunks]
+
+    def clear(self):
+        for table in self._tables:
+            table.clear()
+        self._hashes.clear()
+
+    def on_add(self, question_id: str, doc):
+        phash = doc.metadata.get("phash")
+        if not phash:
+            return
+        self.on_remove(question_id)
+        h = int(phash, 16)
+        self._hashes[question_id] = h
+        for table, value in zip(self._tables, self._chunk_values(h)):
+            table.setdefault(value, set()).add(question_id)
+
+    def on_remove(self, question_id: str):
+        h = self._hashes.pop(question_id, None)
+        if h is None:
+            return
+        for table, value in zip(self._tables, self._chunk_values(h)):
+            qids = table.get(value)
+            if qids is not None:
+                qids.discard(question_id)
+                if not qids:
+                    del table[value]
+
+    def matches(self, phash: str, limit: int = PHASH_CANDIDATES):
+        """
+        [(question_id, Hamming distance)] of up to `limit` stored images within max_distance,
+        nearest first. These are candidates only; confirm them with page_change.
+        """
+        h = int(phash, 16)
+        found = {}
+        for table, value in zip(self._tables, self._chunk_values(h)):
+            for qid in table.get(value, ()):
+                if qid not in found:
+                    distance = bin(self._hashes[qid] ^ h).count("1")
+                    if distance <= self.max_distance:
+                        found[qid] = distance
+        return sorted(found.items(), key=lambda kv: (kv[1], kv[0]))[:limit]
+
+    def query(self, phash: str):
+        """
+        (question_id, Hamming distance) of the closest stored image within max_distance, or None.
+        """
+        matches = self.matches(phash, limit=1)
+        return matches[0] if matches else None
+
+    def __len__(self) -> int:
+        return len(self._hashes)
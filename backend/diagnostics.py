@@ -0,0 +1,286 @@
+"""
+Startup diagnostics for the backend.
+
+    python diagnostics.py imports                 # digest of `python -X importtime -c "import main"`
+    python diagnostics.py imports --budget-ms 800 # ...and exit 1 if the import is over budget
+
+    python diagnostics.py ann --path faiss_indexes/advanced   # recall@k vs latency/size per index config
+    python diagnostics.py ann --synthetic 1000000             # same on clustered random vectors
+
+    python diagnostics.py gate --path faiss_indexes/biology --subject Biology
+                                                  # GPT skip rate vs precision per confidence threshold
+
+Run it from backend/ after dependency or import changes to keep worker cold starts in check,
+and before changing VECTORSTORE_INDEX_CONFIG or CONFIDENCE_GATE_CONFIG.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+# Default cap on `import main` (cumulative, in a fresh interpreter)
+IMPORT_BUDGET_MS = float(os.getenv("IMPORT_BUDGET_MS", "1500"))
+
+
+def parse_importtime(stderr: str):
+    """
+    [(indent, self_us, cumulative_us, module)] from -X importtime output, in print order
+    (a module is printed after everything it imported).
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        indent = len(name) - len(name.lstrip(" "))
+        rows.append((indent, int(self_us), int(cumulative_us), name.strip()))
+    return rows
+
+
+def import_report(module: str = "main", top: int = 15) -> dict:
+    """
+    Import `module` in a fresh interpreter and digest where the time went.
+    """
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=backend_dir, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        tail = proc.stderr.strip().splitlines()[-1:] or ["unknown error"]
+        raise RuntimeError(f"import {module} failed: {tail[0]}")
+
+    rows = parse_importtime(proc.stderr)
+    end = next(i for i in range(len(rows) - 1, -1, -1) if rows[i][3] == module)
+    # The module's subtree is everything printed between it and the previous top-level import
+    start = end
+    while start > 0 and rows[start - 1][0] > rows[end][0]:
+        start -= 1
+    subtree = rows[start:end + 1]
+
+    by_package = defaultdict(int)
+    for _, self_us, _, name in subtree:
+        by_package[name.split(".")[0]] += self_us
+
+    return {
+        "module": module,
+        "total_ms": round(rows[end][2] / 1000, 1),
+        "modules": len(subtree),
+        "packages": sorted(
+            ((pkg, round(us / 1000, 1)) for pkg, us in by_package.items()),
+            key=lambda item: item[1], reverse=True,
+        )[:top],
+    }
+
+
+def _synthetic_vectors(n: int, d: int, seed: int = 0):
+    # Clustered like real embeddings (topics), not uniform noise, or IVF/HNSW look unrealistically bad
+    import numpy as np
+
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(size=(max(1, n // 1000), d)).astype("float32")
+    vectors = centers[rng.randint(len(centers), size=n)] + 0.5 * rng.normal(size=(n, d)).astype("float32")
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def ann_report(vectors, k: int = 150, n_queries: int = 200, configs=None, seed: int = 0):
+    """
+    recall@k, single-query latency and index size of each index config (ann_index /
+    quantization settings) against exact search. Queries are stored vectors with a little
+    noise (a re-scan of a known question). Returns [(config, recall, mean_ms, p99_ms, mb_per_100k)].
+    """
+    import faiss
+    import numpy as np
+    from ann_index import AnnIndex, resolve_config
+    from quantization import MIN_TRAIN, new_codes_index, resolve_quantization
+
+    n, d = vectors.shape
+    rng = np.random.RandomState(seed)
+    queries = vectors[rng.choice(n, min(n_queries, n), replace=False)]
+    queries = (queries + 0.01 * rng.normal(size=queries.shape)).astype("float32")
+
+    exact = faiss.IndexFlatL2(d)
+    exact.add(vectors)
+
+    def run(search):
+        found, times = [], []
+        for q in queries:
+            started = time.perf_counter()
+            found.append(search(q.reshape(1, -1)))
+            times.append((time.perf_counter() - started) * 1000)
+        return found, np.array(times)
+
+    def mb_per_100k(index):
+        return len(faiss.serialize_index(index)) / n * 100000 / 2 ** 20
+
+    truth, times = run(lambda q: exact.search(q, k)[1][0])
+    rows = [({"type": "flat"}, 1.0, times.mean(), np.percentile(times, 99), mb_per_100k(exact))]
+
+    if configs is None:
+        modes = [mode for mode in ("fp16", "sq8", "binary", "pq") if n >= MIN_TRAIN[mode]]
+        configs = [resolve_config({"type": "flat", "quantization": mode}, n) for mode in modes]
+        ivf = resolve_config({"type": "ivf"}, n)
+        configs += [dict(ivf, nprobe=p) for p in (1, 2, 4, 8, 16, 32, 64, 128) if p <= ivf["nlist"]]
+        configs += [resolve_config({"type": "hnsw", "ef_search": ef}, n) for ef in (k, 2 * k, 4 * k, 8 * k)]
+        if n >= MIN_TRAIN["pq"]:
+            configs += [dict(ivf, quantization="pq", nprobe=p) for p in (16, 32, 64) if p <= ivf["nlist"]]
+
+    built = {}
+    for config in configs:
+        quant = resolve_quantization(config, d)
+        key = (config["type"], config.get("nlist"), config.get("M"), config.get("ef_construction"),
+               quant["mode"], quant.get("pq_m"))
+        if key not in built:
+            started = time.perf_counter()
+            if config["type"] == "flat":
+                index = new_codes_index(quant, d, vectors)
+                index.add(vectors)
+                built[key] = index
+            else:
+                built[key] = AnnIndex.build(config, vectors)
+            print(f"  built {config['type']}/{quant['mode']} in {time.perf_counter() - started:.1f}s")
+        structure = built[key]
+        if config["type"] != "flat":
+            structure.config = config  # search params are read from the config on every search
+
+        fetch = k * quant["rerank"] if quant["rerank"] > 1 else k
+
+        def search(q):
+            candidates = structure.search(q, fetch)[1][0]
+            candidates = candidates[candidates >= 0]
+            if quant["rerank"]:
+                # Exact re-rank, as vectorstore_utils.search_store does from ExactVectors
+                distances = ((vectors[candidates] - q) ** 2).sum(axis=1)
+                candidates = candidates[np.argsort(distances, kind="stable")[:k]]
+            return candidates
+
+        found, times = run(search)
+        recall = np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+        size = mb_per_100k(structure if config["type"] == "flat" else structure.index)
+        described = dict(config, quantization=quant["mode"], **{k: v for k, v in quant.items() if k != "mode"})
+        rows.append((described, float(recall), times.mean(), np.percentile(times, 99), size))
+    return rows
+
+
+def gate_report(path: str, subject: str, k: int, sample: int, config: dict):
+    """
+    Leave-one-out confidence gate evaluation of a snapshot against MongoDB's classification
+    collection (see confidence_gate.evaluate).
+    """
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    from confidence_gate import evaluate
+    from topic_votes import TopicMatrix
+    from vectorstore_utils import load_snapshot, read_manifest
+
+    load_dotenv()
+    db = MongoClient(os.getenv("MONGO_URI"))["hschub"]
+    vs = load_snapshot(path, None, read_manifest(path).get("model"))
+    matrix = TopicMatrix()
+    for doc in vs.docstore._dict.values():
+        matrix.on_add(str(doc.metadata.get("question_id")), doc)
+
+    subject_topics = {t["TopicId"] for t in db["topics"].find({"subject": subject}, {"TopicId": 1})}
+    truth = defaultdict(set)
+    for row in db["classification"].find({}, {"_id": 0, "QuestionId": 1, "TopicId": 1}):
+        if row["TopicId"] in subject_topics:
+            truth[str(row["QuestionId"])].add(row["TopicId"])
+    thresholds = [round(0.05 * i, 2) for i in range(1, 21)]
+    return evaluate(vs, matrix, truth, config, k, thresholds, sample)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backend startup diagnostics")
+    sub = parser.add_subparsers(dest="command", required=True)
+    imports = sub.add_parser("imports", help="import-time digest for a module")
+    imports.add_argument("--module", default="main")
+    imports.add_argument("--top", type=int, default=15)
+    imports.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    ann = sub.add_parser("ann", help="recall vs latency and size of index/quantization configs on a store")
+    source = ann.add_mutually_exclusive_group(required=True)
+    source.add_argument("--path", help="snapshot folder, e.g. faiss_indexes/advanced")
+    source.add_argument("--synthetic", type=int, help="number of random clustered vectors")
+    ann.add_argument("--dim", type=int, default=1536)
+    ann.add_argument("--k", type=int, default=150)
+    ann.add_argument("--queries", type=int, default=200)
+    ann.add_argument("--target-recall", type=float, default=0.95)
+    gate = sub.add_parser("gate", help="GPT skip rate vs precision of the confidence gate on a store")
+    gate.add_argument("--path", required=True, help="snapshot folder, e.g. faiss_indexes/biology")
+    gate.add_argument("--subject", required=True)
+    gate.add_argument("--k", type=int, default=150)
+    gate.add_argument("--sample", type=int, default=2000, help="questions to evaluate (0 = all)")
+    gate.add_argument("--min-voters", type=int)
+    gate.add_argument("--min-similarity", type=float)
+    gate.add_argument("--target-precision", type=float, default=0.95)
+    args = parser.parse_args()
+
+    if args.command == "gate":
+        from confidence_gate import gate_config
+
+        config = gate_config(args.subject)
+        if args.min_voters is not None:
+            config["min_voters"] = args.min_voters
+        if args.min_similarity is not None:
+            config["min_similarity"] = args.min_similarity
+        rows = gate_report(args.path, args.subject, args.k, args.sample, config)
+        print(f"{args.subject}: min_voters={config['min_voters']}, min_similarity={config['min_similarity']}, k={args.k}")
+        print(f"\n  {'threshold':>9}  {'skip rate':>9}  {'precision':>9}  {'skipped':>7}")
+        for threshold, skip_rate, precision, n in rows:
+            print(f"  {threshold:9.2f}  {skip_rate:9.3f}  {precision:9.3f}  {n:7d}")
+
+        ok = [row for row in rows if row[3] and row[2] >= args.target_precision]
+        if not ok:
+            print(f"\nNo threshold reaches precision {args.target_precision}; leave the gate off")
+            return
+        best = min(ok, key=lambda row: row[0])
+        print(f"\nLowest threshold with precision >= {args.target_precision}: {best[0]} "
+              f"(skips GPT for {best[1]:.1%} of uploads)")
+        print(f"  CONFIDENCE_GATE_CONFIG='{{\"{args.subject}\": {{\"threshold\": {best[0]}}}}}'")
+        return
+
+
+    if args.command == "ann":
+        if args.path:
+            import faiss
+            import numpy as np
+            from quantization import VECTORS_FILE
+            from vectorstore_utils import INDEX_FILE, read_manifest, verify_snapshot
+
+            manifest = verify_snapshot(args.path, model=read_manifest(args.path).get("model"))
+            if manifest.get("quantization"):
+                # Quantized stores keep their exact vectors next to the compressed index
+                vectors = np.load(os.path.join(args.path, VECTORS_FILE))
+            else:
+                index = faiss.read_index(os.path.join(args.path, INDEX_FILE))
+                vectors = index.reconstruct_n(0, index.ntotal)
+        else:
+            vectors = _synthetic_vectors(args.synthetic, args.dim)
+        print(f"{len(vectors)} vectors, d={vectors.shape[1]}, k={args.k}, {args.queries} queries")
+
+        rows = ann_report(vectors, args.k, args.queries)
+        print(f"\n  {'recall@' + str(args.k):>10}  {'mean ms':>8}  {'p99 ms':>8}  {'MB/100k':>8}  config")
+        for config, recall, mean_ms, p99_ms, mb in rows:
+            print(f"  {recall:10.4f}  {mean_ms:8.3f}  {p99_ms:8.3f}  {mb:8.1f}  {config}")
+
+        ok = [row for row in rows if row[1] >= args.target_recall]
+        best = min(ok, key=lambda row: row[2])
+        print(f"\nFastest config with recall >= {args.target_recall}: {best[0]} ({best[2]:.3f} ms)")
+        return
+
+    report = import_report(args.module, args.top)
+    print(f"import {report['module']}: {report['total_ms']} ms across {report['modules']} modules "
+          f"(budget {args.budget_ms:g} ms)")
+    for pkg, ms in report["packages"]:
+        print(f"  {ms:8.1f} ms  {pkg}")
+
+    if report["total_ms"] > args.budget_ms:
+        print(f"❌ Over budget by {report['total_ms'] - args.budget_ms:.1f} ms")
+        sys.exit(1)
+    print("✅ Within budget")
+
+
+if __name__ == "__main__":
+    main()
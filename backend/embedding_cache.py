@@ -0,0 +1,210 @@
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from pathlib import Path
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+EMBEDDING_CACHE_PATH = Path(os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache/embeddings.sqlite3"))
+# ~6 KB per 1536-dim vector, so the default caps the file at roughly 600 MB
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+# Puts between re-counts of the table, which other uvicorn workers also write to
+RECOUNT_EVERY = 1000
+
+
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings object with a persistent on-disk cache.
+
+    Keys are sha256(model, dimensions, normalized text), so the same question text is only
+    ever sent to the API once per model, across rebuilds, restarts and clear_vectorstore.py.
+    The cache is bounded to `max_entries` and evicts least-recently-used vectors.
+
+    `underlying` may also be a zero-argument factory; it is then only called (and the
+    provider SDK imported) on the first cache miss.
+    """
+
+    def __init__(self, underlying, model: str, dimensions: int = None,
+                 path=EMBEDDING_CACHE_PATH, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self._underlying = underlying
+        self.model = model
+        self.dimensions = dimensions
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings(last_used)")
+        self._conn.commit()
+        # Kept up to date on insert and evict, rather than a COUNT(*) (a full scan) on every put
+        self._entries = self._row_count()
+        self._puts = 0
+
+    @property
+    def underlying(self) -> Embeddings:
+        if not isinstance(self._underlying, Embeddings):
+            with self._lock:
+                if not isinstance(self._underlying, Embeddings):
+                    self._underlying = self._underlying()
+        return self._underlying
+
+    async def _aunderlying(self) -> Embeddings:
+        # Normally built during warm-up; if not, the factory (an SDK import) runs off the event loop
+        if isinstance(self._underlying, Embeddings):
+            return self._underlying
+        return await asyncio.to_thread(lambda: self.underlying)
+
+    def _key(self, text: str) -> str:
+        raw = f"{self.model}\x00{self.dimensions}\x00{normalize_text(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _get_many(self, keys: List[str]) -> dict:
+        found = {}
+        now = time.time()
+        with self._lock:
+            # SQLite caps bound parameters, so look up in chunks
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+        return found
+
+    def _row_count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _put_many(self, items):
+        now = time.time()
+        with self._lock:
+            # A key that's already there (another thread or worker embedded the same text) has
+            # the same vector, so it's left alone and only new rows are counted
+            added = self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), now) for key, vector in items],
+            ).rowcount
+            self._entries += added
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # Other workers' inserts aren't in our count: re-count now and then, and before evicting
+        self._puts += 1
+        if self._puts % RECOUNT_EVERY == 0 or self._entries > self.max_entries:
+            self._entries = self._row_count()
+        if self._entries <= self.max_entries:
+            return
+        # Evict down to 90% so we don't pay for this on every insert
+        excess = self._entries - int(self.max_entries * 0.9)
+        evicted = self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN ("
+            " SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+            (excess,),
+        ).rowcount
+        self._entries -= evicted
+        self.evictions += evicted
+
+    def _lookup(self, texts: List[str]):
+        keys = [self._key(t) for t in texts]
+        cached = self._get_many(list(set(keys)))
+
+        # Embed each distinct missing text once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        n_missing = sum(1 for k in keys if k in missing)
+        with self._lock:
+            # embed_documents is called from several threads during streaming builds
+            self.hits += len(texts) - n_missing
+            self.misses += n_missing
+        return keys, cached, missing
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, cached, missing = self._lookup(texts)
+        if missing:
+            vectors = self.underlying.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            self._put_many(new_items)
+            cached.update(new_items)
+
+        return [cached[k] for k in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        keys, cached, missing = self._lookup([text])
+        if missing:
+            vector = self.underlying.embed_query(text)
+            self._put_many([(keys[0], vector)])
+            return vector
+        return cached[keys[0]]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        embed_documents on the underlying model's async client; request paths use this so
+        a cache miss doesn't block the event loop. The SQLite reads and writes (and waits on
+        the lock index builds share) run in a thread for the same reason.
+        """
+        keys, cached, missing = await asyncio.to_thread(self._lookup, texts)
+        if missing:
+            underlying = await self._aunderlying()
+            vectors = await underlying.aembed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            await asyncio.to_thread(self._put_many, new_items)
+            cached.update(new_items)
+
+        return [cached[k] for k in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        keys, cached, missing = await asyncio.to_thread(self._lookup, [text])
+        if missing:
+            underlying = await self._aunderlying()
+            vector = await underlying.aembed_query(text)
+            await asyncio.to_thread(self._put_many, [(keys[0], vector)])
+            return vector
+        return cached[keys[0]]
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = self._row_count()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "entries": size,
+            "max_entries": self.max_entries,
+        }
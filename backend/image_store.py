@@ -0,0 +1,70 @@
+import base64
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+# Question images live here as raw PNG bytes, one file per sha256 of the bytes:
+#   image_store/ab/ab12....png
+IMAGE_STORE_ROOT = Path(os.getenv("IMAGE_STORE_ROOT", "image_store"))
+
+
+def _image_path(image_hash: str, root: Path = IMAGE_STORE_ROOT) -> Path:
+    return Path(root) / image_hash[:2] / f"{image_hash}.png"
+
+
+def put_image(image_base64: str, root: Path = IMAGE_STORE_ROOT) -> str:
+    """
+    Store a base64 image and return its sha256. Storing the same image twice is a no-op.
+    """
+    data = base64.b64decode(image_base64)
+    image_hash = hashlib.sha256(data).hexdigest()
+    path = _image_path(image_hash, root)
+    if path.exists():
+        return image_hash
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return image_hash
+
+
+def get_image(image_hash: str, root: Path = IMAGE_STORE_ROOT) -> Optional[str]:
+    """
+    Return the stored image as base64, or None if it isn't in the store.
+    """
+    if not image_hash:
+        return None
+    path = _image_path(image_hash, root)
+    if not path.exists():
+        return None
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("utf-8")
+
+
+def doc_image_base64(doc) -> str:
+    """
+    Resolve a vectorstore Document's image lazily (only when a response needs it).
+    """
+    return get_image(doc.metadata.get("image_hash")) or doc.metadata.get("base64", "")
+
+
+def externalize_image(metadata: dict, root: Path = IMAGE_STORE_ROOT) -> bool:
+    """
+    Move metadata["base64"] into the store, leaving metadata["image_hash"] behind.
+    Returns True if the metadata changed.
+    """
+    if "base64" not in metadata:
+        return False
+    image_base64 = metadata.pop("base64")
+    if image_base64:
+        metadata["image_hash"] = put_image(image_base64, root)
+    return True
@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+LLM_CACHE_PATH = Path(os.getenv("LLM_CACHE_PATH", "llm_cache/responses.sqlite3"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "20000"))
+# Puts between re-counts of the table, which other uvicorn workers also write to
+RECOUNT_EVERY = 1000
+
+# Endpoints whose LLM answers are cached, and for how long (seconds, null = until evicted).
+# Only near-deterministic calls opt in. Override per endpoint, or switch one off, with e.g.
+#   LLM_CACHE_CONFIG='{"generate_solution": {"ttl": 86400}, "generate_diagram": {"enabled": false}}'
+LLM_CACHE_POLICY = {
+    "generate_diagram": {"enabled": True, "ttl": 7 * 86400},
+    "generate_solution": {"enabled": True, "ttl": 7 * 86400},
+    "extract_question_text": {"enabled": True, "ttl": None},
+}
+for _endpoint, _policy in json.loads(os.getenv("LLM_CACHE_CONFIG", "{}")).items():
+    LLM_CACHE_POLICY[_endpoint] = {**LLM_CACHE_POLICY.get(_endpoint, {"enabled": True, "ttl": None}), **_policy}
+
+
+def cache_mode(cache_control: str = None) -> str:
+    """
+    How a request uses the cache, from its Cache-Control header: "use" by default,
+    "refresh" for no-cache (ask the model, store the new answer), "off" for no-store.
+    """
+    directives = {d.strip().lower() for d in (cache_control or "").split(",")}
+    if "no-store" in directives:
+        return "off"
+    if "no-cache" in directives:
+        return "refresh"
+    return "use"
+
+
+def request_key(request: dict) -> str:
+    """
+    sha256 of the whole API request (model, messages/input, response_format, temperature,
+    seed, ...), so any change to the prompt or the retrieved context is a different entry.
+    """
+    raw = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Model output text keyed by request_key, in SQLite. Entries expire after their endpoint's
+    TTL and the table is bounded to `max_entries`, evicting least-recently-used answers.
+    """
+
+    def __init__(self, path=LLM_CACHE_PATH, max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 policy: dict = LLM_CACHE_POLICY):
+        self.max_entries = max_entries
+        self.policy = policy
+        self.evictions = 0
+        self._counts = {}  # endpoint -> {"hits", "misses"}
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " endpoint TEXT NOT NULL,"
+            " output TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses(last_used)")
+        self._conn.commit()
+        # Kept up to date on insert, expiry and evict, rather than a COUNT(*) (a full scan) on every put
+        self._entries = self._row_count()
+        self._puts = 0
+
+    def enabled(self, endpoint: str) -> bool:
+        return self.policy.get(endpoint, {}).get("enabled", False)
+
+    def _count(self, endpoint, outcome):
+        counts = self._counts.setdefault(endpoint, {"hits": 0, "misses": 0})
+        counts[outcome] += 1
+
+    def get(self, endpoint: str, key: str):
+        """
+        The cached output, or None if missing or older than the endpoint's TTL.
+        """
+        ttl = self.policy.get(endpoint, {}).get("ttl")
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT output, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and ttl is not None and now - row[1] > ttl:
+                self._entries -= self._conn.execute("DELETE FROM responses WHERE key = ?", (key,)).rowcount
+                self._conn.commit()
+                row = None
+            if row is None:
+                self._count(endpoint, "misses")
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self._count(endpoint, "hits")
+            return row[0]
+
+    def put(self, endpoint: str, key: str, output: str):
+        now = time.time()
+        with self._lock:
+            # A refresh (no-cache) replaces the answer already there: not a new row
+            if self._conn.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone() is None:
+                self._entries += 1
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, endpoint, output, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, endpoint, output, now, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _row_count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _evict(self):
+        # Other workers' inserts aren't in our count: re-count now and then, and before evicting
+        self._puts += 1
+        if self._puts % RECOUNT_EVERY == 0 or self._entries > self.max_entries:
+            self._entries = self._row_count()
+        if self._entries <= self.max_entries:
+            return
+        # Evict down to 90% so we don't pay for this on every insert
+        excess = self._entries - int(self.max_entries * 0.9)
+        evicted = self._conn.execute(
+            "DELETE FROM responses WHERE key IN ("
+            " SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)",
+            (excess,),
+        ).rowcount
+        self._entries -= evicted
+        self.evictions += evicted
+
+    async def call(self, endpoint: str, api, output, mode: str = "use", on_response=None, **request) -> str:
+        """
+        Output text of await api(**request) (output turns the response into text), answered
+        from the cache if the endpoint opts in. mode is cache_mode() of the request's
+        Cache-Control header; on_response(response, seconds) sees each call actually made.
+        The SQLite reads and writes run in a thread, off the event loop.
+        """
+        use_cache = mode != "off" and self.enabled(endpoint)
+        key = request_key(request) if use_cache else None
+        if use_cache and mode == "use":
+            text = await asyncio.to_thread(self.get, endpoint, key)
+            if text is not None:
+                print(f"📦 {endpoint}: cached response")
+                return text
+
+        started = time.perf_counter()
+        response = await api(**request)
+        if on_response is not None:
+            on_response(response, time.perf_counter() - started)
+        text = output(response)
+        if use_cache:
+            await asyncio.to_thread(self.put, endpoint, key, text)
+        return text
+
+    def stats(self) -> dict:
+        with self._lock:
+            sizes = dict(self._conn.execute("SELECT endpoint, COUNT(*) FROM responses GROUP BY endpoint").fetchall())
+            endpoints = {}
+            for endpoint in sorted(set(self._counts) | set(sizes)):
+                counts = self._counts.get(endpoint, {"hits": 0, "misses": 0})
+                total = counts["hits"] + counts["misses"]
+                endpoints[endpoint] = {
+                    **counts,
+                    "hit_rate": round(counts["hits"] / total, 4) if total else 0.0,
+                    "entries": sizes.get(endpoint, 0),
+                }
+            return {"endpoints": endpoints, "evictions": self.evictions, "max_entries": self.max_entries}
@@ -0,0 +1,167 @@
+import asyncio
+import importlib.util
+import os
+import threading
+
+# Every OpenAI call a worker makes from a request (chat, responses and embeddings) goes
+# through one AsyncOpenAI client on one pooled httpx client: kept-alive connections, HTTP/2
+# when the h2 package is installed, and at most OPENAI_MAX_CONCURRENCY requests in flight
+# per host, the rest wait their turn instead of piling onto the API.
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "64"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_KEEPALIVE_SECONDS = float(os.getenv("OPENAI_KEEPALIVE_SECONDS", "120"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+# Connections opened at startup, so the first requests don't pay for DNS + TLS
+OPENAI_WARM_CONNECTIONS = int(os.getenv("OPENAI_WARM_CONNECTIONS", "2"))
+# "auto" uses HTTP/2 if h2 is installed (pip install "httpx[http2]"), "0"/"1" force it
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "auto")
+
+
+def http2_enabled() -> bool:
+    if OPENAI_HTTP2 == "auto":
+        return importlib.util.find_spec("h2") is not None
+    return OPENAI_HTTP2 == "1"
+
+
+class HostLimitedTransport:
+    """
+    httpx async transport wrapper that caps in-flight requests per host (HTTP/2 multiplexes
+    any number of requests over one connection, so the pool size alone doesn't), and counts
+    them for /metrics/openai. Duck-typed, so importing this module doesn't import httpx.
+    """
+
+    def __init__(self, transport, limit: int):
+        self._transport = transport
+        self.limit = limit
+        self._slots = {}  # host -> asyncio.Semaphore
+        self._hosts = {}  # host -> counters
+        self._lock = threading.Lock()
+
+    async def handle_async_request(self, request):
+        host = request.url.host
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = asyncio.Semaphore(self.limit)
+                self._hosts[host] = {"requests": 0, "in_flight": 0, "waiting": 0, "max_in_flight": 0}
+            slots, s = self._slots[host], self._hosts[host]
+            s["waiting"] += 1
+        acquired = False
+        try:
+            async with slots:
+                acquired = True
+                with self._lock:
+                    s["waiting"] -= 1
+                    s["requests"] += 1
+                    s["in_flight"] += 1
+                    s["max_in_flight"] = max(s["max_in_flight"], s["in_flight"])
+                try:
+                    return await self._transport.handle_async_request(request)
+                finally:
+                    with self._lock:
+                        s["in_flight"] -= 1
+        finally:
+            if not acquired:  # cancelled while waiting for a slot
+                with self._lock:
+                    s["waiting"] -= 1
+
+    async def __aenter__(self):
+        await self._transport.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._transport.__aexit__(*exc_info)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {host: dict(s) for host, s in self._hosts.items()}
+
+
+_http_client = None
+_transport = None
+_http_lock = threading.Lock()
+
+
+def http_client():
+    """
+    The worker's shared httpx.AsyncClient for OpenAI, created on first use.
+    """
+    global _http_client, _transport
+    import httpx
+
+    with _http_lock:
+        if _http_client is None:
+            http2 = http2_enabled()
+            _transport = HostLimitedTransport(
+                httpx.AsyncHTTPTransport(
+                    http2=http2,
+                    limits=httpx.Limits(
+                        max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                        keepalive_expiry=OPENAI_KEEPALIVE_SECONDS,
+                    ),
+                ),
+                OPENAI_MAX_CONCURRENCY,
+            )
+            _http_client = httpx.AsyncClient(
+                transport=_transport,
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+                follow_redirects=True,
+            )
+            print(f"🔌 OpenAI HTTP pool: http2={http2}, {OPENAI_MAX_CONCURRENCY} in flight per host")
+        return _http_client
+
+
+async def warm_connections(client, n: int = OPENAI_WARM_CONNECTIONS):
+    """
+    Open n connections (DNS, TCP, TLS) with cheap requests; failures are only logged.
+    """
+    if n <= 0:
+        return
+    results = await asyncio.gather(*(client.models.list() for _ in range(n)), return_exceptions=True)
+    failed = [r for r in results if isinstance(r, Exception)]
+    if failed:
+        print(f"⚠️ OpenAI connection warm-up failed: {failed[0]!r}")
+    else:
+        print(f"🔌 Warmed {n} OpenAI connection(s)")
+
+
+async def close_http_client():
+    global _http_client
+    with _http_lock:
+        client, _http_client = _http_client, None
+    if client is not None:
+        await client.aclose()
+
+
+def pool_stats() -> dict:
+    return {"http2": http2_enabled(), "hosts": _transport.stats() if _transport is not None else {}}
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def cancel_on_disconnect(request, awaitable, poll: float = 0.5):
+    """
+    Await `awaitable`, cancelling it (and its in-flight OpenAI request) and raising
+    ClientDisconnected if the client hangs up first. request is the endpoint's starlette
+    Request, or None to just await.
+    """
+    task = asyncio.ensure_future(awaitable)
+    if request is None:
+        return await task
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                print(f"🛑 Client went away, cancelled {request.url.path}")
+                raise ClientDisconnected(request.url.path)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
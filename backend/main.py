@@ -4,34 +4,101 @@ import os
 import io
 import base64
 import re
-from PIL import Image
-from fastapi import FastAPI, File, UploadFile
+import shutil
+import subprocess
+import tempfile
+import textwrap
+import threading
+import time
+import thread_limits  # caps OpenMP/BLAS threads per worker; must come before numpy/faiss load
+from fastapi import FastAPI, File, Form, Header, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 from pydantic import BaseModel
-from typing import List
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from openai import OpenAI
+from typing import List, Literal, Optional, Tuple
 from langchain_core.documents import Document
-import pytesseract
-from pydantic import BaseModel
-from fastapi.responses import JSONResponse
-import ast
-from typing import List, Optional
 from pymongo import MongoClient
-import random
-from pdf2image import convert_from_path
-from classification_utils import _stitch_double_spreads, _to_rgb, generate_unique_question_id, tally_topics
-from db_utils import insert_classified_question
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from pathlib import Path
-from collections import defaultdict
-from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings
-import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from classification_utils import _stitch_double_spreads, _to_rgb, downscale_base64_png, generate_unique_question_id
+from concurrency_utils import SubjectLocks
+from confidence_gate import decide, gate_config, GateStats
+from db_utils import fetch_questions_with_all_topics, insert_classified_question, topic_ids_from_names
+from dedup_utils import dhash_from_base64, image_dhash, image_from_base64, page_change, ExactTextIndex, MinHashLSHIndex, PerceptualHashIndex, PHASH_CONFIRM_MAX_CHANGE
+from embedding_cache import CachedEmbeddings
+from image_store import doc_image_base64, externalize_image, get_image, put_image
+from llm_cache import cache_mode, LLMResponseCache
+from llm_client import cancel_on_disconnect, ClientDisconnected
+from model_routing import escalation_reason, routing_tiers, RoutingStats
+from retrieval_service import RETRIEVAL_ADDRESS, RemoteRetrieval, RetrievalError
+from schemas import GenerateFromTopicsRequest, GenerateFromTopicsResponse
+from prompt_layout import chat_messages, PromptCacheStats, responses_input
+from topic_classifier import classifier_path, TopicClassifier
+from topic_hierarchy import hierarchy_config, pick_modules, TopicHierarchy
+from topic_votes import TOPIC_VOTE_MAX_NEIGHBORS, TopicMatrix
+from vectorstore_persistence import snapshot_lock, WriteBehindPersister
+from ann_index import build_ann, read_ann, resolve_config
+from quantization import resolve_quantization
+from vectorstore_utils import add_documents_streaming, CLASSIFY_ORIGIN, empty_vectorstore, exact_vectors_of, is_mapped, QuestionIndex, load_snapshot, quantize_store, read_manifest, reopen_snapshot, save_snapshot, search_store, store_vectors, sync_vectorstore, SnapshotError, SnapshotMismatchError
+
+# openai / langchain_openai, langchain_community, pdf2image, pytesseract and PIL are imported
+# on first use: together they are most of a cold import (python diagnostics.py imports)
 
 load_dotenv()
-app = FastAPI()
+
+
+async def warm_openai():
+    from llm_client import OPENAI_WARM_CONNECTIONS, warm_connections
+    try:
+        # The SDK imports are slow, so they happen off the event loop, and now rather than on
+        # the first request: the embeddings client too, which is otherwise built on the first cache miss
+        await run_in_threadpool(lambda: embeddings.underlying)
+        if OPENAI_WARM_CONNECTIONS <= 0:
+            return
+        await warm_connections(await run_in_threadpool(openai_client))
+    except Exception as e:
+        print(f"⚠️ OpenAI connection warm-up failed: {e!r}")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global retrieval, _openai_client
+    # TLS handshakes to OpenAI happen now rather than on the first uploads
+    warming = asyncio.create_task(warm_openai())
+
+    # With a retrieval service running (python retrieval_service.py), it holds the stores
+    remote = RemoteRetrieval.connect(RETRIEVAL_ADDRESS) if RETRIEVAL_ADDRESS else None
+    if remote is not None:
+        retrieval = remote
+        yield
+        remote.close()
+        await close_openai(warming)
+        return
+
+    # Stores load in worker threads, so the server accepts connections (and /readyz) right away
+    thread_limits.apply_thread_limits()
+    executor = ThreadPoolExecutor(max_workers=WARMUP_CONCURRENCY, thread_name_prefix="warmup")
+    start_warmup(executor)
+    persister.start()
+    yield
+    executor.shutdown(wait=False, cancel_futures=True)
+    # Final snapshot of anything still only in the WALs
+    persister.stop()
+    await close_openai(warming)
+
+
+async def close_openai(warming):
+    global _openai_client
+    from llm_client import close_http_client
+    warming.cancel()
+    _openai_client = None
+    await close_http_client()
+
+
+app = FastAPI(lifespan=lifespan)
 last_classified_images = []
 
 app.add_middleware(
@@ -69,16 +136,171 @@ SOLUTIONS_VECTORSTORE_ROOT.mkdir(parents=True, exist_ok=True)
 
 VECTORSTORE_ROOT.mkdir(parents=True, exist_ok=True)
 
-embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 1536
+
+# VECTORSTORE_MMAP=1 memory-maps each snapshot read-only instead of loading it, so every
+# uvicorn worker shares one copy through the page cache; each worker keeps only its own
+# changes in memory and merges them into the snapshot on disk at flush time
+MMAP_STORES = os.getenv("VECTORSTORE_MMAP", "0") == "1"
+
+
+def _openai_embeddings():
+    from langchain_openai import OpenAIEmbeddings
+    from llm_client import http_client
+    # aembed_* (request paths) share the worker's pooled async HTTP client with the chat calls;
+    # index builds embed from worker threads on the SDK's own sync client
+    return OpenAIEmbeddings(model=EMBEDDING_MODEL, http_async_client=http_client())
+
+
+# Every embedding (index builds, add_documents, queries) goes through the on-disk cache.
+# The OpenAI client is only created on the first cache miss.
+embeddings = CachedEmbeddings(_openai_embeddings, model=EMBEDDING_MODEL)
 vectorstores = {}  # subject -> FAISS instance
 
-# Helper: check if a FAISS index exists (folder + required files)
+# Per-subject reader/writer locks: searches share, QuestionIndex mutations are exclusive
+subject_locks = SubjectLocks()
+
+# Helper: check if a legacy FAISS.save_local folder exists (index.faiss + index.pkl)
 def _faiss_exists(folder: Path) -> bool:
-    # FAISS saves multiple files; presence of index.faiss + index.pkl is typical.
-    # If you want to be stricter, check for both.
     return (folder / "index.faiss").exists() and (folder / "index.pkl").exists()
 
 
+# Per-store search index (see ann_index.py); "auto" picks flat/IVF/HNSW from the corpus size.
+# Override per store, e.g. VECTORSTORE_INDEX_CONFIG='{"Biology": {"type": "hnsw", "ef_search": 300}}'
+# (solution stores are keyed "solutions:<subject>"). "quantization" compresses the stored
+# vectors, e.g. {"quantization": "pq"} (see quantization.py)
+INDEX_CONFIGS = json.loads(os.getenv("VECTORSTORE_INDEX_CONFIG", "{}"))
+
+
+def index_config(key, n):
+    return resolve_config(INDEX_CONFIGS.get(key, {"type": "auto"}), n)
+
+
+def save_vectorstore(vs, path: Path, ann=None):
+    # Atomic, versioned snapshot (see vectorstore_utils.save_snapshot)
+    save_snapshot(vs, path, EMBEDDING_MODEL, ann)
+
+
+def resave_vectorstore(vs, path: Path, ann=None):
+    """
+    Save a store that will keep being served, then drop the in-memory copies the snapshot
+    now holds (mapping it when MMAP_STORES).
+    """
+    save_vectorstore(vs, path, ann)
+    reopen_snapshot(vs, path, mmap=MMAP_STORES)
+
+
+def prepare_store_index(key, path: Path, vs):
+    """
+    Bring a loaded store's index in line with its config: re-encode it if the quantization
+    changed, and load the ANN index from its snapshot if it was built with the same
+    structure, otherwise train it from the stored vectors. Returns (ann or None, config,
+    changed), where changed means the snapshot needs rewriting.
+    """
+    config = index_config(key, vs.index.ntotal)
+    converted = convert_quantization(key, vs, config)
+    ann = None
+    try:
+        ann = read_ann(path, read_manifest(path), config)
+    except (SnapshotError, OSError, RuntimeError) as e:
+        print(f"Could not load ANN index for {key}: {e}")
+
+    built = False
+    if ann is None and config["type"] != "flat":
+        started = time.perf_counter()
+        ann = build_ann(config, store_vectors(vs))
+        built = ann is not None
+        if built:
+            print(f"Built {config['type']} index for {key} in {time.perf_counter() - started:.1f}s: {config}")
+    return ann, config, built or converted
+
+
+def convert_quantization(key, vs, config) -> bool:
+    started = time.perf_counter()
+    if not quantize_store(vs, resolve_quantization(config, vs.index.d)):
+        return False
+    exact = exact_vectors_of(vs)
+    mode = exact.quant["mode"] if exact is not None else "none"
+    print(f"Re-encoded {key} as {mode} ({vs.index.ntotal} vectors, "
+          f"{vs.index.code_size} bytes each) in {time.perf_counter() - started:.1f}s")
+    return True
+
+
+def image_metadata(image_base64):
+    """
+    Docstore metadata for a question image: its image-store hash and perceptual hash.
+    """
+    metadata = {"image_hash": put_image(image_base64)}
+    try:
+        metadata["phash"] = dhash_from_base64(image_base64)
+    except Exception as e:
+        print(f"Could not hash image: {e}")
+        metadata["phash"] = ""
+    return metadata
+
+def backfill_phashes(vs):
+    """
+    Compute metadata["phash"] for docs stored before perceptual hashing. Each doc is
+    only ever done once (failures are recorded as "").
+    """
+    count = 0
+    for doc_id, doc in list(vs.docstore._dict.items()):
+        if "phash" in doc.metadata or not doc.metadata.get("image_hash"):
+            continue
+        image_base64 = get_image(doc.metadata["image_hash"])
+        try:
+            doc.metadata["phash"] = dhash_from_base64(image_base64) if image_base64 else ""
+        except Exception:
+            doc.metadata["phash"] = ""
+        vs.docstore._dict[doc_id] = doc  # a mapped docstore decodes docs per read
+        count += 1
+    return count
+
+
+def load_vectorstore(path: Path):
+    """
+    Load a store from its snapshot, migrating a legacy save_local folder if that is all
+    we have. Returns None when nothing usable is on disk so only that store is rebuilt.
+    """
+    vs = None
+    try:
+        vs = load_snapshot(path, embeddings, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS, mmap=MMAP_STORES)
+    except SnapshotMismatchError as e:
+        print(f"⚠️ {e} — rebuilding.")
+        return None
+    except SnapshotError as e:
+        print(f"No usable snapshot in {path}: {e}")
+
+    if vs is None and _faiss_exists(path):
+        from langchain_community.vectorstores import FAISS
+
+        vs = FAISS.load_local(
+            str(path),
+            embeddings,
+            allow_dangerous_deserialization=True,
+        )
+        resave_vectorstore(vs, path)
+        print(f"Migrated legacy FAISS folder {path} to snapshot format.")
+
+    # Older stores kept the full PNG in metadata["base64"]; move those into the image store
+    if vs is not None:
+        moved = 0
+        for doc_id, doc in list(vs.docstore._dict.items()):
+            if externalize_image(doc.metadata):
+                vs.docstore._dict[doc_id] = doc
+                moved += 1
+        hashed = backfill_phashes(vs)
+        if moved or hashed:
+            resave_vectorstore(vs, path)
+            print(f"Moved {moved} images from {path} into the image store, hashed {hashed}.")
+        elif MMAP_STORES and not is_mapped(vs):
+            # Version 1 snapshots have no flat docstore to map until they're rewritten
+            resave_vectorstore(vs, path)
+
+    return vs
+
+
 def load_solutions_context_from_mongo():
     solutions_col = db["solutions"]
 
@@ -88,18 +310,15 @@ def load_solutions_context_from_mongo():
     return json.dumps(docs, indent=2)
 
 # SOLUTION VECTOR STORE
-def build_solution_vectorstore(subject):
-
-    path = SOLUTIONS_VECTORSTORE_PATHS[subject]
-
-    solutions = list(db["solutions"].find(
-    {"subject": subject},   # ✅ FILTER
-    {"_id": 0}
-    ))
-
-    docs = []
+def iter_solution_docs(subject):
+    # Stream solutions from a cursor rather than loading the collection up front
+    cursor = db["solutions"].find(
+        {"subject": subject},   # ✅ FILTER
+        {"_id": 0},
+        batch_size=500,
+    )
 
-    for sol in solutions:
+    for sol in cursor:
 
         content = f"""
 Sample Answer:
@@ -112,7 +331,7 @@ Diagram:
 {sol.get("DiagramDescription","")}
 """
 
-        doc = Document(
+        yield Document(
             page_content=content,
             metadata={
                 "question_id": sol["QuestionId"],
@@ -122,38 +341,29 @@ Diagram:
             }
         )
 
-        docs.append(doc)
+def build_solution_vectorstore(subject):
 
-    print(f"Building solutions FAISS for {subject} with {len(docs)} solutions...")
+    path = SOLUTIONS_VECTORSTORE_PATHS[subject]
 
-    vs = FAISS.from_documents(docs, embeddings)
+    print(f"Building solutions FAISS for {subject}...")
 
-    path.mkdir(parents=True, exist_ok=True)
-    vs.save_local(str(path))
+    vs = empty_vectorstore(embeddings, EMBEDDING_DIMENSIONS)
+    added = add_documents_streaming(vs, iter_solution_docs(subject))
 
-    return vs
+    print(f"Built solutions FAISS for {subject} with {added} solutions.")
 
-# Try to load all three first
-all_exist = all(_faiss_exists(p) for p in VECTORSTORE_PATHS.values())
+    resave_vectorstore(vs, path)
 
-if all_exist:
-    for subj, path in VECTORSTORE_PATHS.items():
-        vectorstores[subj] = FAISS.load_local(
-            str(path),
-            embeddings,
-            allow_dangerous_deserialization=True,
-        )
-    print("Loaded all subject-specific vectorstores from disk.")
-else:
-    print("One or more vectorstores missing; rebuilding from MongoDB...")
-
-    questions_col = db["questions"]
-    classification_col = db["classification"]
-    topics_col = db["topics"]
+    return vs
 
+def load_topic_maps():
+    """
+    Returns (TopicId -> {name, subject}, QuestionId -> [TopicId, ...]).
+    Both are small compared to the question bank, so they are kept in memory.
+    """
     # 0) Preload TopicId -> {name, subject}
     topics_by_id = {}
-    for t in topics_col.find({}, {"_id": 0, "TopicId": 1, "name": 1, "subject": 1}):
+    for t in db["topics"].find({}, {"_id": 0, "TopicId": 1, "name": 1, "subject": 1}):
         tid = str(t.get("TopicId"))
         if tid:
             topics_by_id[tid] = {
@@ -171,116 +381,586 @@ else:
         }
     ]
     topic_ids_by_qid = {}
-    for row in classification_col.aggregate(pipeline):
+    for row in db["classification"].aggregate(pipeline):
         qid = str(row["_id"])
         topic_ids_by_qid[qid] = [
             str(tid) for tid in row.get("topic_ids", []) if tid is not None
         ]
 
-    # 2) Build docs per subject
-    docs_by_subject = defaultdict(list)  # subject -> [Document, ...]
-    total_docs = 0
+    return topics_by_id, topic_ids_by_qid
+
+
+def iter_question_docs(subject, topics_by_id, topic_ids_by_qid):
+    """
+    Stream one Document per question of `subject` from a MongoDB cursor.
+    Nothing is embedded here and the question bank is never held in memory at once.
+    Images aren't read either: attach_images fetches them for the docs that get added.
+    """
+    cursor = db["questions"].find(
+        {}, {"_id": 0, "QuestionId": 1, "text": 1}, batch_size=500
+    )
 
-    for q in questions_col.find():
+    for q in cursor:
         if "text" in q and "QuestionId" in q:
             qid = str(q["QuestionId"])
             topic_ids = topic_ids_by_qid.get(qid, [])
 
-            # Resolve TopicIds -> names/subjects
+            # Resolve TopicIds -> names, keeping only questions in this subject
             topic_names = []
-            subjects_for_q = set()
+            in_subject = False
             for tid in topic_ids:
                 meta = topics_by_id.get(tid)
                 if meta:
                     # meta["name"] already includes the human string (e.g. "MA-F1: Working with Functions (Year 11)")
                     topic_names.append(meta["name"])
-                    if meta.get("subject"):
-                        subjects_for_q.add(meta["subject"])
+                    if meta.get("subject") == subject:
+                        in_subject = True
 
-            # If no subjects were resolved, you can choose to skip or bucket elsewhere
-            if not subjects_for_q:
-                # Optional: assign to a default bucket or continue
-                # subjects_for_q.add("Unknown")  # if you want a catch-all
+            if not in_subject:
                 continue
 
-            doc = Document(
-                page_content=q["text"],
-                metadata={
-                    "question_id": qid,
-                    "topics": topic_names,  # human-friendly topic strings
-                    "topic_ids": topic_ids, # raw TopicIds if useful
-                    "base64": q.get("base64", ""),
-                },
-            )
+            metadata = {
+                "question_id": qid,
+                "topics": topic_names,  # human-friendly topic strings
+                "topic_ids": topic_ids, # raw TopicIds if useful
+            }
 
-            # Add the same doc to each subject this question belongs to
-            for subj in subjects_for_q:
-                if subj in VECTORSTORE_PATHS:  # only bucket known subjects
-                    docs_by_subject[subj].append(doc)
-                    total_docs += 1
-
-    # 3) Build & persist FAISS per subject
-    if any(docs_by_subject.values()):
-        for subj, path in VECTORSTORE_PATHS.items():
-            docs = docs_by_subject.get(subj, [])
-            if not docs:
-                print(f"[{subj}] No docs found — creating empty index.")
-                # Create an empty FAISS with a placeholder, then clear it
-                vs = FAISS.from_documents([Document(page_content="placeholder")], embeddings)
-                vs.docstore._dict.clear()
-                vs.index.reset()
-            else:
-                print(f"[{subj}] Building FAISS from {len(docs)} docs...")
-                vs = FAISS.from_documents(docs, embeddings)
+            yield Document(page_content=q["text"], metadata=metadata)
 
-            path.mkdir(parents=True, exist_ok=True)
-            vs.save_local(str(path))
-            vectorstores[subj] = vs
 
-        print(f"Rebuilt {len(vectorstores)} subject-specific vectorstores across {total_docs} docs.")
-    else:
-        print("No questions found with mapped subjects — creating empty indexes.")
-        for subj, path in VECTORSTORE_PATHS.items():
-            vs = FAISS.from_documents([Document(page_content="placeholder")], embeddings)
-            vs.docstore._dict.clear()
-            vs.index.reset()
-            path.mkdir(parents=True, exist_ok=True)
-            vs.save_local(str(path))
-            vectorstores[subj] = vs
+def attach_images(docs):
+    """
+    Fetch the images of a batch of docs from iter_question_docs (one query) and move them
+    into the image store, so only the image's hash goes into the docstore.
+    """
+    qids = [doc.metadata["question_id"] for doc in docs]
+    images = {
+        str(q["QuestionId"]): q.get("base64", "")
+        for q in db["questions"].find({"QuestionId": {"$in": qids}}, {"_id": 0, "QuestionId": 1, "base64": 1})
+    }
+    for doc in docs:
+        doc.metadata["base64"] = images.get(doc.metadata["question_id"], "")
+        externalize_image(doc.metadata)
+
+# ---- Startup: subject stores load in background threads (see lifespan) ----
+
+# VECTORSTORE_SYNC_ON_START=1 also diffs the loaded snapshots against MongoDB
+SYNC_ON_START = os.getenv("VECTORSTORE_SYNC_ON_START", "0") == "1"
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", "4"))
+
+# subject -> normalized OCR text hash -> question_id (exact duplicate check in /classify/)
+text_indexes = {}
+
+# subject -> MinHash/LSH over OCR shingles (re-scans whose OCR differs slightly)
+near_duplicate_indexes = {}
+
+# subject -> dHash multi-index table (repeat uploads, checked before OCR)
+phash_indexes = {}
+
+# subject -> multi-hot question x topic matrix (topic priors for /classify/)
+topic_matrices = {}
+
+# subject -> question_id map over that subject's store; all mutations go through it
+question_indexes = {}
+
+# Subjects classified by a local topic model (topic_classifier.py) instead of GPT, e.g.
+# TOPIC_CLASSIFIER_CONFIG='{"Biology": {"min_confidence": 0.8}}'. Uploads it's less sure
+# about than min_confidence (default 0: none) go on to the confidence gate and GPT.
+TOPIC_CLASSIFIER_CONFIGS = json.loads(os.getenv("TOPIC_CLASSIFIER_CONFIG", "{}"))
+topic_classifiers = {}  # subject -> TopicClassifier
 
 solution_vectorstores = {}
+solution_anns = {}  # subject -> ann_index.AnnIndex, or None for exact search
+
+
+def merge_into_snapshot(subj, path: Path, records):
+    """
+    Apply one worker's WAL records to the snapshot now on disk, which other workers may have
+    written since this one loaded it, and save the result (MMAP_STORES flushes). Returns
+    the generation of the snapshot merged onto.
+    """
+    vs = load_snapshot(path, embeddings, EMBEDDING_MODEL, mmap=True, verify=False)
+    merged_onto = vs.generation
+    ann, ann_config, _ = prepare_store_index(subj, path, vs)
+    qindex = QuestionIndex(vs, ann_config=ann_config, ann=ann)
+    for record in records:
+        qindex.apply(record)
+    save_vectorstore(vs, path, qindex.ann)
+    return merged_onto
+
+
+def save_topic_classifier(subj):
+    # After each snapshot of the subject (and on shutdown): its topic model, if corrections changed it
+    classifier = topic_classifiers.get(subj)
+    if classifier is not None and classifier.unsaved:
+        classifier.save(classifier_path(VECTORSTORE_PATHS[subj]))
+
+
+# Mutations are appended to a per-subject, per-worker WAL; snapshots are written in the background
+if MMAP_STORES:
+    persister = WriteBehindPersister(
+        save_vectorstore, locks=subject_locks, merge_fn=merge_into_snapshot,
+        rebase_fn=lambda vs, path: reopen_snapshot(vs, path, mmap=True),
+        extras_fn=save_topic_classifier,
+    )
+else:
+    persister = WriteBehindPersister(save_vectorstore, locks=subject_locks, extras_fn=save_topic_classifier)
+wals = {}
+
+# "Biology" / "solutions:Biology" -> {"state": pending|loading|ready|failed, "seconds", "vectors", "error"}
+warmup_status = {}
+STARTED_AT = time.time()
+
+_topic_maps = None
+_topic_maps_lock = threading.Lock()
+
+
+def shared_topic_maps():
+    # Subjects warming up in parallel share one read of the topic/classification collections
+    global _topic_maps
+    with _topic_maps_lock:
+        if _topic_maps is None:
+            _topic_maps = load_topic_maps()
+        return _topic_maps
+
+
+def warm_question_store(subj):
+    """
+    Load one subject's snapshot, replay the WALs of workers that are gone, sync it from
+    MongoDB if needed and publish it. Returns the number of vectors.
+    """
+    path = VECTORSTORE_PATHS[subj]
+    # Other workers may be starting up (or flushing) on the same snapshot
+    with snapshot_lock(path):
+        vs, qindex, wal, indexes = load_question_store(subj, path)
+
+    text_indexes[subj], near_duplicate_indexes[subj], phash_indexes[subj], topic_matrices[subj] = indexes
+    question_indexes[subj] = qindex
+    wals[subj] = wal
+    vectorstores[subj] = vs
+    if subj in TOPIC_CLASSIFIER_CONFIGS:
+        topic_classifiers[subj] = load_topic_classifier(subj, path, qindex)
+    return vs.index.ntotal
 
-for subj in SOLUTIONS_VECTORSTORE_PATHS:
+
+def load_topic_classifier(subj, path: Path, qindex):
+    """
+    The subject's saved topic model, or one trained on its stored vectors and the
+    classification collection (and saved) if there's none for this embedding model.
+    """
+    saved = classifier_path(path)
+    classifier = TopicClassifier.load(saved, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+    if classifier is not None:
+        print(f"[{subj}] Topic model loaded: {len(classifier.topics)} topics, {classifier.updates} correction batches")
+        return classifier
+
+    topics_by_id, topic_ids_by_qid = shared_topic_maps()
+    labels = {}
+    for qid, tids in topic_ids_by_qid.items():
+        names = [topics_by_id[t]["name"] for t in tids if topics_by_id.get(t, {}).get("subject") == subj]
+        if names:
+            labels[qid] = names
+    with subject_locks.read(subj):
+        qids, vectors = qindex.vectors(labels)
+    started = time.perf_counter()
+    classifier = TopicClassifier(EMBEDDING_DIMENSIONS, EMBEDDING_MODEL)
+    classifier.fit(vectors, [labels[q] for q in qids])
+    classifier.save(saved)
+    print(f"[{subj}] Topic model trained on {len(qids)} questions, {len(classifier.topics)} topics "
+          f"in {time.perf_counter() - started:.1f}s")
+    return classifier
+
+
+def load_question_store(subj, path: Path):
+    """
+    (store, QuestionIndex, this worker's WAL, (text, near-duplicate, phash indexes, topic
+    matrix)) for a subject, with its snapshot brought up to date. Call under snapshot_lock.
+    """
+    vs = load_vectorstore(path)
+    missing = vs is None
+    if missing:
+        # Nothing usable on disk: start empty and fill from MongoDB below
+        vs = empty_vectorstore(embeddings, EMBEDDING_DIMENSIONS)
+
+    if missing:
+        ann, ann_config, dirty = None, index_config(subj, 0), True
+    else:
+        ann, ann_config, dirty = prepare_store_index(subj, path, vs)
+    text_index, near_index, phash_index = ExactTextIndex(), MinHashLSHIndex(), PerceptualHashIndex()
+    topic_matrix = TopicMatrix()
+    qindex = QuestionIndex(
+        vs, observers=[text_index, near_index, phash_index, topic_matrix], ann_config=ann_config, ann=ann,
+    )
+
+    wal = persister.register(subj, qindex, path)
+    if missing:
+        # No snapshot to replay onto (or one from another model); MongoDB is rebuilt from instead
+        persister.discard_orphans(subj)
+    else:
+        replayed = persister.replay(subj)
+        if replayed:
+            print(f"[{subj}] Replayed {replayed} WAL records on top of the snapshot.")
+
+    if missing or SYNC_ON_START:
+        topics_by_id, topic_ids_by_qid = shared_topic_maps()
+        # Only new/changed questions get embedded; a missing store is synced from empty
+        with subject_locks.write(subj):
+            stats = sync_vectorstore(vs, iter_question_docs(subj, topics_by_id, topic_ids_by_qid), prepare=attach_images)
+            hashed = backfill_phashes(vs)
+            # The corpus size may have changed which index type "auto" picks, or let PQ train
+            ann_config = index_config(subj, vs.index.ntotal)
+            converted = convert_quantization(subj, vs, ann_config)
+            retrain = any(stats.values()) or ann_config != qindex.ann_config
+            qindex.ann_config = ann_config
+            qindex.rebuild(ann=retrain)
+        print(f"[{subj}] Synced: {stats}")
+        print(f"Embedding cache: {embeddings.stats()}")
+        dirty = dirty or any(stats.values()) or hashed or converted
+
+    # Start from a clean snapshot + empty WAL
+    if dirty or persister.has_orphans(subj):
+        resave_vectorstore(vs, path, qindex.ann)
+        persister.discard_orphans(subj)
+    return vs, qindex, wal, (text_index, near_index, phash_index, topic_matrix)
+
+
+def warm_solution_store(subj):
     path = SOLUTIONS_VECTORSTORE_PATHS[subj]
+    with snapshot_lock(path):
+        vs = load_vectorstore(path)
+        if vs is None:
+            vs = build_solution_vectorstore(subj)
+        ann, _, changed = prepare_store_index(f"solutions:{subj}", path, vs)
+        if changed:
+            resave_vectorstore(vs, path, ann)
+    solution_anns[subj] = ann
+    solution_vectorstores[subj] = vs
+    return vs.index.ntotal
+
+
+def _warm(key, load_fn, subj):
+    status = warmup_status[key]
+    status["state"] = "loading"
+    started = time.perf_counter()
+    try:
+        vectors = load_fn(subj)
+    except Exception as e:
+        status.update(state="failed", error=str(e), seconds=round(time.perf_counter() - started, 3))
+        print(f"❌ Warmup of {key} failed: {e}")
+        return
+    status.update(state="ready", vectors=vectors, seconds=round(time.perf_counter() - started, 3))
+    print(f"✅ {key} ready ({vectors} vectors in {status['seconds']}s)")
 
-    if (path / "index.faiss").exists():
 
-        solution_vectorstores[subj] = FAISS.load_local(
-            str(path),
-            embeddings,
-            allow_dangerous_deserialization=True,
+def start_warmup(executor):
+    """
+    Queue every question and solution store on `executor`. Returns the futures.
+    """
+    jobs = [(subj, warm_question_store, subj) for subj in VECTORSTORE_PATHS]
+    jobs += [(f"solutions:{subj}", warm_solution_store, subj) for subj in SOLUTIONS_VECTORSTORE_PATHS]
+    for key, _, _ in jobs:
+        warmup_status[key] = {"state": "pending"}
+    return [executor.submit(_warm, *job) for job in jobs]
+
+
+def warm_up():
+    """
+    Load everything and wait for it (for scripts; the server warms up in the background).
+    """
+    with ThreadPoolExecutor(max_workers=WARMUP_CONCURRENCY) as executor:
+        start_warmup(executor)
+
+
+def require_ready(key):
+    """
+    Fast 400/503 for endpoints whose subject store is unknown or still loading. Blocking
+    (a socket call with a RemoteRetrieval), so handlers run it in the threadpool.
+    """
+    status = retrieval.status().get(key)
+    if status is None:
+        raise HTTPException(status_code=400, detail=f"No vectorstore found for subject '{key}'")
+    if status["state"] != "ready":
+        raise HTTPException(
+            status_code=503,
+            detail=f"Vectorstore for '{key}' is {status['state']}, try again shortly.",
+            headers={"Retry-After": "5"},
         )
 
-        print(f"Loaded solution vectorstore for {subj}")
 
-    else:
+@app.get("/healthz")
+async def healthz():
+    # Liveness only: the process is up and serving
+    return {"status": "ok", "uptime_seconds": round(time.time() - STARTED_AT, 3)}
 
-        solution_vectorstores[subj] = build_solution_vectorstore(subj)
 
-client = OpenAI()
+@app.get("/readyz")
+async def readyz():
+    status = await run_in_threadpool(retrieval.status)
+    ready = bool(status) and all(s["state"] == "ready" for s in status.values())
+    return JSONResponse(
+        {"ready": ready, "subjects": status},
+        status_code=200 if ready else 503,
+    )
 
 
-# NOTE: This is the new function that extracts images from files without any cropping logic
-def extract_image_from_file(file_path, vs):
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected(request, exc):
+    # Nobody is listening; the status only shows up in the access log
+    return JSONResponse({"detail": "Client closed request"}, status_code=499)
+
+
+@app.exception_handler(RetrievalError)
+async def retrieval_unavailable(request, exc):
+    # The retrieval service went away after startup: callers retry like a cold start
+    print(f"❌ Retrieval service error: {exc}")
+    return JSONResponse(
+        {"detail": f"Retrieval service unavailable: {exc}"},
+        status_code=503,
+        headers={"Retry-After": "5"},
+    )
+
+_openai_client = None
+
+
+def openai_client():
+    """
+    Shared AsyncOpenAI client on the worker's pooled HTTP client (see llm_client.py),
+    created on first use.
+    """
+    global _openai_client
+    if _openai_client is None:
+        from openai import AsyncOpenAI
+        from llm_client import http_client
+        _openai_client = AsyncOpenAI(http_client=http_client())
+    return _openai_client
+
+
+def stored_topic_names(subject, question_id):
+    """
+    Human-readable topics for a known question: MongoDB first, then the vectorstore
+    metadata for questions that were classified but never corrected. Blocking, so
+    handlers run it in the threadpool.
+    """
+    # Fetch topics from MongoDB
+    topic_links = list(db["classification"].find({"QuestionId": question_id}, {"_id": 0, "TopicId": 1}))
+    topic_ids = [t["TopicId"] for t in topic_links]
+
+    if topic_ids:
+        # Map topic IDs to human-readable names
+        topic_lookup = {
+            t["TopicId"]: t["name"]
+            for t in db["topics"].find({"TopicId": {"$in": topic_ids}}, {"_id": 0, "TopicId": 1, "name": 1})
+        }
+        return [topic_lookup.get(tid, tid) for tid in topic_ids]
+
+    doc = retrieval.get(subject, question_id)
+    return list(doc.metadata.get("topics", [])) if doc is not None else []
+
+
+def subject_topics(subject):
+    """
+    The subject's topics from MongoDB, sorted so the prompt's catalogue is byte-identical.
+    Blocking, so handlers run it in the threadpool.
+    """
+    return list(
+        db["topics"].find(
+            {"subject": subject},
+            {"_id": 0, "TopicId": 1, "name": 1}
+        ).sort("TopicId", 1)
+    )
+
+
+def _copy(doc):
+    # Callers use docs after the read lock is released, while corrections may rewrite them
+    return Document(page_content=doc.page_content, metadata=dict(doc.metadata))
+
+
+class LocalRetrieval:
+    """
+    The question and solution stores loaded in this process, behind the same methods
+    retrieval_service.RemoteRetrieval forwards to a retrieval service. Queries and new
+    texts come in already embedded; each method takes the subject lock it needs.
+    """
+
+    def status(self):
+        return warmup_status
+
+    def search(self, key, vectors, k):
+        """
+        [(Document, distance)] for each query vector. key is a subject or "solutions:<subject>".
+        """
+        if key.startswith("solutions:"):
+            subj = key.split(":", 1)[1]
+            vs, ann = solution_vectorstores[subj], solution_anns.get(subj)
+            with subject_locks.read(key):
+                return [search_store(vs, vector, k, ann) for vector in vectors]
+        with subject_locks.read(key):
+            return [question_indexes[key].search(vector, k) for vector in vectors]
+
+    def topic_votes(self, subject, vectors):
+        """
+        Topic votes of each query vector's nearest questions (see topic_votes.TopicMatrix.vote).
+        """
+        with subject_locks.read(subject):
+            qindex, matrix = question_indexes[subject], topic_matrices[subject]
+            return [matrix.vote(qindex.search(vector, TOPIC_VOTE_MAX_NEIGHBORS)) for vector in vectors]
+
+    def predict_topics(self, subject, vectors):
+        """
+        (topics, confidence) from the subject's topic model for each query vector, or None
+        if the subject has none.
+        """
+        classifier = topic_classifiers.get(subject)
+        if classifier is None:
+            return None
+        return [classifier.predict(vector) for vector in vectors]
+
+    def get(self, subject, question_id):
+        with subject_locks.read(subject):
+            doc = question_indexes[subject].get(question_id)
+            return _copy(doc) if doc is not None else None
+
+    def known_ids(self, subject):
+        # Live view: `in` is a dict lookup, no copy of every id
+        return question_indexes[subject].question_ids()
+
+    def lookup_text(self, subject, text):
+        with subject_locks.read(subject):
+            return text_indexes[subject].lookup(text)
+
+    def near_duplicate(self, subject, text):
+        with subject_locks.read(subject):
+            return near_duplicate_indexes[subject].query(text)
+
+    def repeat_upload(self, subject, phash):
+        """
+        [(question_id, dHash distance, Document)] of stored pages whose dHash is close, nearest
+        first. Only candidates: confirm_repeat checks each against its stored image.
+        """
+        with subject_locks.read(subject):
+            return [
+                (qid, distance, _copy(question_indexes[subject].get(qid)))
+                for qid, distance in phash_indexes[subject].matches(phash)
+            ]
+
+    def add(self, subject, docs, vectors):
+        embedded = dict(zip([d.page_content for d in docs], vectors))
+        with persister.writing(subject) as qindex:
+            return qindex.add(docs, embedded)
+
+    def upsert(self, subject, entries, embedded):
+        classifier = topic_classifiers.get(subject)
+        with persister.writing(subject) as qindex:
+            stats = qindex.upsert_many(entries, embedded)
+            if classifier is not None:
+                # Corrections are labelled examples: nudge the topic model towards them, in step
+                # with the store. The snapshot writer saves it (save_topic_classifier)
+                labels = {str(qid): metadata["topics"] for qid, _, metadata in entries if (metadata or {}).get("topics")}
+                qids, vectors = qindex.vectors(labels)
+                classifier.partial_fit(vectors, [labels[q] for q in qids])
+        return stats
+
+    def delete(self, subject, question_ids):
+        with persister.writing(subject) as qindex:
+            return sum(qindex.delete(qid) for qid in question_ids)
+
+
+# Replaced by a RemoteRetrieval in lifespan when RETRIEVAL_ADDRESS points at a running service
+retrieval = LocalRetrieval()
+
+
+def local_topics(subject, vector):
+    """
+    (topics, vote) for a new question's embedding. topics comes from the subject's topic model
+    or the neighbours' consensus when either is sure enough to skip GPT, else None; vote is the
+    nearest questions' topic vote (see topic_votes.TopicMatrix.vote), None if not needed.
+    """
+    predicted = retrieval.predict_topics(subject, [vector]) if subject in TOPIC_CLASSIFIER_CONFIGS else None
+    if predicted is not None:
+        topics, confidence = predicted[0]
+        if topics and confidence >= TOPIC_CLASSIFIER_CONFIGS[subject].get("min_confidence", 0.0):
+            print(f"🧮 Topic model: {topics} (confidence {confidence:.2f})")
+            gate_stats.record(subject, "model")
+            return topics, None
+
+    # Similarity-weighted topic votes of the closest stored questions
+    vote = retrieval.topic_votes(subject, [vector])[0]
+    print(f"🔎 {vote['voters']} similar questions voted for {len(vote['topics'])} topics")
+
+    # Neighbours that clearly agree on a topic set answer without GPT
+    gated = decide(vote, gate_config(subject))
+    if gated is not None:
+        print(f"⚡ Skipping GPT: {vote['agreement']:.0%} of votes for {gated} (margin {vote['margin']:.2f})")
+        gate_stats.record(subject, "neighbours")
+        return gated, vote
+    gate_stats.record(subject, "gpt")
+    return None, vote
+
+
+async def add_questions(subject, docs):
+    # Embed first, so nothing is embedded under the write lock (or by the retrieval service)
+    vectors = await embeddings.aembed_documents([d.page_content for d in docs])
+    return await run_in_threadpool(retrieval.add, subject, docs, vectors)
+
+
+async def upsert_questions(subject, entries):
+    texts = [text for _, text, _ in entries if text]
+    vectors = await embeddings.aembed_documents(texts) if texts else []
+    return await run_in_threadpool(retrieval.upsert, subject, entries, dict(zip(texts, vectors)))
+
+
+# Low-res render used only for the perceptual hash; a hit skips the 200 dpi render + OCR
+PHASH_PREVIEW_DPI = 30
+
+
+def confirm_repeat(subject, preview, phash):
+    """
+    (question_id, dHash distance, Document, image base64) of an earlier upload of the page in
+    `preview`, or None. The dHash only shortlists stored pages; each one is compared with the
+    preview (dedup_utils.page_change) before its answer is reused.
+    """
+    for question_id, distance, doc in retrieval.repeat_upload(subject, phash):
+        image_base64 = doc_image_base64(doc)
+        if not image_base64:
+            continue
+        change = page_change(preview, image_from_base64(image_base64))
+        if change <= PHASH_CONFIRM_MAX_CHANGE:
+            return question_id, distance, doc, image_base64
+        print(f"🔍 dHash candidate {question_id} (distance {distance}) is another page ({change:.0%} of ink differs)")
+    return None
+
+
+def find_duplicate(subject, text):
+    """
+    (question_id, Jaccard similarity) of a stored question with this OCR text, or None.
+    similarity is None for an exact match (normalized text hash), else a near-duplicate's.
+    Both lookups take the subject's read lock, so callers run this in the threadpool.
+    """
+    question_id = retrieval.lookup_text(subject, text)
+    if question_id is not None:
+        return question_id, None
+    return retrieval.near_duplicate(subject, text)
+
+def render_page_image(file_path, dpi=200):
     if file_path.lower().endswith(".pdf"):
+        from pdf2image import convert_from_path
+
         # You can tweak dpi if needed (higher = bigger/clearer, but heavier)
-        pages = convert_from_path(file_path, dpi=200)
+        pages = convert_from_path(file_path, dpi=dpi)
         if len(pages) == 0:
             raise ValueError("PDF has no pages.")
-        image = pages[0] if len(pages) == 1 else _stitch_double_spreads(pages, gap=32, bg_color="white")
+        # Keep the gap proportional so previews stitch the same way as the full render
+        gap = max(1, round(32 * dpi / 200))
+        image = pages[0] if len(pages) == 1 else _stitch_double_spreads(pages, gap=gap, bg_color="white")
     else:
+        from PIL import Image
         image = Image.open(file_path)
         image = _to_rgb(image)
+    return image
+
+# NOTE: This is the new function that extracts images from files without any cropping logic
+def extract_image_from_file(file_path, existing_ids):
+    image = render_page_image(file_path)
 
     # Convert to base64 (PNG)
     buffered = io.BytesIO()
@@ -288,10 +968,11 @@ def extract_image_from_file(file_path, vs):
     img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
 
     # OCR (run on the stitched image)
+    import pytesseract
+
     text = pytesseract.image_to_string(image)
 
-    # Generate unique ID
-    existing_ids = {doc.metadata.get("question_id") for doc in vs.docstore._dict.values()}
+    # Generate unique ID (existing_ids is a live set-like view, so this is O(1))
     qid = generate_unique_question_id(existing_ids)
 
     return [{
@@ -301,86 +982,71 @@ def extract_image_from_file(file_path, vs):
         "topics": []
     }]
 
-def parse_topic_counts(s: str):
+# Classify an image 
+CLASSIFY_RULES = """Classify the HSC exam question you are given into syllabus topics.
+- Pick only from the allowed topics below (no new ones), using their exact names.
+- Base your judgment on the question meaning first.
+- You are also given how strongly the most similar stored questions vote for each topic; use those votes to break ties."""
+
+CLASSIFY_CONFIDENCE_RULE = "- Also give your confidence (0 to 1) that the chosen topics are right."
+
+
+async def classify_image_with_gpt(subject: str, base64_img: str, catalogue, topic_votes, model: str = "gpt-4o",
+                            text: str = None, ask_confidence: bool = False, temperature: float = 0.3):
     """
-    Parses a string like:
-    'BIO-M5.4: Genetic Variation (Year 12): 8, BIO-M6.1: Mutation (Year 12): 8, ...'
-    into a dictionary:
-    {
-        'BIO-M5.4: Genetic Variation (Year 12)': 8,
-        'BIO-M6.1: Mutation (Year 12)': 8,
-        ...
-    }
+    catalogue: the topic names GPT may choose from, in a fixed order (the subject's topics, or
+    its chosen modules' topics, see narrow_to_modules); topic_votes: [(topic, votes)] best first,
+    from local_topics. Without an image the question's OCR `text` is classified instead.
+    ask_confidence also asks for a 0-1 "confidence" in the answer (see classify_with_routing).
     """
-    counts = {}
-    for part in s.split(","):
-        part = part.strip()
-        match = re.search(r":\s*(\d+)$", part)
-        if not match:
-            continue
-        count = int(match.group(1))
-        name = part[:match.start()].strip()
-        counts[name] = count
-    return counts
-# Classify an image 
-def classify_image_with_gpt(base64_img: str, topics_text: str, corrections_context: str):
-    image_bytes = base64.b64decode(base64_img)
-    print("CONTEXT",corrections_context)
-    
-    freq_counter = tally_topics(corrections_context)
-    topic_counts_str = ", ".join([f"{topic}: {count}" for topic, count in freq_counter.most_common()])
+    topic_counts_str = ", ".join(f"{topic}: {votes:.1f}" for topic, votes in topic_votes)
     print("Topic counts:", topic_counts_str)
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
+    properties = {
+        "topics": {
+            "type": "array",
+            "items": {"type": "string", "enum": list(catalogue)} if catalogue else {"type": "string"},
+            "minItems": 1
+        }
+    }
+    if ask_confidence:
+        properties["confidence"] = {"type": "number", "minimum": 0, "maximum": 1}
+
+    # Same system text, rules and catalogue for every upload of a subject, so the prefix is cached
+    rules = CLASSIFY_RULES + ("\n" + CLASSIFY_CONFIDENCE_RULE if ask_confidence else "")
+    catalogue_text = "📋 Allowed topics:\n" + "\n".join(f"* {topic}" for topic in catalogue)
+    variable = [f"Similar questions' topic votes: {topic_counts_str or '(none)'}"]
+    if base64_img is None:
+        variable.append(f"Question (OCR text):\n{text}")
+
+    started = time.perf_counter()
+    response = await openai_client().chat.completions.create(
+        model=model,
         response_format={
             "type": "json_schema",
             "json_schema": {
                 "name": "topic_choice",
                 "schema": {
                     "type": "object",
-                    "properties": {
-                        "topics": {
-                            "type": "array",
-                            "items": {
-                                "type": "string",
-                                "enum": list(parse_topic_counts(topic_counts_str).keys())
-                            },
-                            "minItems": 1
-                        }
-                    },
-                    "required": ["topics"],
+                    "properties": properties,
+                    "required": list(properties),
                     "additionalProperties": False
                 },
             },
         },
-        messages=[
-            {"role": "system", "content": "You are an expert HSC Biology teacher."},
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"""
-    {topic_counts_str}
-
-    Classify this question using your reasoning **and** the topic rankings.
-    - You must pick from the above topics only (no new ones).
-    - Base your judgment on the question meaning first, then use the counts to break ties.
-
-    📋 Allowed topics:
-    {topic_counts_str}
-    """
-                    },
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64_img}" }},
-                ],
-            },
-        ],
-        temperature=0.3,
+        messages=chat_messages(
+            f"You are an expert HSC {subject} teacher.", [rules, catalogue_text], variable, base64_img,
+        ),
+        temperature=temperature,
     )
+    prompt_cache_stats.record(f"classify:{model}", response, time.perf_counter() - started)
 
     content = response.choices[0].message.content
-    print("🧠 GPT Response:\n", content)
+    print(f"🧠 {model} response:\n", content)
+    try:
+        return json.loads(content)
+    except ValueError:
+        pass
     try:
         match = re.search(r"{\s*\"topics\".*}", content, re.DOTALL)
         return json.loads(match.group(0)) if match else {"topics": []}
@@ -389,102 +1055,262 @@ def classify_image_with_gpt(base64_img: str, topics_text: str, corrections_conte
         return {"topics": []}
 
 
+routing_stats = RoutingStats()
+prompt_cache_stats = PromptCacheStats()
+llm_cache = LLMResponseCache()
+
+
+async def cached_llm_call(endpoint, api, output, mode="use", **request):
+    """
+    Output text of await api(**request) (e.g. openai_client().responses.create; output turns
+    the response into text), answered from llm_cache if the endpoint opts in (see llm_cache.py).
+    mode is cache_mode() of the request's Cache-Control header.
+    """
+    return await llm_cache.call(
+        endpoint, api, output, mode,
+        on_response=lambda response, seconds: prompt_cache_stats.record(endpoint, response, seconds),
+        **request,
+    )
+
+
+async def classify_with_routing(subject, base64_img, text, catalogue, topic_votes):
+    """
+    Ask the subject's routing tiers in turn (see model_routing.py) until one gives an answer
+    worth keeping; the last tier's answer is always kept.
+    """
+    tiers = routing_tiers(subject)
+    for i, tier in enumerate(tiers):
+        last = i == len(tiers) - 1
+        if tier["input"] == "text":
+            image = None
+        elif tier["max_side"]:
+            image = await run_in_threadpool(downscale_base64_png, base64_img, tier["max_side"])
+        else:
+            image = base64_img
+        started = time.perf_counter()
+        result = await classify_image_with_gpt(
+            subject, image, catalogue, topic_votes, model=tier["model"], text=text,
+            ask_confidence=not last, temperature=tier["temperature"],
+        )
+        reason = None if last else escalation_reason(result, tier, topic_votes)
+        routing_stats.record(subject, tier["name"], time.perf_counter() - started, kept=reason is None)
+        if reason is None:
+            return result
+        print(f"⤴️ {tier['name']} answer escalated ({reason})")
+
+
+async def pick_modules_with_gpt(text, hierarchy, config):
+    """
+    Stage one when the neighbours can't say: a short text-only prompt for the question's
+    module(s), listing modules rather than topics.
+    """
+    module_ids = sorted(hierarchy.modules)
+    modules_text = "\n".join(f"* {m}: {hierarchy.modules[m]['name']}" for m in module_ids)
+    started = time.perf_counter()
+    response = await openai_client().chat.completions.create(
+        model=config["model"],
+        response_format={
+            "type": "json_schema",
+            "json_schema": {
+                "name": "module_choice",
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "modules": {
+                            "type": "array",
+                            "items": {"type": "string", "enum": module_ids},
+                            "minItems": 1,
+                        }
+                    },
+                    "required": ["modules"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        messages=chat_messages(
+            "You sort HSC exam questions into syllabus modules.",
+            [f"Modules:\n{modules_text}", f"Pick the module(s) the question belongs to, at most {config['max_modules']}."],
+            [f"Question (OCR text):\n{text}"],
+        ),
+        temperature=0,
+    )
+    prompt_cache_stats.record(f"modules:{config['model']}", response, time.perf_counter() - started)
+    # content is None when the model refuses
+    try:
+        picked = json.loads(response.choices[0].message.content or "{}").get("modules", [])
+    except ValueError:
+        picked = []
+    return [m for m in picked if m in hierarchy.modules][:config["max_modules"]]
+
+
+async def narrow_to_modules(subject, text, topic_docs, topic_votes):
+    """
+    (catalogue, topic_votes): the topic names GPT may choose from and the neighbours' votes for
+    them. Normally every topic of the subject; for two-stage classification (see
+    topic_hierarchy.py) only the topics of the question's module(s).
+    """
+    catalogue = [t["name"] for t in topic_docs] or [topic for topic, _ in topic_votes]
+    config = hierarchy_config(subject)
+    if config is None:
+        return catalogue, topic_votes
+    hierarchy = TopicHierarchy(topic_docs)
+
+    modules = []
+    if config["first_stage"] == "votes":
+        modules = pick_modules(hierarchy.module_votes(topic_votes), config)
+    if not modules:
+        started = time.perf_counter()
+        modules = await pick_modules_with_gpt(text, hierarchy, config)
+        routing_stats.record(subject, f"modules:{config['model']}", time.perf_counter() - started, kept=bool(modules))
+    if not modules:
+        return catalogue, topic_votes
+
+    narrowed = hierarchy.topics_of(modules)
+    ids = set(topic_ids_from_names(narrowed))
+    topic_votes = [(topic, votes) for topic, votes in topic_votes if topic_ids_from_names([topic])[0] in ids]
+    print(f"🗂️ Modules {modules}: {len(narrowed)} of {len(catalogue)} topics")
+    return narrowed, topic_votes
+
+
+@app.get("/metrics/locks")
+async def lock_metrics():
+    """
+    Per-subject reader/writer lock counters: acquisitions, how many had to wait, and wait times.
+    """
+    return subject_locks.stats()
+
+
+@app.get("/metrics/routing")
+async def routing_metrics():
+    """
+    Per-subject, per-model-tier calls, share of answers kept (not escalated) and latency.
+    """
+    return routing_stats.stats()
+
+
+@app.get("/metrics/llm-cache")
+def llm_cache_metrics():
+    """
+    Per-endpoint hits, misses and entries of the LLM response cache.
+    """
+    return llm_cache.stats()
+
+
+@app.get("/metrics/openai")
+async def openai_metrics():
+    """
+    Per-host OpenAI requests made, in flight, waiting for a slot and the most ever in flight.
+    """
+    from llm_client import pool_stats
+    return pool_stats()
+
+
+@app.get("/metrics/prompt-cache")
+async def prompt_cache_metrics():
+    """
+    Per-endpoint (and model) LLM calls, prompt tokens and the share served from the provider's
+    prompt cache, and mean latency.
+    """
+    return prompt_cache_stats.stats()
+
+
+gate_stats = GateStats()
+
+
+@app.get("/metrics/classify")
+async def classify_metrics():
+    """
+    Per-subject uploads classified by the topic model, by their neighbours alone or by GPT,
+    and the share that skipped GPT.
+    """
+    return gate_stats.stats()
+
+
 @app.post("/classify/")
-async def classify(file: UploadFile = File(...),  subject: str = Form(...)):
+async def classify(request: Request, file: UploadFile = File(...),  subject: str = Form(...)):
     global last_classified_images
     file_path = f"temp_{file.filename}"
     print(subject)
-    vs = vectorstores[subject] 
     
     if subject is None or subject.strip() == "":
         raise HTTPException(status_code=400, detail="Missing 'subject' field in form data.")
+    await run_in_threadpool(require_ready, subject)
     
     with open(file_path, "wb") as f:
         f.write(await file.read())
 
     try:
-        
+
+        # Repeat upload? A cheap preview whose dHash matches a stored page, and that still
+        # looks like that page side by side, skips OCR, embedding and GPT entirely
+        # Rendering and OCR run in the threadpool so they don't hold up the event loop
+        preview = await run_in_threadpool(render_page_image, file_path, PHASH_PREVIEW_DPI)
+        phash = image_dhash(preview)
+        repeat = await run_in_threadpool(confirm_repeat, subject, preview, phash)
+        if repeat is not None:
+            reused_id, distance, doc, repeat_image = repeat
+            repeat_text = doc.page_content
+            print(f"🔁 Reusing existing ID {reused_id} for repeat upload (dHash distance {distance})")
+            images = [{
+                "id": reused_id,
+                "base64": repeat_image,
+                "text": repeat_text,
+                "topics": await run_in_threadpool(stored_topic_names, subject, reused_id),
+            }]
+            last_classified_images = images
+            return {"result": images}
+
         # Query MongoDB for topics matching subject
-        topic_docs = list(
-            db["topics"].find(
-                {"subject": subject},
-                {"_id": 0, "TopicId": 1, "name": 1}
-            ).sort("TopicId", 1)
-        )
+        topic_docs = await run_in_threadpool(subject_topics, subject)
 
-        # Format bullet list (but don’t return it)
-        bullets = [
-            f"* {t['TopicId']}: {t['name'].split(': ', 1)[1]}"
-            if t["name"].startswith(t["TopicId"])
-            else f"* {t['name']}"
-            for t in topic_docs
-        ]
-        bullets_markdown = "\n".join(bullets)
-        
-        images = extract_image_from_file(file_path, vs)
+        known_ids = await run_in_threadpool(retrieval.known_ids, subject)
+        images = await run_in_threadpool(extract_image_from_file, file_path, known_ids)
 
         new_docs = []
         for img in images:
 
-            # Check if this exact question already exists 
-            duplicate_found = False
-            for doc in vs.docstore._dict.values():
-               if doc.page_content.strip() == img["text"].strip():
-                    reused_id = doc.metadata.get("question_id")
+            # Check if this exact question already exists (normalized OCR text hash, O(1)),
+            # or is the same question from a different scan: OCR differs slightly but shingles mostly agree
+            duplicate = await run_in_threadpool(find_duplicate, subject, img["text"])
+            if duplicate is not None:
+                reused_id, similarity = duplicate
+                if similarity is None:
                     print(f"🔁 Reusing existing ID {reused_id} for duplicate")
-
-                    # Fetch topics from MongoDB
-                    topic_links = list(db["classification"].find({"QuestionId": reused_id}, {"_id": 0, "TopicId": 1}))
-                    topic_ids = [t["TopicId"] for t in topic_links]
-
-                    # Map topic IDs to human-readable names
-                    topic_lookup = {
-                        t["TopicId"]: t["name"]
-                        for t in db["topics"].find({"TopicId": {"$in": topic_ids}}, {"_id": 0, "TopicId": 1, "name": 1})
-                    }
-                    full_topic_names = [topic_lookup.get(tid, tid) for tid in topic_ids]
-
-                    img["id"] = reused_id
-                    img["topics"] = full_topic_names
-                    duplicate_found = True
-                    break
-
-
-            if duplicate_found:
+                else:
+                    print(f"🔁 Reusing existing ID {reused_id} for near-duplicate (Jaccard ≈ {similarity:.2f})")
+                img["id"] = reused_id
+                img["topics"] = await run_in_threadpool(stored_topic_names, subject, reused_id)
                 continue  #  Skip GPT and go to next image
             
-            retriever = vs.as_retriever(search_kwargs={"k": 150})
-            retrieved_docs = retriever.invoke(img["text"])
-            
-
-            # DEBUG: Printing out the questions ai found semantically similar
-            print("\n🔎 Retrieved relevant documents for this question:")
-            for i, doc in enumerate(retrieved_docs):
-                print(f"\nDoc {i+1}:")
-                print(f"Text:\n{doc.page_content}")
-                print(f"Topics: {doc.metadata.get('topics', [])}")
-
-            corrections_context = "\n\n".join(
-                f"Topics: {doc.metadata.get('topics', [])}"
-                for doc in retrieved_docs
-            )
-
-            result = classify_image_with_gpt(img["base64"], bullets_markdown, corrections_context)
-            img["topics"] = result.get("topics", [])
+            vector = await embeddings.aembed_query(img["text"])
+            topics, vote = await run_in_threadpool(local_topics, subject, vector)
+            if topics is not None:
+                img["topics"] = topics
+            else:
+                catalogue, topic_votes = await narrow_to_modules(subject, img["text"], topic_docs, vote["topics"])
+                # Abandoned uploads stop paying for GPT
+                result = await cancel_on_disconnect(
+                    request, classify_with_routing(subject, img["base64"], img["text"], catalogue, topic_votes),
+                )
+                img["topics"] = result.get("topics", [])
 
             doc = Document(
                 page_content=img["text"],
                 metadata={
                     "question_id": img["id"],
                     "topics": img["topics"],
-                    "base64": img["base64"]
+                    "topic_ids": topic_ids_from_names(img["topics"]),
+                    "image_hash": put_image(img["base64"]),
+                    "phash": phash,
+                    # Not in MongoDB until corrected, so syncs leave it be
+                    "origin": CLASSIFY_ORIGIN,
                 }
             )
             new_docs.append(doc)
 
         if new_docs:
-            vs.add_documents(new_docs)
-            vs.save_local(str(VECTORSTORE_PATHS[subject]))
+            # Logged to the subject's WAL; the snapshot is written in the background
+            await add_questions(subject, new_docs)
         else:
             print("No new documents to add to vectorstore.")
 
@@ -515,48 +1341,25 @@ async def submit_corrections(payload: SubmitCorrectionsPayload):
     subject = payload.subject
     images = payload.corrections
 
-    # pick the right FAISS index for this subject
-    vs = vectorstores.get(subject)
-    if vs is None:
-        raise HTTPException(status_code=400, detail=f"No vectorstore found for subject '{subject}'")
+    # this subject's FAISS index must be loaded
+    await run_in_threadpool(require_ready, subject)
 
-    updated_count = 0
-    added_count = 0
-
-    # For quicker lookups, grab the dict once
-    store_dict = vs.docstore._dict  # {doc_id: Document}
+    entries = []
 
     for img in images:
-        found_doc_id = None
-
-        # 1) Update in-memory FAISS docstore if the doc exists
-        for doc_id, doc in store_dict.items():
-            if doc.metadata.get("question_id") == img.id:
-                # update topics (and optional fields)
-                doc.metadata["topics"] = img.topics
-                if img.base64 is not None:
-                    doc.metadata["base64"] = img.base64
-                if img.text:  # if you also want to replace the content
-                    doc.page_content = img.text
-                found_doc_id = doc_id
-                updated_count += 1
-                break
-
-        # 2) If not found in the FAISS store, optionally add it
-        if found_doc_id is None and img.text:
-            new_doc = Document(
-                page_content=img.text,
-                metadata={
-                    "question_id": img.id,
-                    "topics": img.topics,
-                    "base64": img.base64 or "",
-                },
-            )
-            vs.add_documents([new_doc])
-            added_count += 1
+        # 1) Queue the vectorstore upsert: re-embeds only if the text changed
+        metadata = {
+            "topics": img.topics,
+            "topic_ids": topic_ids_from_names(img.topics),
+            "origin": "corrections",  # written to MongoDB below
+        }
+        if img.base64:
+            metadata.update(image_metadata(img.base64))
+        entries.append((img.id, img.text, metadata))
 
-        # 3) Always upsert to MongoDB
-        insert_classified_question(
+        # 2) Always upsert to MongoDB (pymongo blocks, so off the event loop)
+        await run_in_threadpool(
+            insert_classified_question,
             {
                 "id": img.id,
                 "text": img.text,
@@ -567,8 +1370,10 @@ async def submit_corrections(payload: SubmitCorrectionsPayload):
             db,
         )
 
-    # persist ONLY this subject's FAISS index
-    vs.save_local(str(VECTORSTORE_PATHS[subject]))
+    # Logged to this subject's WAL; its snapshot is written in the background
+    stats = await upsert_questions(subject, entries)
+    updated_count = stats["updated"] + stats["retagged"]
+    added_count = stats["added"]
 
     return {
         "message": f"Corrections saved. Updated {updated_count} docs, added {added_count} new.",
@@ -586,18 +1391,13 @@ class RevampRequest(BaseModel):
     img: ImageData
     subject: str
     
+# Rules first and the question last (see prompt_layout.py), so the rules are a cached prefix
 BIOLOGY_REVAMP_PROMPT = r"""
 You are a Biology HSC question rewriter.
 
-Your task is to revamp the given question to create ONE NEW UNIQUE question that tests the same concepts and remains consistent with the given question's difficulty, but 
+Your task is to revamp the question given below to create ONE NEW UNIQUE question that tests the same concepts and remains consistent with the given question's difficulty, but 
 uses a different scenario or different phrasing.
 
-Question: 
-{question_text}
-
-Question topic(s):
-{question_topics}
-
 STRUCTURE RULES:
 1) Keep the question in the same general format (e.g., multiple choice (a. b. c. d.), short answer, etc.).
 3) Keep terminology and notation consistent with the subject area.
@@ -606,21 +1406,15 @@ STRUCTURE RULES:
 
 LATEX RULES:
 - Use plain text for Biology unless referring to chemical/molecular notation (e.g., ATP, DNA, \(H_2O\)).
-- Do NOT use LaTeX environments such as \begin{{align}}, TikZ, or tables.
+- Do NOT use LaTeX environments such as \begin{align}, TikZ, or tables.
 Return only the raw question text (no explanations or commentary).
 """
 
 MATH_REVAMP_PROMPT = r"""You are a HSC question rewriter that outputs questions in valid MathJax/KaTeX-safe LaTeX format.
 
-Your task is to revamp the given question to create ONE NEW UNIQUE question that tests the same concepts and remains consistent with the given question's difficulty, but 
+Your task is to revamp the question given below to create ONE NEW UNIQUE question that tests the same concepts and remains consistent with the given question's difficulty, but 
 uses a different scenario or different phrasing.
 
-Question: 
-{question_text}
-
-Question topic(s):
-{question_topics}
-
 STRUCTURE RULES:
 1) Keep the question in the same general format (e.g., multiple choice (a. b. c. d.), short answer, etc.).
 3) Keep terminology and notation consistent with the subject area.
@@ -630,16 +1424,22 @@ STRUCTURE RULES:
 LATEX RULES:
 - Use only MathJax/KaTeX-safe LaTeX syntax.
 - Inline math: \( ... \)
-- Display math: \[ ... \] or \\begin{{align*}} ... \\end{{align*}}
-- Do not use \\begin{{enumerate}}, \\item, \\tabular, \\center, TikZ, or \\boxed.
+- Display math: \[ ... \] or \\begin{align*} ... \\end{align*}
+- Do not use \\begin{enumerate}, \\item, \\tabular, \\center, TikZ, or \\boxed.
 - Do not wrap LaTeX in triple backticks or prepend "latex".
 - Return only the raw LaTeX content.
 
 - Do not include explanations, reasoning, or extra commentary.
 """
 
+REVAMP_QUESTION_TEMPLATE = """Question topic(s):
+{question_topics}
+
+Question: 
+{question_text}"""
+
 @app.post("/revamp_question/")
-async def revamp_question(req: RevampRequest):
+async def revamp_question(req: RevampRequest, request: Request):
     img = req.img
     subject = req.subject
     print("WOWOWW",subject)
@@ -657,20 +1457,21 @@ async def revamp_question(req: RevampRequest):
     else: 
         prompt_template = MATH_REVAMP_PROMPT
 
-    user_prompt = prompt_template.format(
+    question = REVAMP_QUESTION_TEMPLATE.format(
         question_text = img.text,
         question_topics = img.topics
     )
-    print(user_prompt)
-    prompt = user_prompt
-    response = client.chat.completions.create(
+    print(question)
+    started = time.perf_counter()
+    response = await cancel_on_disconnect(request, openai_client().chat.completions.create(
         model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "You are a creative HSC teacher who writes high-qualit HSC questions in LaTeX."},
-            {"role": "user", "content": prompt}
-        ],
+        messages=chat_messages(
+            "You are a creative HSC teacher who writes high-qualit HSC questions in LaTeX.",
+            [prompt_template], [question],
+        ),
         temperature=0.7
-    )
+    ))
+    prompt_cache_stats.record("revamp_question", response, time.perf_counter() - started)
 
     new_question_latex = response.choices[0].message.content.strip()
     print(new_question_latex)
@@ -687,7 +1488,8 @@ class QuestionRequest(BaseModel):
     count: int = 10
 
 @app.post("/get-questions")
-async def get_questions(req: QuestionRequest):
+def get_questions(req: QuestionRequest):
+    # Only MongoDB queries: a plain def, so FastAPI runs it in the threadpool
     topic_names = req.topics
     count = req.count
 
@@ -743,34 +1545,19 @@ async def get_questions(req: QuestionRequest):
 
     return JSONResponse(content={"questions": final_questions})
 
-from fastapi import APIRouter
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from openai import OpenAI
-import os
-import asyncio
-from pymongo import MongoClient
-from schemas import GenerateFromTopicsRequest, GenerateFromTopicsResponse
-from db_utils import fetch_questions_with_all_topics
-
 
 SYSTEM_PROMPT = (
     "You are a senior HSC Mathematics teacher who writes authentic HSC-style questions in LaTeX."
 )
 
-USER_PROMPT_TEMPLATE = r"""You are given authentic HSC exemplar questions. 
+# Rules first and the exemplars/topics last (see prompt_layout.py), so the rules are a cached prefix
+USER_PROMPT_TEMPLATE = r"""You are given authentic HSC exemplar questions (below). 
 Your task is to write ONE NEW UNIQUE HSC-style question that looks and feels like these exemplars.
 
 The topics are provided only to keep the mathematics relevant.
 Do NOT use different technical terminology, or invent your own structure or style — stay as close as possible to the exemplars.
 Randomise the difficulty of the questions you generate (not always very easy, make some quite hard).
 
-Exemplar questions (pick a random one and use it as the main reference for style, structure, and phrasing):
-{exemplars_block}
-
-Target topics (for relevance only, secondary to style):
-{topics_lines}
-
 Write EXACTLY ONE HSC-style math question.
 
 STRUCTURE RULES:
@@ -784,25 +1571,19 @@ STRUCTURE RULES:
 LATEX RULES:
 - Use only MathJax/KaTeX-safe LaTeX:
   - Inline: \( ... \)
-  - Display: \[ ... \] or \begin{{align*}}...\end{{align*}}
-- Do NOT use \begin{{enumerate}}, \item, \tabular, \center, TikZ, or \boxed.
+  - Display: \[ ... \] or \begin{align*}...\end{align*}
+- Do NOT use \begin{enumerate}, \item, \tabular, \center, TikZ, or \boxed.
 - Do NOT wrap in triple backticks or prepend "latex".
 Return only the raw LaTeX content.
 """
 
-BIOLOGY_USER_PROMPT_TEMPLATE = r"""You are given authentic HSC Biology exemplar questions. 
+BIOLOGY_USER_PROMPT_TEMPLATE = r"""You are given authentic HSC Biology exemplar questions (below). 
 Your task is to write ONE NEW UNIQUE HSC-style question that looks and feels like these exemplars.
 
 The topics are provided only to keep the biology content relevant.
 Do NOT use terminology or structures that differ from authentic HSC Biology exam style.
 Questions must sound natural and realistic for NESA-style HSC exams, not textbook exercises.
 
-Exemplar questions (pick a random one and use it as the main reference for style, structure, and phrasing):
-{exemplars_block}
-
-Target topics (for relevance only, secondary to style):
-{topics_lines}
-
 Write EXACTLY ONE HSC-style Biology question.
 
 STRUCTURE RULES:
@@ -822,11 +1603,17 @@ CONTENT RULES:
 
 LATEX RULES:
 - Use plain text for Biology unless referring to chemical/molecular notation (e.g., ATP, DNA, \(H_2O\)).
-- Do NOT use LaTeX environments such as \begin{{align}}, TikZ, or tables.
+- Do NOT use LaTeX environments such as \begin{align}, TikZ, or tables.
 
 Return only the raw question text (no explanations or commentary).
 """
 
+EXEMPLARS_TEMPLATE = """Exemplar questions (pick a random one and use it as the main reference for style, structure, and phrasing):
+{exemplars_block}
+
+Target topics (for relevance only, secondary to style):
+{topics_lines}"""
+
 def _topics_lines(topics):
     return "\n".join(f"- {t}" for t in topics)
 
@@ -842,14 +1629,14 @@ def _exemplars_block(docs):
     return "\n\n".join(blocks)
 
 @app.post("/generate-question-by-topics", response_model=GenerateFromTopicsResponse)
-async def generate_question_by_topics(req: GenerateFromTopicsRequest):
+async def generate_question_by_topics(req: GenerateFromTopicsRequest, request: Request = None):
     topics = [t.strip() for t in req.topics if t.strip()]
     if not topics:
         return JSONResponse({"error": "At least one topic is required."}, status_code=400)
 
     # Pull intersection exemplars from Mongo
-    exemplars = fetch_questions_with_all_topics(
-        db, topic_names=topics, limit=req.exemplar_count
+    exemplars = await run_in_threadpool(
+        fetch_questions_with_all_topics, db, topic_names=topics, limit=req.exemplar_count
     )
 
     # Require ≥2 exemplars to properly ground the style
@@ -866,22 +1653,21 @@ async def generate_question_by_topics(req: GenerateFromTopicsRequest):
         prompt_template = USER_PROMPT_TEMPLATE
 
     # Format the prompt
-    user_prompt = prompt_template.format(
+    examples = EXEMPLARS_TEMPLATE.format(
         topics_lines=_topics_lines(topics),
         exemplars_block=_exemplars_block(exemplars),
     )
     
-    print("User prompt:\n", user_prompt)
+    print("User prompt:\n", prompt_template + "\n" + examples)
 
-    resp = client.chat.completions.create(
+    started = time.perf_counter()
+    resp = await cancel_on_disconnect(request, openai_client().chat.completions.create(
         model="gpt-4o",
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": user_prompt},
-        ],
+        messages=chat_messages(SYSTEM_PROMPT, [prompt_template], [examples]),
         temperature=req.temperature,
         max_tokens=700,
-    )
+    ))
+    prompt_cache_stats.record("generate_from_topics", resp, time.perf_counter() - started)
 
     latex = resp.choices[0].message.content.strip()
     response = {
@@ -894,16 +1680,6 @@ async def generate_question_by_topics(req: GenerateFromTopicsRequest):
     print("ids", response["exemplar_ids"])
     return response
 
-# add to your existing file (same imports stay)
-from typing import Optional, Literal
-from pydantic import BaseModel
-import tempfile
-import subprocess
-import shutil
-import textwrap
-import uuid
-import os
-
 # ---------- Pydantic Schemas ----------
 
 class GenerateDiagramRequest(BaseModel):
@@ -927,25 +1703,26 @@ SYSTEM_PROMPT_DIAGRAM = (
 )
 
 USER_PROMPT_TEMPLATE_DIAGRAM = r"""
-You are given an HSC-style math question in LaTeX (no solutions provided).
+You are given an HSC-style math question in LaTeX (below, no solutions provided).
 
 Your task:
 1) Decide whether a diagram meaningfully supports the question (axes, graph, labelled points,
    geometric figure, vector diagram, probability tree, etc).
 2) If yes, output ONLY a valid TikZ diagram inside EXACTLY one environment:
-   \begin{{tikzpicture}}
+   \begin{tikzpicture}
      ...
-   \end{{tikzpicture}}
+   \end{tikzpicture}
 
 Constraints:
 - Use TikZ primitives that are compatible with tikzjax or standalone->dvisvgm: no external images, no PGFPlots.
 - If axes are needed, draw them with ticks and labels; label key points/curves clearly.
 - Keep exam style: clean, uncluttered, black/white lines, sensible scales.
-- DO NOT include preamble, \documentclass, \usepackage, or \begin{{document}}.
+- DO NOT include preamble, \documentclass, \usepackage, or \begin{document}.
 - DO NOT include any text besides the tikzpicture environment.
 - If a diagram is unnecessary, still produce a minimal contextual diagram (e.g., axes with a placeholder curve) that remains useful.
+"""
 
-Question (LaTeX):
+DIAGRAM_QUESTION_TEMPLATE = r"""Question (LaTeX):
 ---
 {question_latex}
 ---
@@ -967,9 +1744,6 @@ def _hint_line(hint: Optional[str]) -> str:
 
 # ---------- TikZ -> SVG (optional server-side compile) ----------
 
-import os, shutil, tempfile, textwrap, subprocess
-from typing import Optional, Tuple
-
 def tikz_to_svg(tikz_code: str) -> Tuple[Optional[str], Optional[str]]:
     """
     Compile TikZ to SVG using:
@@ -1076,24 +1850,23 @@ def tikz_to_svg(tikz_code: str) -> Tuple[Optional[str], Optional[str]]:
 # ---------- Endpoint ----------
 
 @app.post("/generate-diagram-for-question", response_model=GenerateDiagramResponse)
-async def generate_diagram_for_question(req: GenerateDiagramRequest):
-    user_prompt = USER_PROMPT_TEMPLATE_DIAGRAM.format(
+async def generate_diagram_for_question(req: GenerateDiagramRequest, request: Request,
+                                        cache_control: Optional[str] = Header(None)):
+    question = DIAGRAM_QUESTION_TEMPLATE.format(
         question_latex=req.question_latex.strip(),
         topics_lines=_topics_lines_for_diagram(req.topics),
         hint_line=_hint_line(req.hint)
     )
 
-    chat = client.chat.completions.create(
+    # Cache-Control: no-cache asks the model again, no-store skips the response cache
+    raw = (await cancel_on_disconnect(request, cached_llm_call(
+        "generate_diagram", openai_client().chat.completions.create,
+        lambda chat: chat.choices[0].message.content or "", cache_mode(cache_control),
         model="gpt-4o",
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT_DIAGRAM},
-            {"role": "user", "content": user_prompt},
-        ],
+        messages=chat_messages(SYSTEM_PROMPT_DIAGRAM, [USER_PROMPT_TEMPLATE_DIAGRAM], [question]),
         temperature=req.temperature,
         max_tokens=900,
-    )
-
-    raw = (chat.choices[0].message.content or "").strip()
+    ))).strip()
 
     # Sanity: extract exactly one tikzpicture block
     start_tag = r"\begin{tikzpicture}"
@@ -1110,7 +1883,7 @@ async def generate_diagram_for_question(req: GenerateDiagramRequest):
 
     svg_text = None
     if req.render_target == "svg":
-        svg_text, warn = tikz_to_svg(tikz_code)
+        svg_text, warn = await run_in_threadpool(tikz_to_svg, tikz_code)
         if warn:
             warnings = (warnings or []) + [warn]
 
@@ -1148,7 +1921,7 @@ def main():
     )
 
     async def run_test():
-        result = await generate_diagram_for_question(req)
+        result = await generate_diagram_for_question(req, None, None)
 
         # Always print the TikZ for debugging
         print("\n--- TikZ Code ---\n")
@@ -1198,47 +1971,36 @@ def main():
     asyncio.run(run_test())
 
 # GENERATE SOLUTIONS 
-def extract_question_text_from_base64(image_base64: str):
+async def extract_question_text_from_base64(image_base64: str, mode: str = "use"):
 
     prompt = "Extract the exact question text from this image."
 
-    response = client.responses.create(
+    return (await cached_llm_call(
+        "extract_question_text", openai_client().responses.create, lambda r: r.output_text, mode,
         model="gpt-5.2",
-        input=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": prompt},
-                    {
-                        "type": "input_image",
-                        "image_url": f"data:image/png;base64,{image_base64}"
-                    }
-                ]
-            }
-        ]
-    )
+        input=responses_input(prompt, image_base64=image_base64)
+    )).strip()
 
-    return response.output_text.strip()
+async def retrieve_similar_solutions(question_text, subject, k=5):
 
-def retrieve_similar_solutions(question_text, subject, k=5):
+    key = f"solutions:{subject}"
 
-    vs = solution_vectorstores.get(subject)
-
-    if vs is None:
+    status = await run_in_threadpool(retrieval.status)
+    if status.get(key, {}).get("state") != "ready":
         raise HTTPException(status_code=400, detail=f"No solution vectorstore for {subject}")
 
-    retriever = vs.as_retriever(search_kwargs={"k": k})
-    docs = retriever.invoke(question_text)
+    vector = await embeddings.aembed_query(question_text)
+    docs = [doc for doc, _ in (await run_in_threadpool(retrieval.search, key, [vector], k))[0]]
 
     return docs
 
-def generate_solution_from_text(question_text: str, subject: str):
+async def generate_solution_from_text(question_text: str, subject: str, mode: str = "use"):
 
     # 1. Extract question text
     question_text = question_text
 
     # 2. Retrieve similar solutions
-    docs = retrieve_similar_solutions(question_text, subject)
+    docs = await retrieve_similar_solutions(question_text, subject)
 
     # (optional debug)
     for d in docs:
@@ -1255,6 +2017,8 @@ def generate_solution_from_text(question_text: str, subject: str):
         for d in docs
     ])
 
+    # Static system text and rules first, then the retrieved solutions and the question
+    # (see prompt_layout.py)
     if subject == "Biology":
 
         system_prompt = """You are an NSW HSC Biology exam marker.
@@ -1267,11 +2031,8 @@ Rules:
 • Match HSC command verbs (explain, analyse, evaluate)
 """
 
-        user_prompt = f"""
-You are given HSC Biology sample answers and marking criteria.
-
-Reference solutions:
-{solutions_context}
+        rules = """
+You are given HSC Biology sample answers and marking criteria (the reference solutions below).
 
 Using the SAME style:
 - Use precise biological terminology
@@ -1279,9 +2040,6 @@ Using the SAME style:
 - Be concise but complete
 - Use appropriate command verbs (explain, analyse, evaluate)
 
-Question:
-{question_text}
-
 Format your response EXACTLY like this:
 
 SOLUTION:
@@ -1300,11 +2058,8 @@ Ensure:
 • Method marks would be awarded
 """
 
-        user_prompt = f"""
-You are given marking criteria and sample answers from similar HSC questions.
-
-Reference solutions:
-{solutions_context}
+        rules = """
+You are given marking criteria and sample answers from similar HSC questions (the reference solutions below).
 
 Using the SAME marking standards:
 - Follow the Criteria structure
@@ -1312,9 +2067,6 @@ Using the SAME marking standards:
 - Show full working clearly
 - Match the style of SampleAnswer
 
-Question:
-{question_text}
-
 Format your response EXACTLY like this:
 
 SOLUTION:
@@ -1322,34 +2074,32 @@ SOLUTION:
 
 """
 
-    response = client.responses.create(
+    output_text = await cached_llm_call(
+        "generate_solution", openai_client().responses.create, lambda r: r.output_text, mode,
         model="gpt-5.2",
         temperature=0.2,
-        input=[
-            {
-                "role": "system",
-                "content": [{"type": "input_text", "text": system_prompt}]
-            },
-            {
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": user_prompt + "\n\nQuestion:\n" + question_text}
-                ]
-            }
-        ]
+        input=responses_input(
+            system_prompt, [rules],
+            [f"Reference solutions:\n{solutions_context}", f"Question:\n{question_text}"],
+        )
     )
     print("\n--- RETRIEVED SOLUTIONS ---\n")
     for i, d in enumerate(docs):
         print(f"\nSolution {i+1}")
         print(d.page_content[:200])
 
-    return response.output_text
+    return output_text
 
 @app.post("/generate-solution")
-async def generate_solution_endpoint(req: GenerateSolutionRequest):
+async def generate_solution_endpoint(req: GenerateSolutionRequest, request: Request,
+                                     cache_control: Optional[str] = Header(None)):
+    await run_in_threadpool(require_ready, f"solutions:{req.subject}")
 
     try:
-        result_text = generate_solution_from_text(req.question_text, req.subject)
+        # Cache-Control: no-cache asks the model again, no-store skips the response cache
+        result_text = await cancel_on_disconnect(
+            request, generate_solution_from_text(req.question_text, req.subject, cache_mode(cache_control)),
+        )
 
         print("\n--- RAW MODEL OUTPUT ---\n")
         print(result_text)
@@ -1365,11 +2115,15 @@ async def generate_solution_endpoint(req: GenerateSolutionRequest):
             "generated_solution": generated_solution,
         }
 
+    except ClientDisconnected:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 if __name__ == "__main__":
+    warm_up()
+
     # Get the advanced vectorstore
     advanced_vs = vectorstores.get("Mathematics Standard")
 
@@ -0,0 +1,350 @@
+import json
+import os
+from collections.abc import MutableMapping
+
+import faiss
+import numpy as np
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+
+from quantization import empty_codec
+
+# Read-only, memory-mapped loading of a snapshot (VECTORSTORE_MMAP=1). Every uvicorn worker
+# maps the same files, so the index and docstore live once in the OS page cache instead of
+# once per worker; each worker keeps only its changes since the snapshot in memory.
+#
+# The docstore is stored flat so it can be mapped too:
+#   docstore.jsonl        -> line 0: docstore ids in vector position order,
+#                            then one [page_content, metadata] line per position
+#   docstore_offsets.npy  -> byte offset of every doc line, plus the end of the file
+DOCS_FILE = "docstore.jsonl"
+DOCS_OFFSETS_FILE = "docstore_offsets.npy"
+
+
+def _line(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def write_docs(folder, ids, docs) -> list:
+    """
+    Write the flat docstore for `ids` (vector position order) into a snapshot folder; `docs`
+    maps docstore id -> Document. Returns the file names (save_snapshot checksums them).
+    """
+    offsets = np.empty(len(ids) + 1, dtype="int64")
+    with open(os.path.join(str(folder), DOCS_FILE), "wb") as f:
+        f.write(_line(ids))
+        for i, doc_id in enumerate(ids):
+            doc = docs[doc_id]
+            offsets[i] = f.tell()
+            f.write(_line([doc.page_content, doc.metadata]))
+        offsets[len(ids)] = f.tell()
+        f.flush()
+        os.fsync(f.fileno())
+    np.save(os.path.join(str(folder), DOCS_OFFSETS_FILE), offsets)
+    return [DOCS_FILE, DOCS_OFFSETS_FILE]
+
+
+def read_docs(folder):
+    """
+    (ids, {docstore id: Document}) from a flat docstore, fully loaded.
+    """
+    with open(os.path.join(str(folder), DOCS_FILE), "r", encoding="utf-8") as f:
+        ids = json.loads(f.readline())
+        docs = {}
+        for doc_id in ids:
+            content, metadata = json.loads(f.readline())
+            docs[doc_id] = Document(page_content=content, metadata=metadata)
+    return ids, docs
+
+
+class MappedDocs(MutableMapping):
+    """
+    docstore id -> Document over a mapped docstore.jsonl. Docs are decoded on every read,
+    so callers that change one must assign it back (docs[doc_id] = doc); writes and
+    deletes go to an in-memory overlay and never touch the file.
+    """
+
+    def __init__(self, data, offsets, ids):
+        self._data = data
+        self._offsets = offsets
+        self._row_by_id = {doc_id: row for row, doc_id in enumerate(ids)}
+        self._changed = {}     # docstore id -> Document written since the snapshot
+        self._removed = set()  # snapshot ids deleted since
+
+    def _decode(self, row: int) -> Document:
+        content, metadata = json.loads(bytes(self._data[self._offsets[row]:self._offsets[row + 1]]))
+        return Document(page_content=content, metadata=metadata)
+
+    def __getitem__(self, doc_id) -> Document:
+        doc = self._changed.get(doc_id)
+        if doc is not None:
+            return doc
+        row = self._row_by_id.get(doc_id)
+        if row is None or doc_id in self._removed:
+            raise KeyError(doc_id)
+        return self._decode(row)
+
+    def __contains__(self, doc_id) -> bool:
+        if doc_id in self._changed:
+            return True
+        return doc_id in self._row_by_id and doc_id not in self._removed
+
+    def __setitem__(self, doc_id, doc: Document):
+        self._changed[doc_id] = doc
+        self._removed.discard(doc_id)
+
+    def __delitem__(self, doc_id):
+        if doc_id not in self:
+            raise KeyError(doc_id)
+        self._changed.pop(doc_id, None)
+        if doc_id in self._row_by_id:
+            self._removed.add(doc_id)
+
+    def __iter__(self):
+        for doc_id in self._row_by_id:
+            if doc_id not in self._removed and doc_id not in self._changed:
+                yield doc_id
+        yield from list(self._changed)
+
+    def __len__(self) -> int:
+        added = sum(1 for doc_id in self._changed if doc_id not in self._row_by_id)
+        return len(self._row_by_id) - len(self._removed) + added
+
+    def overlay_size(self) -> int:
+        return len(self._changed) + len(self._removed)
+
+    def clone(self) -> "MappedDocs":
+        # The mapping is read-only, so a snapshot clone can share it
+        docs = MappedDocs(self._data, self._offsets, ())
+        docs._row_by_id = self._row_by_id
+        docs._changed = {
+            doc_id: Document(page_content=doc.page_content, metadata=dict(doc.metadata))
+            for doc_id, doc in self._changed.items()
+        }
+        docs._removed = set(self._removed)
+        return docs
+
+
+class MappedDocstore(Docstore, AddableMixin):
+    """
+    LangChain docstore over MappedDocs, the mapped counterpart of InMemoryDocstore.
+    """
+
+    def __init__(self, docs: MappedDocs):
+        self._dict = docs
+
+    @classmethod
+    def open(cls, folder):
+        """
+        (MappedDocstore, ids in vector position order) for a snapshot folder.
+        """
+        data = np.memmap(os.path.join(str(folder), DOCS_FILE), dtype="uint8", mode="r")
+        offsets = np.load(os.path.join(str(folder), DOCS_OFFSETS_FILE), mmap_mode="r")
+        ids = json.loads(bytes(data[:offsets[0]]))
+        if len(offsets) != len(ids) + 1:
+            raise ValueError(f"{DOCS_OFFSETS_FILE} has {len(offsets)} offsets for {len(ids)} ids")
+        return cls(MappedDocs(data, offsets, ids)), ids
+
+    def add(self, texts: dict):
+        overlapping = [doc_id for doc_id in texts if doc_id in self._dict]
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        for doc_id, doc in texts.items():
+            self._dict[doc_id] = doc
+
+    def delete(self, ids):
+        if not any(doc_id in self._dict for doc_id in ids):
+            raise ValueError(f"Tried to delete ids that does not  exist: {ids}")
+        for doc_id in ids:
+            self._dict.pop(doc_id, None)
+
+    def search(self, search: str):
+        if search not in self._dict:
+            return f"ID {search} not found."
+        return self._dict[search]
+
+    def clone(self) -> "MappedDocstore":
+        return MappedDocstore(self._dict.clone())
+
+
+class DeltaIndex:
+    """
+    A snapshot's flat-codes index mapped read-only (IndexFlatL2 or one from
+    quantization.new_codes_index), plus an in-memory index of this worker's vectors since,
+    with the same encoding.
+
+    Implements the part of the faiss Index API that LangChain's FAISS and QuestionIndex use,
+    over the store's usual positions 0..ntotal-1. Each position points at a row of either
+    layer. Mapped rows are never written (faiss aborts on writes to a mapped index), so a
+    replaced or deleted vector just stops being pointed at until the next snapshot.
+    """
+
+    def __init__(self, base, delta=None, rows=None):
+        self.base = base
+        self.delta = delta if delta is not None else empty_codec(base)
+        # position -> row: >= 0 is a base row, < 0 is delta row ~row
+        self._rows = np.arange(base.ntotal, dtype="int64") if rows is None else rows
+        self.ntotal = len(self._rows)
+        self._reindex()
+
+    @classmethod
+    def open(cls, path) -> "DeltaIndex":
+        return cls(faiss.read_index(str(path), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY))
+
+    @property
+    def d(self) -> int:
+        return self.base.d
+
+    @property
+    def code_size(self) -> int:
+        return self.base.code_size
+
+    @property
+    def metric_type(self):
+        return self.base.metric_type
+
+    @property
+    def is_trained(self) -> bool:
+        return True
+
+    def _reindex(self):
+        # row -> position for each layer, -1 for rows no position points at
+        rows = self._rows[:self.ntotal]
+        in_base = rows >= 0
+        self._base_positions = np.full(self.base.ntotal, -1, dtype="int64")
+        self._base_positions[rows[in_base]] = np.nonzero(in_base)[0]
+        self._delta_positions = np.full(self.delta.ntotal, -1, dtype="int64")
+        self._delta_positions[~rows[~in_base]] = np.nonzero(~in_base)[0]
+
+    def _grow(self, n: int):
+        if n > len(self._rows):
+            rows = np.empty(max(n, 2 * len(self._rows), 1024), dtype="int64")
+            rows[:self.ntotal] = self._rows[:self.ntotal]
+            self._rows = rows
+
+    def _release(self, pos: int):
+        # The position stops pointing at its row
+        row = self._rows[pos]
+        if row >= 0:
+            self._base_positions[row] = -1
+        else:
+            self._delta_positions[~row] = -1
+
+    def _point(self, pos: int, row: int):
+        self._rows[pos] = row
+        if row >= 0:
+            self._base_positions[row] = pos
+        else:
+            self._delta_positions[~row] = pos
+
+    def _add_rows(self, x) -> np.ndarray:
+        start = self.delta.ntotal
+        self.delta.add(x)
+        self._delta_positions = np.concatenate([self._delta_positions, np.full(len(x), -1, dtype="int64")])
+        return ~np.arange(start, start + len(x), dtype="int64")
+
+    def delta_size(self) -> int:
+        return self.delta.ntotal
+
+    def sa_encode(self, x):
+        return self.base.sa_encode(x)
+
+    def add(self, x):
+        x = np.ascontiguousarray(x, dtype="float32").reshape(-1, self.d)
+        rows = self._add_rows(x)
+        self._grow(self.ntotal + len(x))
+        for offset, row in enumerate(rows):
+            self._point(self.ntotal + offset, row)
+        self.ntotal += len(x)
+
+    def replace(self, pos: int, vector):
+        """
+        Point a position at a new vector (QuestionIndex._replace).
+        """
+        row = self._add_rows(np.ascontiguousarray(vector, dtype="float32").reshape(1, self.d))[0]
+        self._release(pos)
+        self._point(pos, row)
+
+    def swap_remove(self, pos: int):
+        """
+        Move the last position's vector into `pos` and drop the last position (QuestionIndex.delete).
+        """
+        last = self.ntotal - 1
+        self._release(pos)
+        if pos != last:
+            self._point(pos, self._rows[last])
+        self.ntotal -= 1
+
+    def remove_ids(self, ids) -> int:
+        # LangChain's FAISS.delete: drop the positions and shift the later ones down
+        keep = np.ones(self.ntotal, dtype=bool)
+        ids = np.asarray(ids, dtype="int64")
+        keep[ids[(ids >= 0) & (ids < self.ntotal)]] = False
+        self._rows = self._rows[:self.ntotal][keep].copy()
+        removed = self.ntotal - len(self._rows)
+        self.ntotal = len(self._rows)
+        self._reindex()
+        return removed
+
+    def search(self, x, k: int, params=None):
+        x = np.ascontiguousarray(x, dtype="float32").reshape(-1, self.d)
+        # Rows nobody points at can take up to this many of a layer's top hits
+        dead = self.base.ntotal + self.delta.ntotal - self.ntotal
+        all_distances, all_positions = [], []
+        for index, positions in ((self.base, self._base_positions), (self.delta, self._delta_positions)):
+            if index.ntotal == 0:
+                continue
+            distances, rows = index.search(x, min(k + dead, index.ntotal))
+            found = np.where(rows >= 0, positions[np.maximum(rows, 0)], -1)
+            all_distances.append(np.where(found >= 0, distances, np.inf))
+            all_positions.append(found)
+
+        distances = np.full((len(x), k), np.inf, dtype="float32")
+        labels = np.full((len(x), k), -1, dtype="int64")
+        if all_distances:
+            merged_distances = np.concatenate(all_distances, axis=1)
+            merged_positions = np.concatenate(all_positions, axis=1)
+            order = np.argsort(merged_distances, axis=1, kind="stable")[:, :k]
+            width = order.shape[1]
+            distances[:, :width] = np.take_along_axis(merged_distances, order, axis=1)
+            labels[:, :width] = np.take_along_axis(merged_positions, order, axis=1)
+            labels[~np.isfinite(distances)] = -1
+        return distances, labels
+
+    def reconstruct_n(self, start: int, n: int):
+        rows = self._rows[start:start + n]
+        out = np.empty((len(rows), self.d), dtype="float32")
+        in_base = rows >= 0
+        if in_base.any():
+            out[in_base] = self.base.reconstruct_batch(rows[in_base])
+        if (~in_base).any():
+            out[~in_base] = self.delta.reconstruct_batch(~rows[~in_base])
+        return out
+
+    def reconstruct(self, key: int):
+        return self.reconstruct_n(int(key), 1)[0]
+
+    def _codes(self, index):
+        if index.ntotal == 0:
+            return np.empty((0, index.code_size), dtype="uint8")
+        size = index.ntotal * index.code_size
+        return faiss.rev_swig_ptr(index.codes.data(), size).reshape(index.ntotal, index.code_size)
+
+    def materialize(self):
+        """
+        A plain in-memory index with the same vectors at the same positions, for writing a
+        snapshot. Codes are copied as is, so nothing is re-encoded.
+        """
+        rows = self._rows[:self.ntotal]
+        in_base = rows >= 0
+        codes = np.empty((self.ntotal, self.code_size), dtype="uint8")
+        codes[in_base] = self._codes(self.base)[rows[in_base]]
+        codes[~in_base] = self._codes(self.delta)[~rows[~in_base]]
+        index = empty_codec(self.base)
+        if self.ntotal:
+            index.add_sa_codes(codes)
+        return index
+
+    def clone(self) -> "DeltaIndex":
+        # The mapped base is read-only, so a snapshot clone can share it
+        return DeltaIndex(self.base, faiss.clone_index(self.delta), self._rows[:self.ntotal].copy())
@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+
+# Which models /classify/ asks, in order. Each tier but the last also reports its confidence,
+# and its answer is kept unless that's below min_confidence or none of its topics are among
+# the neighbours' top `agree_top` votes; then the next tier is asked. Per subject, e.g.
+#   CLASSIFY_ROUTING_CONFIG='{"Biology": [
+#       {"model": "gpt-4o-mini", "input": "text"},
+#       {"model": "gpt-4o-mini", "input": "image", "max_side": 768},
+#       {"model": "gpt-4o"}]}'
+# input is "image" (the page PNG, downscaled to max_side if set) or "text" (the OCR text only).
+CLASSIFY_ROUTING_CONFIG = json.loads(os.getenv("CLASSIFY_ROUTING_CONFIG", "{}"))
+
+TIER_DEFAULTS = {
+    "model": "gpt-4o",
+    "input": "image",
+    "max_side": None,
+    "temperature": 0.3,
+    "min_confidence": 0.8,
+    "agree_top": 3,
+}
+DEFAULT_TIERS = [{"model": "gpt-4o"}]
+
+
+def routing_tiers(subject: str):
+    # An empty list would ask nobody and leave /classify/ without an answer: use the default
+    tiers = [{**TIER_DEFAULTS, **tier} for tier in CLASSIFY_ROUTING_CONFIG.get(subject) or DEFAULT_TIERS]
+    for tier in tiers:
+        if tier["input"] not in ("image", "text"):
+            raise ValueError(f"Unknown routing input {tier['input']!r} for {subject}")
+        tier.setdefault("name", f"{tier['model']}/{tier['input']}" + (f"@{tier['max_side']}" if tier["max_side"] else ""))
+    return tiers
+
+
+def escalation_reason(result: dict, tier: dict, topic_votes):
+    """
+    Why a tier's answer isn't good enough to keep, or None if it is.
+    """
+    topics = result.get("topics") or []
+    if not topics:
+        return "no topics"
+    confidence = result.get("confidence")
+    if not isinstance(confidence, (int, float)) or confidence < tier["min_confidence"]:
+        return f"confidence {confidence}"
+    prior = {topic for topic, votes in topic_votes[:tier["agree_top"]] if votes > 0}
+    if prior and not prior & set(topics):
+        return "disagrees with the neighbours' top topics"
+    return None
+
+
+class RoutingStats:
+    """
+    Per-subject, per-tier calls, answers kept vs escalated, and latency.
+    """
+
+    def __init__(self):
+        self._tiers = {}
+        self._lock = threading.Lock()
+
+    def record(self, subject: str, tier: str, seconds: float, kept: bool):
+        with self._lock:
+            s = self._tiers.setdefault((subject, tier), {"calls": 0, "kept": 0, "total": 0.0, "max": 0.0})
+            s["calls"] += 1
+            s["kept"] += kept
+            s["total"] += seconds
+            s["max"] = max(s["max"], seconds)
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = {}
+            for (subject, tier), s in self._tiers.items():
+                out.setdefault(subject, {})[tier] = {
+                    "calls": s["calls"],
+                    "kept": s["kept"],
+                    "hit_rate": round(s["kept"] / s["calls"], 4),
+                    "latency_ms_mean": round(s["total"] * 1000 / s["calls"], 1),
+                    "latency_ms_max": round(s["max"] * 1000, 1),
+                }
+            return out
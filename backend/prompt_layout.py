@@ -0,0 +1,82 @@
+import threading
+
+# OpenAI caches prompt prefixes (1024+ tokens, in 128-token steps) and bills/serves the cached
+# part faster. A prefix only matches byte for byte, so every prompt is laid out as
+#   system text -> static blocks (rules, topic catalogue, output format) -> per-request blocks
+# with the static blocks built the same way every time for a given subject. Anything that
+# changes per request (OCR text, images, neighbour votes, retrieved examples) goes last.
+
+
+def chat_messages(system: str, static=(), variable=(), image_base64: str = None):
+    """
+    Chat Completions messages: one system message holding everything that repeats across
+    requests, then a user message with the per-request blocks and the image, if any.
+    """
+    content = [{"type": "text", "text": "\n\n".join(variable)}] if variable else []
+    if image_base64 is not None:
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}})
+    return [
+        {"role": "system", "content": "\n\n".join([system, *static])},
+        {"role": "user", "content": content},
+    ]
+
+
+def responses_input(system: str, static=(), variable=(), image_base64: str = None):
+    """
+    Same layout for the Responses API.
+    """
+    content = [{"type": "input_text", "text": "\n\n".join(variable)}] if variable else []
+    if image_base64 is not None:
+        content.append({"type": "input_image", "image_url": f"data:image/png;base64,{image_base64}"})
+    return [
+        {"role": "system", "content": [{"type": "input_text", "text": "\n\n".join([system, *static])}]},
+        {"role": "user", "content": content},
+    ]
+
+
+def prompt_tokens(usage):
+    """
+    (prompt tokens, cached prompt tokens) from a Chat Completions or Responses usage block.
+    """
+    if usage is None:
+        return 0, 0
+    details = getattr(usage, "prompt_tokens_details", None) or getattr(usage, "input_tokens_details", None)
+    total = getattr(usage, "prompt_tokens", None) or getattr(usage, "input_tokens", None) or 0
+    return total, (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+
+
+class PromptCacheStats:
+    """
+    Per-endpoint calls, prompt tokens, how many of them were served from the provider's
+    prompt cache, and call latency.
+    """
+
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, response, seconds: float):
+        total, cached = prompt_tokens(getattr(response, "usage", None))
+        print(f"🧊 {endpoint}: {cached}/{total} prompt tokens cached ({seconds * 1000:.0f} ms)")
+        with self._lock:
+            s = self._endpoints.setdefault(endpoint, {"calls": 0, "cached_calls": 0, "prompt_tokens": 0,
+                                                      "cached_tokens": 0, "total": 0.0})
+            s["calls"] += 1
+            s["cached_calls"] += cached > 0
+            s["prompt_tokens"] += total
+            s["cached_tokens"] += cached
+            s["total"] += seconds
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                endpoint: {
+                    "calls": s["calls"],
+                    "cached_calls": s["cached_calls"],
+                    "prompt_tokens": s["prompt_tokens"],
+                    "cached_tokens": s["cached_tokens"],
+                    "cached_share": round(s["cached_tokens"] / s["prompt_tokens"], 4) if s["prompt_tokens"] else 0.0,
+                    "latency_ms_mean": round(s["total"] * 1000 / s["calls"], 1),
+                }
+                for endpoint, s in self._endpoints.items()
+            }
@@ -0,0 +1,223 @@
+import os
+
+import faiss
+import numpy as np
+
+# Compressed vector storage for a store's FAISS index. Set per store in its index config
+# (VECTORSTORE_INDEX_CONFIG), e.g. {"quantization": "pq", "pq_m": 96, "rerank": 4}:
+#   "none"   -> float32, 4*d bytes per vector (6 KB at d=1536)
+#   "fp16"   -> float16 scalar quantization, 2*d bytes
+#   "sq8"    -> int8 scalar quantization, d bytes
+#   "pq"     -> product quantization, pq_m bytes (96 B by default)
+#   "binary" -> one bit per dimension, d/8 bytes (192 B), Hamming scan
+# Quantized stores keep their float32 vectors in vectors.npy next to the index, memory-mapped
+# rather than loaded, and re-rank the top k*rerank candidates with exact L2 distances.
+QUANTIZATION_MODES = ("none", "fp16", "sq8", "pq", "binary")
+DEFAULT_RERANK = {"none": 0, "fp16": 0, "sq8": 2, "pq": 4, "binary": 8}
+DEFAULT_PQ_M = 96
+
+# Trained codecs need enough vectors to learn ranges/thresholds/centroids from (PQ: 256
+# centroids per sub-quantizer, 39+ points each); smaller stores stay float32 until they grow
+PQ_MIN_TRAIN = 39 * 256
+MIN_TRAIN = {"none": 0, "fp16": 0, "sq8": 1000, "binary": 1000, "pq": PQ_MIN_TRAIN}
+# PQ runs one k-means per sub-quantizer, so the training sample bounds a one-off conversion
+QUANTIZER_TRAIN_POINTS = 16384
+
+VECTORS_FILE = "vectors.npy"
+
+
+def resolve_quantization(config: dict, d: int) -> dict:
+    """
+    {"mode", "rerank"[, "pq_m"]} for a store's index config (see ann_index.resolve_config).
+    """
+    mode = (config or {}).get("quantization", "none")
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization '{mode}'")
+    quant = {"mode": mode, "rerank": int((config or {}).get("rerank", DEFAULT_RERANK[mode]))}
+    if mode == "pq":
+        m = int((config or {}).get("pq_m", DEFAULT_PQ_M))
+        # Sub-quantizers must split the dimension evenly
+        while d % m:
+            m -= 1
+        quant["pq_m"] = m
+    return quant
+
+
+def effective_quantization(quant: dict, n: int) -> dict:
+    """
+    The quantization a store of n vectors can actually use right now.
+    """
+    if n < MIN_TRAIN[quant["mode"]]:
+        return {"mode": "none", "rerank": 0}
+    return quant
+
+
+def codec_factory(quant: dict) -> str:
+    """
+    The index_factory codec for a quantization (used after "IVF..," / "HNSW..," for ANN indexes).
+    """
+    return {
+        "none": "Flat", "fp16": "SQfp16", "sq8": "SQ8", "pq": f"PQ{quant.get('pq_m')}",
+    }[quant["mode"]]
+
+
+def _train_sample(vectors):
+    if len(vectors) <= QUANTIZER_TRAIN_POINTS:
+        return vectors
+    rng = np.random.RandomState(0)
+    return vectors[np.sort(rng.choice(len(vectors), QUANTIZER_TRAIN_POINTS, replace=False))]
+
+
+def new_codes_index(quant: dict, d: int, train_vectors):
+    """
+    Empty (trained) flat-codes index for a quantization: exhaustive scan over compressed
+    vectors, positions 0..ntotal-1 like IndexFlatL2.
+    """
+    if quant["mode"] == "binary":
+        # Threshold each dimension at its median rather than at 0, so bits carry information
+        # even if the embedding space isn't centred
+        index = faiss.IndexLSH(d, d, False, True)
+    else:
+        index = faiss.index_factory(d, codec_factory(quant))
+    if not index.is_trained:
+        index.train(np.ascontiguousarray(_train_sample(train_vectors), dtype="float32"))
+    return index
+
+
+def empty_codec(index):
+    """
+    Empty index with the same (trained) encoding as a flat-codes index, so codes from one
+    are valid in the other.
+    """
+    d, metric = index.d, index.metric_type
+    if isinstance(index, faiss.IndexFlat):
+        return faiss.IndexFlat(d, metric)
+    if isinstance(index, faiss.IndexLSH):
+        new = faiss.IndexLSH(d, index.nbits, index.rotate_data, index.train_thresholds)
+        new.thresholds = index.thresholds
+    elif isinstance(index, faiss.IndexPQ):
+        new = faiss.IndexPQ(d, index.pq.M, index.pq.nbits, metric)
+        new.pq.centroids = index.pq.centroids
+    elif isinstance(index, faiss.IndexScalarQuantizer):
+        new = faiss.IndexScalarQuantizer(d, index.sq.qtype, metric)
+        new.sq.trained = index.sq.trained
+    else:
+        raise ValueError(f"Unsupported index type {type(index).__name__}")
+    new.is_trained = True
+    return new
+
+
+def quantization_of(index) -> str:
+    """
+    Quantization mode of a flat-codes index built by new_codes_index.
+    """
+    # mapped_store.DeltaIndex: the mapped snapshot defines the encoding
+    index = getattr(index, "base", index)
+    if isinstance(index, faiss.IndexFlat):
+        return "none"
+    if isinstance(index, faiss.IndexLSH):
+        return "binary"
+    if isinstance(index, faiss.IndexPQ):
+        return "pq"
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return "fp16" if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    raise ValueError(f"Unsupported index type {type(index).__name__}")
+
+
+def same_quantization(index, quant: dict) -> bool:
+    index = getattr(index, "base", index)
+    mode = quantization_of(index)
+    if mode != quant["mode"]:
+        return False
+    return mode != "pq" or index.pq.M == quant["pq_m"]
+
+
+class ExactVectors:
+    """
+    float32 copies of a quantized store's vectors, keyed by docstore id, for re-ranking.
+
+    The bulk comes from the snapshot's vectors.npy, memory-mapped read-only so only the rows
+    a search re-ranks are ever paged in. Vectors added or replaced since the snapshot live in
+    a small in-memory overlay that the next snapshot writes out in full.
+    """
+
+    def __init__(self, d: int, quant: dict, base=None, base_ids=()):
+        self.d = d
+        self.quant = quant
+        self._base = base
+        self._row_by_id = {doc_id: row for row, doc_id in enumerate(base_ids)}
+        self._overlay = {}
+
+    @classmethod
+    def from_array(cls, d: int, quant: dict, ids, vectors) -> "ExactVectors":
+        exact = cls(d, quant)
+        for doc_id, vector in zip(ids, np.asarray(vectors, dtype="float32")):
+            exact._overlay[doc_id] = vector.copy()
+        return exact
+
+    @classmethod
+    def open(cls, folder, quant: dict, ids) -> "ExactVectors":
+        base = np.load(os.path.join(str(folder), VECTORS_FILE), mmap_mode="r")
+        if len(base) != len(ids):
+            raise ValueError(f"{VECTORS_FILE} has {len(base)} rows for {len(ids)} ids")
+        return cls(base.shape[1], quant, base, ids)
+
+    @property
+    def rerank(self) -> int:
+        return self.quant["rerank"]
+
+    def put(self, doc_ids, vectors):
+        vectors = np.asarray(vectors, dtype="float32").reshape(len(doc_ids), self.d)
+        for doc_id, vector in zip(doc_ids, vectors):
+            self._overlay[doc_id] = vector.copy()
+
+    def discard(self, doc_ids):
+        for doc_id in doc_ids:
+            self._overlay.pop(doc_id, None)
+            self._row_by_id.pop(doc_id, None)
+
+    def get(self, doc_ids):
+        out = np.empty((len(doc_ids), self.d), dtype="float32")
+        for i, doc_id in enumerate(doc_ids):
+            vector = self._overlay.get(doc_id)
+            out[i] = vector if vector is not None else self._base[self._row_by_id[doc_id]]
+        return out
+
+    def overlay_size(self) -> int:
+        return len(self._overlay)
+
+    def clone(self) -> "ExactVectors":
+        # The mmap is read-only, so a snapshot clone can share it
+        exact = ExactVectors(self.d, dict(self.quant), self._base)
+        exact._row_by_id = dict(self._row_by_id)
+        exact._overlay = dict(self._overlay)
+        return exact
+
+    def write(self, folder, ids, chunk: int = 4096) -> list:
+        """
+        Write vectors.npy for `ids` (vector position order) into a snapshot folder;
+        returns the file names (save_snapshot checksums them).
+        """
+        out = np.lib.format.open_memmap(
+            os.path.join(str(folder), VECTORS_FILE), mode="w+", dtype="float32", shape=(len(ids), self.d),
+        )
+        for start in range(0, len(ids), chunk):
+            out[start:start + chunk] = self.get(ids[start:start + chunk])
+        out.flush()
+        del out
+        return [VECTORS_FILE]
+
+    def describe(self, index) -> dict:
+        return {**self.quant, "bytes_per_vector": int(index.code_size)}
+
+
+def rerank(exact: ExactVectors, query, doc_ids, k: int):
+    """
+    (doc_ids, exact L2 distances) of the k candidates nearest to `query`.
+    """
+    if not doc_ids:
+        return [], np.empty(0, dtype="float32")
+    vectors = exact.get(doc_ids)
+    distances = ((vectors - np.asarray(query, dtype="float32").reshape(1, -1)) ** 2).sum(axis=1)
+    order = np.argsort(distances, kind="stable")[:k]
+    return [doc_ids[i] for i in order], distances[order]
@@ -9,7 +9,8 @@ def main():
             "MA-C3: Applications of Differentiation (Year 12)"
         ],
         exemplar_count=5,
-        temperature=0.5
+        temperature=0.5,
+        subject="Mathematics Advanced"
     )
 
     # Call the function directly
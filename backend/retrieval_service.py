@@ -0,0 +1,315 @@
+"""
+Standalone retrieval process: owns every subject's question and solution stores and serves
+them to the API workers over a local socket, so a host holds one copy of the indexes and all
+index writes go through one process (one WAL, one snapshot writer).
+
+    python retrieval_service.py                                   # listens on RETRIEVAL_ADDRESS
+    RETRIEVAL_ADDRESS=/tmp/hsc-retrieval.sock python3 -m uvicorn main:app --workers 4
+
+RETRIEVAL_ADDRESS is a Unix socket path, or host:port for localhost TCP. API workers that
+can't reach it at startup load the stores themselves (main.LocalRetrieval), as without it.
+
+Wire format, both directions: a frame is
+
+    u32 header length | u32 blob length | header (JSON) | blob
+
+Requests are {"op", ...arguments}; vectors travel in the blob as little-endian float32 with
+their shape in the header. Replies are {"ok": true, "result"} or {"ok": false, "error"}.
+"""
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import threading
+
+import thread_limits  # before numpy/faiss load, as in main.py
+import numpy as np
+from langchain_core.documents import Document
+
+RETRIEVAL_ADDRESS = os.getenv("RETRIEVAL_ADDRESS", "")
+# Seconds to wait on the sidecar before a request fails (connect and each reply)
+RETRIEVAL_TIMEOUT = float(os.getenv("RETRIEVAL_TIMEOUT", "30"))
+DEFAULT_ADDRESS = "/tmp/hsc-retrieval.sock"
+
+_FRAME = struct.Struct("!II")
+# Safe to resend after a dropped connection
+_READ_OPS = {"status", "search", "topic_votes", "predict_topics", "get", "contains", "lookup_text", "near_duplicate", "repeat_upload"}
+
+
+class RetrievalError(Exception):
+    """Raised when the retrieval service is unreachable or a request to it failed."""
+
+
+def _is_tcp(address: str) -> bool:
+    return ":" in address and not address.startswith("/")
+
+
+def _recv_exact(sock, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise EOFError("connection closed")
+        buf += chunk
+    return bytes(buf)
+
+
+def send_frame(sock, header: dict, blob: bytes = b""):
+    head = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    sock.sendall(_FRAME.pack(len(head), len(blob)) + head + blob)
+
+
+def recv_frame(sock):
+    """
+    (header, blob) of the next frame; EOFError once the peer has closed the connection.
+    """
+    head_len, blob_len = _FRAME.unpack(_recv_exact(sock, _FRAME.size))
+    header = json.loads(_recv_exact(sock, head_len))
+    return header, _recv_exact(sock, blob_len) if blob_len else b""
+
+
+def pack_vectors(vectors):
+    vectors = np.ascontiguousarray(vectors, dtype="<f4")
+    return list(vectors.shape), vectors.tobytes()
+
+
+def unpack_vectors(shape, blob: bytes):
+    return np.frombuffer(blob, dtype="<f4").reshape(shape)
+
+
+def _doc(pair) -> Document:
+    content, metadata = pair
+    return Document(page_content=content, metadata=metadata)
+
+
+class _RemoteIds:
+    # `question_id in ids` for generate_unique_question_id, one round trip per probe
+    def __init__(self, client, subject):
+        self._client, self._subject = client, subject
+
+    def __contains__(self, question_id) -> bool:
+        return self._client.call("contains", subject=self._subject, question_id=str(question_id))[0]
+
+
+class RemoteRetrieval:
+    """
+    Client for the retrieval service, with the same methods as main.LocalRetrieval. Each
+    thread keeps its own connection, so concurrent requests never share a socket.
+    """
+
+    def __init__(self, address: str, timeout: float = RETRIEVAL_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @classmethod
+    def connect(cls, address: str, timeout: float = RETRIEVAL_TIMEOUT):
+        """
+        A client if the service answers at `address`, else None.
+        """
+        client = cls(address, timeout)
+        try:
+            client.status()
+        except RetrievalError as e:
+            print(f"⚠️ Retrieval service at {address} unavailable ({e}), loading stores in-process")
+            return None
+        print(f"🔌 Using retrieval service at {address}")
+        return client
+
+    def _socket(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            if _is_tcp(self.address):
+                host, port = self.address.rsplit(":", 1)
+                sock = socket.create_connection((host, int(port)), timeout=self.timeout)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            else:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                sock.connect(self.address)
+            self._local.sock = sock
+        return sock
+
+    def _drop(self):
+        sock = getattr(self._local, "sock", None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def call(self, op: str, blob: bytes = b"", **args):
+        """
+        (result, blob) of one request.
+        """
+        attempts = 2 if op in _READ_OPS else 1
+        for attempt in range(attempts):
+            try:
+                sock = self._socket()
+                send_frame(sock, {"op": op, **args}, blob)
+                header, reply = recv_frame(sock)
+                break
+            except (OSError, EOFError) as e:
+                # A pooled connection may have been closed by a service restart; reads retry once
+                self._drop()
+                if attempt == attempts - 1:
+                    raise RetrievalError(f"{op} failed: {e}")
+        if not header.get("ok"):
+            raise RetrievalError(header.get("error", "unknown error"))
+        return header.get("result"), reply
+
+    def close(self):
+        self._drop()
+
+    def status(self) -> dict:
+        return self.call("status")[0]
+
+    def search(self, key: str, vectors, k: int):
+        shape, blob = pack_vectors(vectors)
+        result, _ = self.call("search", blob, key=key, k=k, shape=shape)
+        return [[(_doc(pair), distance) for *pair, distance in hits] for hits in result]
+
+    def topic_votes(self, subject: str, vectors):
+        shape, blob = pack_vectors(vectors)
+        result, _ = self.call("topic_votes", blob, subject=subject, shape=shape)
+        return [{**vote, "topics": [tuple(t) for t in vote["topics"]]} for vote in result]
+
+    def predict_topics(self, subject: str, vectors):
+        shape, blob = pack_vectors(vectors)
+        result, _ = self.call("predict_topics", blob, subject=subject, shape=shape)
+        return [tuple(p) for p in result] if result is not None else None
+
+    def get(self, subject: str, question_id):
+        result, _ = self.call("get", subject=subject, question_id=str(question_id))
+        return _doc(result) if result is not None else None
+
+    def known_ids(self, subject: str):
+        return _RemoteIds(self, subject)
+
+    def lookup_text(self, subject: str, text: str):
+        return self.call("lookup_text", subject=subject, text=text)[0]
+
+    def near_duplicate(self, subject: str, text: str):
+        result = self.call("near_duplicate", subject=subject, text=text)[0]
+        return tuple(result) if result is not None else None
+
+    def repeat_upload(self, subject: str, phash: str):
+        result = self.call("repeat_upload", subject=subject, phash=phash)[0]
+        return [(question_id, distance, _doc(doc)) for question_id, distance, doc in result]
+
+    def add(self, subject: str, docs, vectors) -> int:
+        shape, blob = pack_vectors(vectors)
+        docs = [[d.page_content, d.metadata] for d in docs]
+        return self.call("add", blob, subject=subject, docs=docs, shape=shape)[0]
+
+    def upsert(self, subject: str, entries, embedded: dict) -> dict:
+        texts = list(embedded)
+        shape, blob = pack_vectors([embedded[t] for t in texts] if texts else np.zeros((0, 0)))
+        entries = [[str(qid), text, metadata] for qid, text, metadata in entries]
+        return self.call("upsert", blob, subject=subject, entries=entries, texts=texts, shape=shape)[0]
+
+    def delete(self, subject: str, question_ids) -> int:
+        return self.call("delete", subject=subject, question_ids=[str(q) for q in question_ids])[0]
+
+
+def dispatch(retrieval, header: dict, blob: bytes):
+    """
+    Run one request against a main.LocalRetrieval; returns the JSON-able result.
+    """
+    op = header["op"]
+    if op == "status":
+        return retrieval.status()
+    if op == "search":
+        hits = retrieval.search(header["key"], unpack_vectors(header["shape"], blob), header["k"])
+        return [[[doc.page_content, doc.metadata, distance] for doc, distance in row] for row in hits]
+    if op == "topic_votes":
+        return retrieval.topic_votes(header["subject"], unpack_vectors(header["shape"], blob))
+    if op == "predict_topics":
+        return retrieval.predict_topics(header["subject"], unpack_vectors(header["shape"], blob))
+    if op == "get":
+        doc = retrieval.get(header["subject"], header["question_id"])
+        return [doc.page_content, doc.metadata] if doc is not None else None
+    if op == "contains":
+        return header["question_id"] in retrieval.known_ids(header["subject"])
+    if op == "lookup_text":
+        return retrieval.lookup_text(header["subject"], header["text"])
+    if op == "near_duplicate":
+        return retrieval.near_duplicate(header["subject"], header["text"])
+    if op == "repeat_upload":
+        return [
+            [question_id, distance, [doc.page_content, doc.metadata]]
+            for question_id, distance, doc in retrieval.repeat_upload(header["subject"], header["phash"])
+        ]
+    if op == "add":
+        docs = [_doc(pair) for pair in header["docs"]]
+        return retrieval.add(header["subject"], docs, unpack_vectors(header["shape"], blob))
+    if op == "upsert":
+        vectors = unpack_vectors(header["shape"], blob)
+        entries = [tuple(entry) for entry in header["entries"]]
+        return retrieval.upsert(header["subject"], entries, dict(zip(header["texts"], vectors)))
+    if op == "delete":
+        return retrieval.delete(header["subject"], header["question_ids"])
+    raise ValueError(f"Unknown op {op!r}")
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # One connection per client thread, many requests per connection
+        while True:
+            try:
+                header, blob = recv_frame(self.request)
+            except (EOFError, OSError):
+                return
+            try:
+                reply = {"ok": True, "result": dispatch(self.server.retrieval, header, blob)}
+            except Exception as e:
+                reply = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            send_frame(self.request, reply)
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(address: str = None):
+    """
+    Load every store, then serve them at `address` until SIGINT/SIGTERM, and flush
+    pending snapshots on the way out.
+    """
+    import main as app  # the stores, warmup and write-behind persister all live in main.py
+
+    address = address or RETRIEVAL_ADDRESS or DEFAULT_ADDRESS
+    if _is_tcp(address):
+        host, port = address.rsplit(":", 1)
+        server = _TCPServer((host, int(port)), _Handler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)  # left behind by a previous run
+        server = _UnixServer(address, _Handler)
+    server.retrieval = app.LocalRetrieval()
+
+    # Listen straight away: clients see pending/loading in status() and get 503s until ready
+    thread_limits.apply_thread_limits()
+    warmup = threading.Thread(target=app.warm_up, name="warmup", daemon=True)
+    warmup.start()
+    app.persister.start()
+    stop = lambda *_: threading.Thread(target=server.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"📡 Retrieval service listening on {address}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        app.persister.stop()
+        if not _is_tcp(address) and os.path.exists(address):
+            os.remove(address)
+
+
+if __name__ == "__main__":
+    serve()
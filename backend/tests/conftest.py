@@ -0,0 +1,66 @@
+import hashlib
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# The backend modules import each other as top-level modules (uvicorn runs from backend/)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+D = 16
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Deterministic unit vectors seeded from the text, so nothing calls the OpenAI API.
+    """
+
+    def __init__(self, d: int = D):
+        self.d = d
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+        vector = np.random.RandomState(seed).randn(self.d)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+def unit_vectors(n: int, d: int = D, seed: int = 0):
+    vectors = np.random.RandomState(seed).randn(n, d).astype("float32")
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def question_docs(n: int, topics=lambda i: []):
+    return [
+        Document(page_content=f"question {i}", metadata={"question_id": f"q{i}", "topics": topics(i)})
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def embeddings():
+    return HashEmbeddings()
+
+
+@pytest.fixture
+def make_index(embeddings):
+    """
+    make_index(n) -> (QuestionIndex over a fresh flat store holding q0..q{n-1}, their vectors).
+    """
+    from vectorstore_utils import empty_vectorstore, QuestionIndex
+
+    def make(n: int, seed: int = 0, **kwargs):
+        vs = empty_vectorstore(embeddings, D)
+        qindex = QuestionIndex(vs, **kwargs)
+        docs = question_docs(n)
+        vectors = unit_vectors(n, seed=seed)
+        qindex.add(docs, embedded={doc.page_content: vector for doc, vector in zip(docs, vectors)})
+        return qindex, vectors
+
+    return make
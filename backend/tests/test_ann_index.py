@@ -0,0 +1,135 @@
+import numpy as np
+import pytest
+
+import ann_index
+from ann_index import AnnIndex, build_ann, read_ann, resolve_config, same_structure
+from conftest import unit_vectors
+
+HNSW = {"type": "hnsw", "M": 16, "ef_construction": 100, "ef_search": 64}
+
+
+def exact(vectors, live, query, k):
+    """
+    The k nearest live positions to query, by brute force.
+    """
+    live = np.array(sorted(live))
+    distances = ((vectors[live] - query) ** 2).sum(axis=1)
+    return live[np.argsort(distances, kind="stable")[:k]].tolist()
+
+
+def test_auto_picks_the_type_by_corpus_size():
+    assert resolve_config({"type": "auto"}, ann_index.ANN_AUTO_FLAT_MAX)["type"] == "flat"
+    assert resolve_config({}, ann_index.ANN_AUTO_FLAT_MAX + 1)["type"] == "ivf"
+    assert resolve_config(None, ann_index.ANN_AUTO_IVF_MAX)["type"] == "ivf"
+    hnsw = resolve_config({"type": "auto"}, ann_index.ANN_AUTO_IVF_MAX + 1)
+    assert hnsw == {"type": "hnsw", "M": 32, "ef_construction": 200, "ef_search": 256}
+    # 1-bit codes stay flat at any size
+    assert resolve_config({"quantization": "binary"}, 10 ** 7)["type"] == "flat"
+
+
+def test_nlist_is_clamped_to_the_training_points():
+    # At least 39 training points per list
+    assert resolve_config({"type": "ivf", "nlist": 1024}, 10000)["nlist"] == 10000 // 39
+    assert resolve_config({"type": "ivf"}, 10 ** 6) == {"type": "ivf", "nlist": 4000, "nprobe": 250}
+    assert resolve_config({"type": "ivf", "nlist": 64, "nprobe": 8}, 10 ** 6) == {"type": "ivf", "nlist": 64, "nprobe": 8}
+    assert resolve_config({"type": "ivf"}, 10)["nlist"] == 1
+
+
+def test_bad_configs_raise():
+    for kind in ("ivf", "hnsw"):
+        with pytest.raises(ValueError, match="Binary quantization"):
+            resolve_config({"type": kind, "quantization": "binary"}, 10 ** 6)
+    with pytest.raises(ValueError, match="Unknown index type"):
+        resolve_config({"type": "lsh"}, 100)
+
+
+def test_same_structure():
+    ivf = resolve_config({"type": "ivf", "nlist": 64}, 10 ** 6)
+    assert same_structure(ivf, {**ivf, "nprobe": 1})
+    assert not same_structure(ivf, {**ivf, "nlist": 32})
+    assert not same_structure(ivf, {**ivf, "quantization": "sq8"})
+    assert same_structure(HNSW, {**HNSW, "ef_search": 512})
+    assert not same_structure(HNSW, {**HNSW, "M": 32}) and not same_structure(HNSW, ivf)
+
+
+def test_add_remove_move_keep_tombstones():
+    vectors = unit_vectors(10)
+    ann = AnnIndex.build(HNSW, vectors)
+    assert (len(ann), ann.tombstones, ann.needs_rebuild()) == (10, 0, False)
+
+    ann.remove(3)
+    ann.remove(3)  # already gone: not a second tombstone
+    assert (len(ann), ann.tombstones) == (9, 1)
+
+    # Replacing a position tombstones its old label and appends a new one
+    ann.add([2], unit_vectors(1, seed=5))
+    assert (len(ann), ann.tombstones, ann.index.ntotal) == (9, 2, 11)
+    assert ann._label_by_position[2] == 10 and ann._positions[2] == -1 and ann._positions[10] == 2
+
+    # A delete swapped the last position (9) into the hole at 3: same label, new position
+    ann.move(9, 3)
+    assert ann._label_by_position[3] == 9 and 9 not in ann._label_by_position
+    assert (len(ann), ann.tombstones) == (9, 2)
+    # Moving onto a live position replaces it
+    ann.move(8, 0)
+    assert (len(ann), ann.tombstones) == (8, 3) and ann._label_by_position[0] == 8
+
+    assert ann.needs_rebuild()  # 3 tombstones > 20% of 8 live labels
+    # A new position past the end grows the label table
+    ann.add(list(range(10, 40)), unit_vectors(30, seed=6))
+    assert (len(ann), ann.tombstones, ann.needs_rebuild()) == (38, 3, False)
+
+
+@pytest.mark.parametrize("config", [HNSW, {"type": "ivf", "nlist": 2, "nprobe": 2}])
+def test_search_never_returns_tombstones(config):
+    vectors = unit_vectors(100)
+    ann = build_ann(config, vectors)
+    removed = set(range(0, 100, 3))
+    for pos in removed:
+        ann.remove(pos)
+    live = set(range(100)) - removed
+
+    # Queries right at removed vectors: their own (dead) labels are the nearest
+    distances, positions = ann.search(vectors[sorted(removed)], 5)
+    assert not removed & set(positions.ravel().tolist())
+    for query, found, found_d in zip(vectors[sorted(removed)], positions, distances):
+        assert found.tolist() == exact(vectors, live, query, 5)
+        np.testing.assert_allclose(found_d, ((vectors[found] - query) ** 2).sum(axis=1), atol=1e-5)
+
+    # More than is left: padded with -1 / inf
+    distances, positions = ann.search(vectors[:1], 80)
+    assert (positions[0, len(live):] == -1).all() and np.isinf(distances[0, len(live):]).all()
+    assert sorted(positions[0, :len(live)].tolist()) == sorted(live)
+
+
+def test_build_ann_skips_small_or_flat_stores():
+    vectors = unit_vectors(100)
+    assert build_ann({"type": "flat"}, vectors) is None
+    assert build_ann({"type": "ivf", "nlist": 4, "nprobe": 1}, vectors[:155]) is None  # < 39 * 4
+    assert build_ann({**HNSW, "quantization": "sq8"}, vectors) is None  # < MIN_TRAIN["sq8"]
+    assert isinstance(build_ann(HNSW, vectors), AnnIndex)
+
+
+def test_read_ann_round_trip_and_mismatch(tmp_path):
+    vectors = unit_vectors(100)
+    config = resolve_config({"type": "ivf", "nlist": 2}, len(vectors))
+    ann = build_ann(config, vectors)
+    ann.remove(7)
+    ann.add([5], unit_vectors(1, seed=3))
+    files = ann.write(tmp_path)
+    assert sorted(files) == sorted([ann_index.ANN_INDEX_FILE, ann_index.ANN_POSITIONS_FILE])
+    manifest = {"ann": ann.describe()}
+    assert manifest["ann"]["labels"] == 101 and manifest["ann"]["tombstones"] == 2
+
+    # Search-only params may differ
+    loaded = read_ann(tmp_path, manifest, {**config, "nprobe": 1})
+    assert loaded is not None and loaded.config["nprobe"] == 1
+    assert (len(loaded), loaded.tombstones) == (len(ann), ann.tombstones)
+    assert loaded._label_by_position == ann._label_by_position
+
+    assert read_ann(tmp_path, manifest, {**config, "nlist": 4}) is None
+    assert read_ann(tmp_path, manifest, HNSW) is None
+    assert read_ann(tmp_path, {}, config) is None
+    # Positions that don't match the saved index (a torn write): rebuild instead
+    np.save(tmp_path / ann_index.ANN_POSITIONS_FILE, ann._positions[:50])
+    assert read_ann(tmp_path, manifest, config) is None
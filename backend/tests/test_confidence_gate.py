@@ -0,0 +1,99 @@
+import math
+
+import numpy as np
+import pytest
+
+import confidence_gate
+from confidence_gate import confidence, decide, evaluate, gate_config, GateStats, GATE_DEFAULTS
+from conftest import D, HashEmbeddings, question_docs
+from topic_votes import TopicMatrix
+from vectorstore_utils import empty_vectorstore, QuestionIndex
+
+
+def vote(consensus=("A-1: Alpha",), voters=8, margin=0.8, similarity=0.9):
+    return {"consensus": list(consensus), "voters": voters, "margin": margin, "similarity": similarity}
+
+
+def config(**overrides):
+    return {**GATE_DEFAULTS, "threshold": 0.6, **overrides}
+
+
+def test_confidence_is_the_margin_of_a_well_backed_consensus():
+    assert confidence(vote(), config()) == 0.8
+    assert confidence(vote(consensus=()), config()) == 0.0
+    assert confidence(vote(voters=4), config(min_voters=5)) == 0.0
+    assert confidence(vote(voters=5), config(min_voters=5)) == 0.8
+    assert confidence(vote(similarity=0.49), config(min_similarity=0.5)) == 0.0
+
+
+def test_decide():
+    assert decide(vote(margin=0.6), config()) == ["A-1: Alpha"]
+    assert decide(vote(margin=0.59), config()) is None
+    assert decide(vote(voters=1), config()) is None
+    # No threshold for the subject: always GPT
+    assert decide(vote(margin=1.0), config(threshold=None)) is None
+
+
+def test_gate_config_per_subject(monkeypatch):
+    monkeypatch.setattr(confidence_gate, "CONFIDENCE_GATE_CONFIG", {"Biology": {"threshold": 0.7, "min_voters": 3}})
+    assert gate_config("Biology") == {**GATE_DEFAULTS, "threshold": 0.7, "min_voters": 3}
+    assert gate_config("Chemistry") == GATE_DEFAULTS
+
+
+def test_gate_stats():
+    stats = GateStats()
+    for source in ("model", "neighbours", "neighbours", "gpt"):
+        stats.record("Biology", source)
+    stats.record("Chemistry", "gpt")
+    assert stats.stats() == {
+        "Biology": {"model": 1, "neighbours": 2, "gpt": 1, "skip_rate": 0.75},
+        "Chemistry": {"model": 0, "neighbours": 0, "gpt": 1, "skip_rate": 0.0},
+    }
+
+
+@pytest.fixture
+def clustered():
+    """
+    Store of two tight clusters tagged "A-1: Alpha" (q0-q5) and "B-1: Beta" (q6-q11), plus q12
+    on its own, and the matrix of their topics.
+    """
+    rng = np.random.RandomState(0)
+    centers = np.eye(D, dtype="float32")[:3]
+    vectors = np.concatenate([
+        centers[0] + 0.05 * rng.normal(size=(6, D)),
+        centers[1] + 0.05 * rng.normal(size=(6, D)),
+        centers[2:3],
+    ]).astype("float32")
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    docs = question_docs(13, topics=lambda i: ["A-1: Alpha"] if i < 6 or i == 12 else ["B-1: Beta"])
+
+    matrix = TopicMatrix()
+    qindex = QuestionIndex(empty_vectorstore(HashEmbeddings(), D), observers=[matrix])
+    qindex.add(docs, embedded={doc.page_content: v for doc, v in zip(docs, vectors)})
+    return qindex.vs, matrix
+
+
+def test_evaluate_leave_one_out(clustered):
+    vs, matrix = clustered
+    truth = {f"q{i}": {"A-1"} if i < 6 or i == 12 else {"B-1"} for i in range(13)}
+    truth["q0"] = {"B-1"}  # mislabelled: its neighbours say A-1
+
+    rows = evaluate(vs, matrix, truth, config(min_voters=5), k=5, thresholds=[0.0, 0.5, 1.01])
+
+    # Every question's consensus is taken at 0; q12 has no close neighbours, so it scores 0 and
+    # is dropped by any positive threshold; the twelve clustered ones are unanimous
+    (t0, skip0, precision0, n0), (t1, skip1, precision1, n1), (t2, skip2, precision2, n2) = rows
+    assert (t0, n0, skip0) == (0.0, 13, 1.0)
+    assert (t1, n1) == (0.5, 12) and skip1 == pytest.approx(12 / 13)
+    assert precision1 == pytest.approx(11 / 12)
+    assert (t2, n2, skip2) == (1.01, 0, 0.0) and math.isnan(precision2)
+
+
+def test_evaluate_only_scores_questions_with_known_topics(clustered):
+    vs, matrix = clustered
+    truth = {f"q{i}": {"B-1"} for i in range(6, 12)}
+    (_, skip, precision, n), = evaluate(vs, matrix, truth, config(), k=5, thresholds=[0.5])
+    assert (skip, precision, n) == (1.0, 1.0, 6)
+
+    (_, _, _, n), = evaluate(vs, matrix, truth, config(), k=5, thresholds=[0.0], sample=4)
+    assert n == 4
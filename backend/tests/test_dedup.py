@@ -0,0 +1,157 @@
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from PIL import Image, ImageDraw
+
+from dedup_utils import (
+    image_dhash, page_change, ExactTextIndex, MinHashLSHIndex, PerceptualHashIndex,
+    PHASH_CONFIRM_MAX_CHANGE, PHASH_MAX_DISTANCE, text_fingerprint,
+)
+
+# A4 at 100 dpi, and a preview 248 px across like main.py's 30 dpi one
+PAGE = (827, 1170)
+PREVIEW_SCALE = 0.3
+
+
+def exam_page(seed: int, lines: int = 2):
+    """
+    White page with the same header and footer every time and `lines` of "words" that
+    depend on the seed: two questions printed on one exam template.
+    """
+    rng = np.random.RandomState(seed)
+    page = Image.new("L", PAGE, 255)
+    draw = ImageDraw.Draw(page)
+    draw.rectangle([75, 50, 750, 65], fill=0)
+    for x in range(75, 450, 30):
+        draw.rectangle([x, 30, x + 22, 45], fill=40)
+    draw.rectangle([75, 1100, 750, 1105], fill=0)
+    y = 100
+    for _ in range(lines):
+        x = 75
+        while x < 725:
+            width = rng.randint(10, 60)
+            draw.rectangle([x, y, x + width, y + 14], fill=int(rng.randint(0, 60)))
+            x += width + rng.randint(8, 15)
+        y += 25
+    return page.convert("RGB")
+
+
+def preview_of(page, noise: int = 0, seed: int = 0):
+    preview = page.resize((round(PAGE[0] * PREVIEW_SCALE), round(PAGE[1] * PREVIEW_SCALE)), Image.BOX)
+    if noise:
+        pixels = np.asarray(preview, dtype=np.int16)
+        pixels += np.random.RandomState(seed).randint(-noise, noise + 1, size=pixels.shape)
+        preview = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    return preview
+
+
+def distance(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def stored(question_id, text="", **metadata):
+    return Document(page_content=text, metadata={"question_id": question_id, **metadata})
+
+
+@pytest.fixture(scope="module")
+def pages():
+    return [exam_page(seed) for seed in range(8)]
+
+
+def confirmed(index, pages_by_qid, preview):
+    # What main.confirm_repeat does with the stored images
+    for qid, _ in index.matches(image_dhash(preview)):
+        if page_change(preview, pages_by_qid[qid]) <= PHASH_CONFIRM_MAX_CHANGE:
+            return qid
+    return None
+
+
+def test_repeat_upload_is_found_and_confirmed(pages):
+    index = PerceptualHashIndex()
+    for i, page in enumerate(pages):
+        index.on_add(f"q{i}", stored(f"q{i}", phash=image_dhash(page)))
+    by_qid = {f"q{i}": page for i, page in enumerate(pages)}
+
+    for i, page in enumerate(pages):
+        preview = preview_of(page, noise=8, seed=i)
+        assert distance(image_dhash(preview), image_dhash(page)) <= PHASH_MAX_DISTANCE
+        assert page_change(preview, page) <= PHASH_CONFIRM_MAX_CHANGE
+        assert confirmed(index, by_qid, preview) == f"q{i}"
+
+
+def test_same_template_pages_collide_but_are_not_confirmed(pages):
+    # The 64-bit dHash can't tell these apart, which is why hits are confirmed
+    collisions = 0
+    for i, page in enumerate(pages):
+        for j, other in enumerate(pages):
+            if i == j:
+                continue
+            preview = preview_of(page)
+            collisions += distance(image_dhash(preview), image_dhash(other)) <= PHASH_MAX_DISTANCE
+            assert page_change(preview, other) > PHASH_CONFIRM_MAX_CHANGE
+    assert collisions > 0
+
+    index = PerceptualHashIndex()
+    index.on_add("other", stored("other", phash=image_dhash(pages[0])))
+    for page in pages[1:]:
+        assert confirmed(index, {"other": pages[0]}, preview_of(page)) is None
+
+
+def test_page_change_of_different_shapes():
+    page = exam_page(0)
+    spread = Image.new("RGB", (PAGE[0] * 2, PAGE[1]), "white")
+    assert page_change(page, spread) == 1.0
+    blank = Image.new("RGB", PAGE, "white")
+    assert page_change(blank, blank.copy()) == 0.0
+
+
+def test_phash_index_matches_nearest_first():
+    index = PerceptualHashIndex(max_distance=4)
+    base = 0x0123456789ABCDEF
+    index.on_add("exact", stored("exact", phash=f"{base:016x}"))
+    index.on_add("two", stored("two", phash=f"{base ^ 0b101:016x}"))
+    index.on_add("far", stored("far", phash=f"{base ^ 0xFF:016x}"))
+    index.on_add("no-hash", stored("no-hash", phash=""))
+
+    assert index.matches(f"{base:016x}") == [("exact", 0), ("two", 2)]
+    assert index.query(f"{base ^ 1:016x}") == ("exact", 1)
+
+    index.on_remove("exact")
+    assert index.query(f"{base:016x}") == ("two", 2)
+    assert len(index) == 2
+
+
+def test_exact_text_index_normalizes_ocr():
+    index = ExactTextIndex()
+    index.on_add("q1", stored("q1", "Differ-\nentiate  f(x) = x²  ‘twice’"))
+    assert index.lookup("differentiate f(x)=x² 'twice'") == "q1"
+    assert index.lookup("   ") is None
+    index.on_remove("q1")
+    assert index.lookup("differentiate f(x)=x² 'twice'") is None
+
+
+def test_exact_text_index_follows_re_adds():
+    index = ExactTextIndex()
+    index.on_add("q1", stored("q1", "Find x."))
+    index.on_add("q2", stored("q2", "find  x."))
+    # Same text again (a retag): still one entry
+    index.on_add("q1", stored("q1", "Find x."))
+    assert index._qids_by_hash[text_fingerprint("Find x.")] == ["q2", "q1"]
+
+    # New text: the old fingerprint no longer points at q1
+    index.on_add("q1", stored("q1", "Solve for y."))
+    assert index.lookup("Find x.") == "q2" and index.lookup("solve for y.") == "q1"
+    assert len(index) == 2 and len(index._qids_by_hash) == 2
+
+    # Re-added with blank OCR text: nothing left to match
+    index.on_add("q2", stored("q2", "  "))
+    assert index.lookup("Find x.") is None and len(index) == 1
+
+
+def test_minhash_finds_rescans_only():
+    index = MinHashLSHIndex()
+    text = "Find the area enclosed between the curve y = x^2 and the line y = 4 for 0 <= x <= 2."
+    index.on_add("q1", stored("q1", text))
+    qid, similarity = index.query(text.replace("area", "arca"))
+    assert qid == "q1" and similarity >= index.threshold
+    assert index.query("Describe the role of enzymes in the digestion of proteins.") is None
@@ -0,0 +1,108 @@
+import asyncio
+import threading
+
+import pytest
+
+from conftest import HashEmbeddings
+from embedding_cache import CachedEmbeddings
+
+MODEL = "test-embeddings"
+
+
+class CountingEmbeddings(HashEmbeddings):
+    def __init__(self):
+        super().__init__()
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [super(CountingEmbeddings, self).embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        self.embedded.append(text)
+        return super().embed_query(text)
+
+    async def aembed_documents(self, texts):
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text):
+        return self.embed_query(text)
+
+
+def test_async_paths_stay_off_the_event_loop(tmp_path):
+    built_on = []
+
+    def factory():
+        built_on.append(threading.get_ident())
+        return CountingEmbeddings()
+
+    cache = CachedEmbeddings(factory, MODEL, path=tmp_path / "embeddings.sqlite3")
+    sqlite_threads = []
+    for name in ("_lookup", "_put_many"):
+        method = getattr(cache, name)
+        setattr(cache, name, lambda *args, method=method: (sqlite_threads.append(threading.get_ident()), method(*args))[1])
+
+    async def run():
+        first = await cache.aembed_query("question")
+        again = await cache.aembed_documents(["question", "another  question", "another question"])
+        return threading.get_ident(), first, again
+
+    loop_thread, first, again = asyncio.run(run())
+    # lookup + put for each call, and the lazily-built client, all in worker threads
+    assert len(sqlite_threads) == 4 and len(built_on) == 1
+    assert loop_thread not in sqlite_threads + built_on
+    assert again[0] == pytest.approx(first) and again[1] == again[2]
+    assert cache.underlying.embedded == ["question", "another  question"]
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_cached_across_instances(tmp_path):
+    path = tmp_path / "embeddings.sqlite3"
+    first = CachedEmbeddings(CountingEmbeddings(), MODEL, path=path)
+    vectors = first.embed_documents(["a", "b", "a "])
+    assert first.underlying.embedded == ["a", "b"] and vectors[0] == vectors[2]
+
+    # Another process (or a restart) reads the same file; another model doesn't share entries
+    again = CachedEmbeddings(CountingEmbeddings(), MODEL, path=path)
+    b, a = again.embed_documents(["b", "a"])
+    assert b == pytest.approx(vectors[1]) and a == pytest.approx(vectors[0])
+    assert again.underlying.embedded == [] and again.stats()["entries"] == 2
+    other = CachedEmbeddings(CountingEmbeddings(), "other-model", path=path)
+    other.embed_query("a")
+    assert other.underlying.embedded == ["a"]
+
+
+def test_eviction_keeps_a_running_count(tmp_path):
+    cache = CachedEmbeddings(CountingEmbeddings(), MODEL, path=tmp_path / "embeddings.sqlite3", max_entries=10)
+    statements = []
+    cache._conn.set_trace_callback(statements.append)
+
+    for i in range(10):
+        cache.embed_query(f"text {i}")
+    # Already there: not counted twice
+    cache._put_many([(cache._key("text 0"), cache.embed_query("text 0"))])
+    assert cache._entries == 10 and cache.evictions == 0
+    assert not [s for s in statements if "COUNT(*)" in s]
+
+    # One over the cap: down to 90%, least recently used first
+    cache.embed_query("text 0")
+    cache.embed_query("text 10")
+    assert cache.evictions == 2 and cache._entries == 9 == cache.stats()["entries"]
+    assert cache.underlying.embedded.count("text 0") == 1
+    cache.embed_query("text 1")
+    assert cache.underlying.embedded.count("text 1") == 2
+
+
+def test_recounts_what_other_workers_added(tmp_path, monkeypatch):
+    import embedding_cache
+    monkeypatch.setattr(embedding_cache, "RECOUNT_EVERY", 3)
+    path = tmp_path / "embeddings.sqlite3"
+    ours = CachedEmbeddings(CountingEmbeddings(), MODEL, path=path, max_entries=10)
+    theirs = CachedEmbeddings(CountingEmbeddings(), MODEL, path=path, max_entries=10)
+
+    theirs.embed_documents([f"theirs {i}" for i in range(10)])
+    ours.embed_query("ours 0")
+    ours.embed_query("ours 1")
+    assert ours._entries == 2
+    ours.embed_query("ours 2")
+    assert ours.evictions == 4 and ours.stats()["entries"] == 9
@@ -0,0 +1,131 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import llm_cache
+from llm_cache import cache_mode, LLMResponseCache, request_key
+
+POLICY = {
+    "solution": {"enabled": True, "ttl": None},
+    "diagram": {"enabled": True, "ttl": 60},
+    "revamp": {"enabled": False, "ttl": None},
+}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return LLMResponseCache(path=tmp_path / "responses.sqlite3", max_entries=10, policy=POLICY)
+
+
+class FakeAPI:
+    """
+    An api(**request) that answers "answer 1", "answer 2", ... and remembers what it was asked.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    async def __call__(self, **request):
+        self.requests.append(request)
+        return SimpleNamespace(output_text=f"answer {len(self.requests)}")
+
+
+def call(cache, api, endpoint="solution", mode="use", **request):
+    request = request or {"model": "gpt-4o", "input": "Find x."}
+    return asyncio.run(cache.call(endpoint, api, lambda r: r.output_text, mode, **request))
+
+
+def test_cache_mode():
+    assert cache_mode(None) == cache_mode("") == cache_mode("max-age=0") == "use"
+    assert cache_mode("no-cache") == cache_mode("No-Cache, max-age=0") == "refresh"
+    assert cache_mode("no-store") == cache_mode("no-cache, no-store") == "off"
+
+
+def test_request_key():
+    request = {"model": "gpt-4o", "input": [{"role": "user", "content": "Find x."}], "temperature": 0}
+    assert request_key(request) == request_key(dict(reversed(list(request.items()))))
+    assert request_key(request) != request_key({**request, "temperature": 0.2})
+
+
+def test_only_enabled_endpoints_are_cached(cache):
+    assert cache.enabled("solution") and not cache.enabled("revamp") and not cache.enabled("unknown")
+    api = FakeAPI()
+    assert call(cache, api) == "answer 1"
+    assert call(cache, api) == "answer 1"
+    assert call(cache, api, model="gpt-4o-mini", input="Find x.") == "answer 2"
+    assert call(cache, api, endpoint="revamp") == "answer 3"
+    assert call(cache, api, endpoint="revamp") == "answer 4"
+    assert len(api.requests) == 4
+
+    assert cache.stats()["endpoints"] == {
+        "solution": {"hits": 1, "misses": 2, "hit_rate": 0.3333, "entries": 2},
+    }
+
+
+def test_policy_from_config(monkeypatch):
+    import importlib
+    monkeypatch.setenv("LLM_CACHE_CONFIG", '{"generate_diagram": {"enabled": false}, "revamp": {"ttl": 5}}')
+    try:
+        policy = importlib.reload(llm_cache).LLM_CACHE_POLICY
+        assert policy["generate_diagram"] == {"enabled": False, "ttl": 7 * 86400}
+        assert policy["revamp"] == {"enabled": True, "ttl": 5}
+        assert policy["extract_question_text"] == {"enabled": True, "ttl": None}
+    finally:
+        monkeypatch.delenv("LLM_CACHE_CONFIG")
+        importlib.reload(llm_cache)
+
+
+def test_no_cache_asks_again_and_stores(cache):
+    api = FakeAPI()
+    call(cache, api)
+    assert call(cache, api, mode="refresh") == "answer 2"
+    # The refreshed answer replaced the old one
+    assert call(cache, api) == "answer 2"
+    assert len(api.requests) == 2 and cache.stats()["endpoints"]["solution"]["entries"] == 1
+
+
+def test_no_store_leaves_the_cache_alone(cache):
+    api = FakeAPI()
+    assert call(cache, api, mode="off") == "answer 1"
+    assert cache.stats()["endpoints"] == {}
+    call(cache, api)
+    assert call(cache, api, mode="off") == "answer 3"
+    assert call(cache, api) == "answer 2"
+
+
+def test_ttl_expiry(cache, monkeypatch):
+    api = FakeAPI()
+    now = time.time()
+    monkeypatch.setattr(llm_cache.time, "time", lambda: now)
+    diagram = {"model": "gpt-4o", "input": "Draw x."}
+    call(cache, api, endpoint="diagram", **diagram)
+    call(cache, api, endpoint="solution")
+
+    now += 61
+    assert call(cache, api, endpoint="diagram", **diagram) == "answer 3"
+    # No TTL: kept until evicted
+    assert call(cache, api, endpoint="solution") == "answer 2"
+    assert call(cache, api, endpoint="diagram", **diagram) == "answer 3"
+    assert cache._entries == 2
+
+
+def test_lru_eviction(cache, monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(llm_cache.time, "time", lambda: now)
+    for i in range(10):
+        now += 1
+        cache.put("solution", f"k{i}", f"v{i}")
+    now += 1
+    assert cache.get("solution", "k0") == "v0"
+
+    statements = []
+    cache._conn.set_trace_callback(statements.append)
+    now += 1
+    cache.put("solution", "k10", "v10")
+    # Down to 90%: k1 and k2 were the least recently used, k0 was just read
+    assert cache.evictions == 2 and cache._entries == 9
+    assert [s for s in statements if "COUNT(*)" in s] == ["SELECT COUNT(*) FROM responses"]
+    assert cache.get("solution", "k1") is None and cache.get("solution", "k2") is None
+    assert cache.get("solution", "k0") == "v0" and cache.get("solution", "k10") == "v10"
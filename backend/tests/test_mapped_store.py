@@ -0,0 +1,167 @@
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+from conftest import D, question_docs, unit_vectors
+from mapped_store import DeltaIndex, MappedDocstore, write_docs
+from vectorstore_utils import is_mapped, load_snapshot, QuestionIndex, save_snapshot
+
+N = 8
+MODEL = "test-embeddings"
+
+
+@pytest.fixture
+def stores(make_index, embeddings, tmp_path):
+    """
+    (mapped QuestionIndex, plain QuestionIndex) over the same N-question snapshot.
+    """
+    qindex, _ = make_index(N)
+    save_snapshot(qindex.vs, tmp_path / "store", MODEL)
+    mapped = QuestionIndex(load_snapshot(tmp_path / "store", embeddings, MODEL, D, mmap=True))
+    plain = QuestionIndex(load_snapshot(tmp_path / "store", embeddings, MODEL, D))
+    return mapped, plain
+
+
+def both(stores, method, *args, **kwargs):
+    results = [getattr(qindex, method)(*args, **kwargs) for qindex in stores]
+    assert results[0] == results[1]
+    return results[0]
+
+
+def state(qindex):
+    vs = qindex.vs
+    return [
+        (vs.docstore._dict[vs.index_to_docstore_id[pos]].metadata["question_id"],
+         vs.docstore._dict[vs.index_to_docstore_id[pos]].page_content,
+         vs.index.reconstruct(pos).tolist())
+        for pos in range(vs.index.ntotal)
+    ]
+
+
+def assert_same(mapped, plain):
+    assert state(mapped) == state(plain)
+    assert len(mapped.vs.docstore._dict) == len(plain.vs.docstore._dict) == mapped.vs.index.ntotal
+    for query in unit_vectors(5, seed=123):
+        for k in (1, 3, mapped.vs.index.ntotal + 2):
+            found = [(doc.metadata["question_id"], distance) for doc, distance in mapped.search(query, k)]
+            expected = [(doc.metadata["question_id"], distance) for doc, distance in plain.search(query, k)]
+            assert [qid for qid, _ in found] == [qid for qid, _ in expected]
+            np.testing.assert_allclose([d for _, d in found], [d for _, d in expected], atol=1e-5)
+
+
+def test_mapped_snapshot_loads_read_only(stores):
+    mapped, plain = stores
+    assert is_mapped(mapped.vs) and not is_mapped(plain.vs)
+    assert isinstance(mapped.vs.index, DeltaIndex) and isinstance(mapped.vs.docstore, MappedDocstore)
+    assert mapped.vs.index.delta_size() == 0 and mapped.vs.docstore._dict.overlay_size() == 0
+    assert_same(mapped, plain)
+
+
+def test_delete_and_replace_across_base_and_delta(stores):
+    mapped, plain = stores
+    docs = question_docs(N + 3)[N:]
+    vectors = unit_vectors(6, seed=50)
+
+    # Three new questions go to the delta
+    both(stores, "add", docs, embedded={doc.page_content: v for doc, v in zip(docs, vectors)})
+    assert mapped.vs.index.delta_size() == 3
+    assert_same(mapped, plain)
+
+    # Replace a base row and a delta row
+    both(stores, "upsert_many", [("q1", "q1 rescanned", {}), (f"q{N}", "new rescanned", {})],
+         embedded={"q1 rescanned": vectors[3], "new rescanned": vectors[4]})
+    assert mapped.vs.index.delta_size() == 5
+    assert_same(mapped, plain)
+
+    # A base delete swaps the last position (a delta row) into the hole; then a delta delete
+    assert both(stores, "delete", "q0")
+    assert both(stores, "delete", f"q{N + 1}")
+    assert_same(mapped, plain)
+
+    # Delete what's now last, and something in the middle of the base
+    last = mapped.vs.docstore._dict[mapped.vs.index_to_docstore_id[mapped.vs.index.ntotal - 1]]
+    assert both(stores, "delete", last.metadata["question_id"])
+    assert both(stores, "delete", "q4")
+    assert_same(mapped, plain)
+
+    # The mapped files are never written: the changes sit in the docstore overlay
+    doc_ids = mapped.vs.docstore._dict
+    base_id = dict(zip([f"q{i}" for i in range(N)], doc_ids._row_by_id))
+    assert doc_ids._removed == {base_id["q0"], base_id["q4"]}
+    assert base_id["q1"] in doc_ids._changed
+    added = {f"q{N}", f"q{N + 2}"} - {last.metadata["question_id"]}
+    assert {doc.metadata["question_id"] for doc in doc_ids._changed.values()} == {"q1"} | added
+
+
+def test_save_from_mapped_store(stores, embeddings, tmp_path):
+    mapped, plain = stores
+    both(stores, "upsert_many", [("q2", "q2 rescanned", {"topics": ["T"]})],
+         embedded={"q2 rescanned": unit_vectors(1, seed=7)[0]})
+    assert both(stores, "delete", "q3")
+
+    # materialize() writes base and delta rows back out at their positions
+    save_snapshot(mapped.vs, tmp_path / "merged", MODEL)
+    reloaded = QuestionIndex(load_snapshot(tmp_path / "merged", embeddings, MODEL, D, mmap=True))
+    assert reloaded.vs.index.delta_size() == 0
+    assert reloaded.get("q2").metadata["topics"] == ["T"]
+    assert_same(reloaded, plain)
+
+
+def test_dead_rows_do_not_crowd_out_live_hits(stores):
+    mapped, plain = stores
+    old = np.array([mapped.vs.index.reconstruct(pos) for pos in range(N)])
+    # Replace every question but q7 with a far-away vector: the old base rows stay in the mapped
+    # index, unreferenced, and crowd q7 (the nearest live row) out of a query at their old vectors
+    new_vectors = 10 * unit_vectors(N - 1, seed=9)
+    both(stores, "upsert_many", [(f"q{i}", f"q{i} rescanned", {}) for i in range(N - 1)],
+         embedded={f"q{i} rescanned": new_vectors[i] for i in range(N - 1)})
+
+    index = mapped.vs.index
+    assert index.base.ntotal + index.delta.ntotal - index.ntotal == N - 1
+    for k in (1, 2, N):
+        found = index.search(old, k)
+        expected = plain.vs.index.search(old, k)
+        np.testing.assert_array_equal(found[1], expected[1])
+        np.testing.assert_allclose(found[0], expected[0], atol=1e-5)
+    assert_same(mapped, plain)
+
+
+def test_mapped_docs_overlay(tmp_path):
+    ids = ["a", "b", "c"]
+    write_docs(tmp_path, ids, {
+        doc_id: Document(page_content=f"text {doc_id}", metadata={"question_id": doc_id}) for doc_id in ids
+    })
+    docstore, loaded_ids = MappedDocstore.open(tmp_path)
+    docs = docstore._dict
+    assert loaded_ids == ids and len(docs) == 3 and docs["b"].page_content == "text b"
+
+    # Decoded fresh on every read: changes only stick when assigned back
+    docs["b"].metadata["topics"] = ["T"]
+    assert "topics" not in docs["b"].metadata
+    doc = docs["b"]
+    doc.metadata["topics"] = ["T"]
+    docs["b"] = doc
+    del docs["a"]
+    docstore.add({"d": Document(page_content="text d", metadata={"question_id": "d"})})
+
+    assert docs._changed.keys() == {"b", "d"} and docs._removed == {"a"}
+    assert docs.overlay_size() == 3
+    assert "a" not in docs and len(docs) == 3
+    assert sorted(docs) == ["b", "c", "d"]
+    assert docs["b"].metadata["topics"] == ["T"]
+    with pytest.raises(KeyError):
+        docs["a"]
+    with pytest.raises(ValueError):
+        docstore.add({"c": Document(page_content="again")})
+
+    # Writing a removed id back brings it back; deleting an added one forgets it
+    docs["a"] = Document(page_content="text a, again", metadata={"question_id": "a"})
+    del docs["d"]
+    assert docs._removed == set() and "d" not in docs._changed
+    assert sorted(docs) == ["a", "b", "c"]
+
+    # A clone's overlay is its own
+    clone = docstore.clone()._dict
+    del clone["c"]
+    clone["b"].metadata["topics"] = ["changed"]
+    assert "c" in docs and docs["b"].metadata["topics"] == ["T"]
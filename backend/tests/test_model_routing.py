@@ -0,0 +1,64 @@
+import pytest
+
+import model_routing
+from model_routing import DEFAULT_TIERS, escalation_reason, routing_tiers, RoutingStats, TIER_DEFAULTS
+
+VOTES = [("A-1: Alpha", 2.5), ("B-1: Beta", 1.0), ("C-1: Gamma", 0.4), ("D-1: Delta", 0.2)]
+
+
+def tier(**overrides):
+    return {**TIER_DEFAULTS, **overrides}
+
+
+def test_default_tiers(monkeypatch):
+    monkeypatch.setattr(model_routing, "CLASSIFY_ROUTING_CONFIG", {})
+    assert routing_tiers("Biology") == [{**TIER_DEFAULTS, **DEFAULT_TIERS[0], "name": "gpt-4o/image"}]
+
+
+def test_configured_tiers(monkeypatch):
+    monkeypatch.setattr(model_routing, "CLASSIFY_ROUTING_CONFIG", {"Biology": [
+        {"model": "gpt-4o-mini", "input": "text"},
+        {"model": "gpt-4o-mini", "max_side": 768, "min_confidence": 0.9},
+        {"model": "gpt-4o", "name": "big"},
+    ]})
+    tiers = routing_tiers("Biology")
+    assert [t["name"] for t in tiers] == ["gpt-4o-mini/text", "gpt-4o-mini/image@768", "big"]
+    assert tiers[1]["min_confidence"] == 0.9 and tiers[0]["min_confidence"] == TIER_DEFAULTS["min_confidence"]
+    # Other subjects keep the default
+    assert [t["name"] for t in routing_tiers("Chemistry")] == ["gpt-4o/image"]
+
+
+def test_empty_or_bad_tiers(monkeypatch):
+    monkeypatch.setattr(model_routing, "CLASSIFY_ROUTING_CONFIG", {"Biology": [], "Physics": [{"input": "audio"}]})
+    assert [t["name"] for t in routing_tiers("Biology")] == ["gpt-4o/image"]
+    with pytest.raises(ValueError, match="audio"):
+        routing_tiers("Physics")
+
+
+def test_escalation_reason():
+    assert escalation_reason({"topics": ["A-1: Alpha"], "confidence": 0.9}, tier(), VOTES) is None
+    assert escalation_reason({"topics": [], "confidence": 0.9}, tier(), VOTES) == "no topics"
+    assert escalation_reason({"confidence": 0.9}, tier(), VOTES) == "no topics"
+    assert escalation_reason({"topics": ["A-1: Alpha"], "confidence": 0.5}, tier(), VOTES) == "confidence 0.5"
+    assert escalation_reason({"topics": ["A-1: Alpha"]}, tier(), VOTES) == "confidence None"
+    assert escalation_reason({"topics": ["A-1: Alpha"], "confidence": "high"}, tier(), VOTES) == "confidence high"
+
+    # Has to share a topic with the neighbours' top agree_top votes
+    outside = {"topics": ["D-1: Delta"], "confidence": 0.9}
+    assert escalation_reason(outside, tier(), VOTES) == "disagrees with the neighbours' top topics"
+    assert escalation_reason(outside, tier(agree_top=4), VOTES) is None
+    assert escalation_reason({"topics": ["C-1: Gamma", "E-1: New"], "confidence": 0.9}, tier(), VOTES) is None
+    # No (positive) votes to disagree with
+    assert escalation_reason(outside, tier(), []) is None
+    assert escalation_reason(outside, tier(), [("A-1: Alpha", 0.0)]) is None
+
+
+def test_routing_stats():
+    stats = RoutingStats()
+    stats.record("Biology", "mini/text", 0.2, kept=True)
+    stats.record("Biology", "mini/text", 0.4, kept=False)
+    stats.record("Biology", "gpt-4o/image", 1.0, kept=True)
+    assert stats.stats() == {"Biology": {
+        "mini/text": {"calls": 2, "kept": 1, "hit_rate": 0.5, "latency_ms_mean": 300.0, "latency_ms_max": 400.0},
+        "gpt-4o/image": {"calls": 1, "kept": 1, "hit_rate": 1.0, "latency_ms_mean": 1000.0, "latency_ms_max": 1000.0},
+    }}
@@ -0,0 +1,238 @@
+import os
+
+import numpy as np
+import pytest
+
+from conftest import D, question_docs, unit_vectors
+from vectorstore_persistence import WAL_SUFFIX, WriteAheadLog, WriteBehindPersister
+from vectorstore_utils import load_snapshot, QuestionIndex, save_snapshot
+
+MODEL = "test-embeddings"
+# No process has this pid, so its log counts as left behind by a crashed worker
+DEAD_WORKER = "999999999-1"
+
+
+def state(qindex):
+    # Everything a replay has to restore: positions, docstore ids, docs and vectors
+    vs = qindex.vs
+    rows = []
+    for pos in range(vs.index.ntotal):
+        doc_id = vs.index_to_docstore_id[pos]
+        doc = vs.docstore._dict[doc_id]
+        rows.append((doc_id, doc.page_content, doc.metadata, vs.index.reconstruct(pos).tolist()))
+    return rows
+
+
+def save(vs, path, ann=None):
+    save_snapshot(vs, path, MODEL, ann)
+
+
+def mutate(persister, subject):
+    docs = question_docs(6)[4:]
+    vectors = unit_vectors(2, seed=7)
+    with persister.writing(subject) as qindex:
+        qindex.add(docs, embedded={doc.page_content: v for doc, v in zip(docs, vectors)})
+        qindex.upsert_many(
+            [("q1", "question 1, rescanned", {"topics": ["T"]}), ("q2", None, {"topics": ["U"]})],
+            embedded={"question 1, rescanned": unit_vectors(1, seed=8)[0]},
+        )
+        qindex.delete("q0")
+        qindex.delete("q5")
+
+
+def test_wal_round_trips_records(tmp_path):
+    wal = WriteAheadLog(tmp_path / "store.wal")
+    vector = unit_vectors(1)[0]
+    wal.append({"op": "put", "question_id": "q1", "text": "x²", "metadata": {"topics": ["T"]}, "vector": vector})
+    wal.append({"op": "delete", "question_id": "q1"})
+    wal.close()
+
+    put, delete = wal.records()
+    assert put["text"] == "x²" and put["metadata"] == {"topics": ["T"]}
+    np.testing.assert_array_equal(put["vector"], vector)
+    assert delete == {"op": "delete", "question_id": "q1"}
+    assert wal.pending == 2
+
+
+def test_torn_trailing_record_is_ignored(tmp_path):
+    wal = WriteAheadLog(tmp_path / "store.wal")
+    wal.append({"op": "delete", "question_id": "q1"})
+    wal.append({"op": "delete", "question_id": "q2"})
+    wal.close()
+    # Crash halfway through the third append
+    with open(wal.path, "a", encoding="utf-8") as f:
+        f.write('{"op":"put","question_id":"q3","te')
+
+    assert [record["question_id"] for record in wal.records()] == ["q1", "q2"]
+
+
+def test_replay_after_crash_restores_store(make_index, embeddings, tmp_path):
+    path = tmp_path / "store"
+    qindex, _ = make_index(4)
+    save(qindex.vs, path)
+
+    persister = WriteBehindPersister(save)
+    wal = persister.register("Maths", qindex, path)
+    mutate(persister, "Maths")
+    expected = state(qindex)
+    assert wal.pending == 6
+
+    # Crash: no flush, and the log now belongs to a worker that is gone
+    wal.close()
+    os.replace(wal.path, path.with_name(f"store.{DEAD_WORKER}{WAL_SUFFIX}"))
+
+    restored = QuestionIndex(load_snapshot(path, embeddings, MODEL, D))
+    assert len(restored) == 4
+    recovery = WriteBehindPersister(save)
+    recovery.register("Maths", restored, path)
+    assert recovery.has_orphans("Maths")
+    assert recovery.replay("Maths") == 6
+
+    assert state(restored) == expected
+    assert sorted(restored.question_ids()) == ["q1", "q2", "q3", "q4"]
+    assert restored.get("q1").page_content == "question 1, rescanned"
+    # Replaying a second time onto the recovered store changes nothing
+    assert recovery.replay("Maths") == 6
+    assert state(restored) == expected
+
+    # Startup then writes a clean snapshot and drops the recovered logs (main.warm_question_store)
+    save(restored.vs, path)
+    recovery.discard_orphans("Maths")
+    assert not list(tmp_path.glob(f"*{DEAD_WORKER}*"))
+    assert state(QuestionIndex(load_snapshot(path, embeddings, MODEL, D))) == expected
+
+
+def test_flush_truncates_log_after_snapshot(make_index, tmp_path):
+    path = tmp_path / "store"
+    qindex, _ = make_index(4)
+    saved = []
+    persister = WriteBehindPersister(lambda vs, path, ann: saved.append(state(QuestionIndex(vs))))
+    wal = persister.register("Maths", qindex, path)
+
+    mutate(persister, "Maths")
+    assert persister.flush("Maths")
+
+    # The snapshot was taken from a copy with every mutation, and the log is gone
+    assert saved == [state(qindex)]
+    assert wal.pending == 0 and not wal.exists()
+    assert list(wal.records()) == []
+    assert not persister.flush("Maths")
+
+
+def test_failed_snapshot_keeps_log_for_next_flush(make_index, tmp_path):
+    path = tmp_path / "store"
+    qindex, _ = make_index(4)
+    attempts = []
+
+    def flaky_save(vs, path, ann):
+        attempts.append(vs.index.ntotal)
+        if len(attempts) == 1:
+            raise OSError("disk full")
+
+    persister = WriteBehindPersister(flaky_save)
+    wal = persister.register("Maths", qindex, path)
+    with persister.writing("Maths") as q:
+        q.delete("q0")
+    assert not persister.flush("Maths")
+    assert wal.pending == 1 and wal.rotated.exists()
+
+    with persister.writing("Maths") as q:
+        q.delete("q1")
+    # Both deletes survive until a snapshot holds them
+    assert [record["question_id"] for record in wal.records()] == ["q0", "q1"]
+    assert persister.flush("Maths")
+    assert attempts == [3, 2]
+    assert not wal.exists()
+
+
+def test_merge_mode_merges_then_rebases(make_index, tmp_path):
+    path = tmp_path / "store"
+    qindex, _ = make_index(4)
+    qindex.vs.generation = "gen-1"
+    calls = []
+
+    def merge(subject, path, records):
+        calls.append(("merge", subject, [(r["op"], r["question_id"]) for r in records]))
+        return merged_onto
+
+    def rebase(vs, path):
+        calls.append(("rebase", vs is qindex.vs))
+
+    def never_save(vs, path, ann):
+        raise AssertionError("merge mode must not write this worker's copy")
+
+    persister = WriteBehindPersister(never_save, merge_fn=merge, rebase_fn=rebase)
+    persister.register("Maths", qindex, path)
+
+    merged_onto = "gen-1"
+    with persister.writing("Maths") as q:
+        q.delete("q0")
+    assert persister.flush("Maths")
+    assert calls == [("merge", "Maths", [("delete", "q0")]), ("rebase", True)]
+
+    # Another worker wrote a snapshot in between: merged, but this store isn't it, so no rebase
+    calls.clear()
+    merged_onto = "gen-other"
+    with persister.writing("Maths") as q:
+        q.delete("q1")
+    assert persister.flush("Maths")
+    assert calls == [("merge", "Maths", [("delete", "q1")])]
+
+
+@pytest.mark.parametrize("failing", ["merge", "rebase"])
+def test_merge_mode_failures(make_index, tmp_path, failing):
+    path = tmp_path / "store"
+    qindex, _ = make_index(4)
+    qindex.vs.generation = "gen-1"
+
+    def merge(subject, path, records):
+        list(records)
+        if failing == "merge":
+            raise OSError("snapshot locked")
+        return "gen-1"
+
+    def rebase(vs, path):
+        raise OSError("mmap failed")
+
+    persister = WriteBehindPersister(None, merge_fn=merge, rebase_fn=rebase)
+    wal = persister.register("Maths", qindex, path)
+    with persister.writing("Maths") as q:
+        q.delete("q0")
+
+    if failing == "merge":
+        # Nothing merged, so the records wait for the next flush
+        assert not persister.flush("Maths")
+        assert wal.pending == 1 and wal.rotated.exists()
+    else:
+        # Merged; a failed rebase only means the delta stays in memory
+        assert persister.flush("Maths")
+        assert not wal.exists()
+    assert "q0" not in qindex
+
+
+def test_extras_saved_after_snapshots_and_on_stop(make_index, tmp_path):
+    qindex, _ = make_index(4)
+    saved = []
+
+    def extras(subject):
+        saved.append(subject)
+        if len(saved) == 2:
+            raise OSError("disk full")
+
+    persister = WriteBehindPersister(lambda vs, path, ann: None, extras_fn=extras)
+    persister.register("Maths", qindex, tmp_path / "store")
+
+    # Nothing pending: no snapshot, no extras
+    assert not persister.flush("Maths") and saved == []
+    with persister.writing("Maths") as q:
+        q.delete("q0")
+    assert persister.flush("Maths") and saved == ["Maths"]
+
+    # A failing extras save doesn't fail the snapshot
+    with persister.writing("Maths") as q:
+        q.delete("q1")
+    assert persister.flush("Maths") and saved == ["Maths", "Maths"]
+
+    # Shutdown saves them even with no snapshot to write
+    persister.stop()
+    assert saved == ["Maths"] * 3
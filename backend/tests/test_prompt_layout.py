@@ -0,0 +1,73 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from prompt_layout import chat_messages, prompt_tokens, PromptCacheStats, responses_input
+
+SYSTEM = "You are an expert HSC Biology teacher."
+STATIC = [
+    "Rules:\n" + "\n".join(f"{i}. Pick only topics from the catalogue." for i in range(50)),
+    "Topics:\n" + "\n".join(f"* BIO-M{i}: Module {i}" for i in range(40)),
+]
+REQUESTS = [
+    (["Question (OCR text):\nWhat is a ribosome?", "Similar questions voted: BIO-M1 (3.0)"], "aW1hZ2Ugb25l"),
+    (["Question (OCR text):\nDescribe osmosis.", "Similar questions voted: BIO-M2 (1.5), BIO-M4 (0.5)"], "aW1hZ2UgdHdv"),
+]
+
+
+def request_bytes(messages):
+    # What goes over the wire: the SDK serializes messages in order
+    return json.dumps({"model": "gpt-4o", "messages": messages}).encode("utf-8")
+
+
+@pytest.mark.parametrize("layout", [chat_messages, responses_input])
+def test_static_prefix_is_byte_identical(layout):
+    prompts = [layout(SYSTEM, STATIC, variable, image) for variable, image in REQUESTS]
+    first, second = (request_bytes(p) for p in prompts)
+    prefix = os.path.commonprefix([first, second])
+
+    # The system message (instructions, rules, catalogue) is all in the shared prefix
+    system = json.dumps(prompts[0][0]).encode("utf-8")
+    static_end = first.index(system) + len(system)
+    assert prompts[0][0] == prompts[1][0] and static_end <= len(prefix)
+    for block in STATIC:
+        assert json.dumps(block)[1:-1].encode("utf-8") in prefix
+
+    # Everything that changes per request comes after it: the text blocks, then the image
+    for (variable, image), body in zip(REQUESTS, (first, second)):
+        positions = [body.index(json.dumps(text)[1:-1].encode("utf-8")) for text in variable]
+        positions.append(body.index(image.encode("utf-8")))
+        assert positions == sorted(positions) and positions[0] >= static_end
+
+
+def test_no_variable_blocks():
+    messages = chat_messages(SYSTEM, STATIC)
+    assert messages[0]["content"] == "\n\n".join([SYSTEM, *STATIC]) and messages[1]["content"] == []
+    assert responses_input(SYSTEM, image_base64="aW1n")[1]["content"] == [
+        {"type": "input_image", "image_url": "data:image/png;base64,aW1n"}
+    ]
+
+
+def test_prompt_tokens():
+    chat = SimpleNamespace(prompt_tokens=2000, prompt_tokens_details=SimpleNamespace(cached_tokens=1024))
+    responses = SimpleNamespace(input_tokens=3000, input_tokens_details=SimpleNamespace(cached_tokens=None))
+    assert prompt_tokens(chat) == (2000, 1024)
+    assert prompt_tokens(responses) == (3000, 0)
+    assert prompt_tokens(SimpleNamespace(prompt_tokens=10, prompt_tokens_details=None)) == (10, 0)
+    assert prompt_tokens(None) == (0, 0)
+
+
+def test_prompt_cache_stats():
+    stats = PromptCacheStats()
+    usage = lambda cached: SimpleNamespace(prompt_tokens=2000, prompt_tokens_details=SimpleNamespace(cached_tokens=cached))
+    stats.record("classify:gpt-4o", SimpleNamespace(usage=usage(0)), 1.0)
+    stats.record("classify:gpt-4o", SimpleNamespace(usage=usage(1536)), 0.5)
+    stats.record("diagram", SimpleNamespace(), 0.2)
+    assert stats.stats() == {
+        "classify:gpt-4o": {"calls": 2, "cached_calls": 1, "prompt_tokens": 4000, "cached_tokens": 1536,
+                            "cached_share": 0.384, "latency_ms_mean": 750.0},
+        "diagram": {"calls": 1, "cached_calls": 0, "prompt_tokens": 0, "cached_tokens": 0,
+                    "cached_share": 0.0, "latency_ms_mean": 200.0},
+    }
@@ -0,0 +1,155 @@
+import numpy as np
+import pytest
+
+from conftest import HashEmbeddings
+from diagnostics import _synthetic_vectors
+from langchain_core.documents import Document
+from quantization import MIN_TRAIN, resolve_quantization
+from vectorstore_utils import (
+    empty_vectorstore, exact_vectors_of, load_snapshot, QuestionIndex, quantize_store, reopen_snapshot,
+    save_snapshot, store_vectors,
+)
+
+D = 32
+K = 10
+MODEL = "test-embeddings"
+
+
+def quantized(mode, n, d=D, **config):
+    # QuestionIndex over n clustered vectors (like diagnostics.ann_report's), re-encoded for `mode`
+    vectors = _synthetic_vectors(n, d)
+    vs = empty_vectorstore(HashEmbeddings(d), d)
+    qindex = QuestionIndex(vs)
+    docs = [Document(page_content=f"question {i}", metadata={"question_id": f"q{i}"}) for i in range(n)]
+    qindex.add(docs, embedded={doc.page_content: vector for doc, vector in zip(docs, vectors)})
+    quantize_store(vs, resolve_quantization({"quantization": mode, **config}, d))
+    qindex.rebuild()
+    return qindex, vectors
+
+
+def queries(vectors, n=50, seed=1):
+    # Re-scans of known questions: stored vectors plus a little noise
+    rng = np.random.RandomState(seed)
+    picked = vectors[rng.choice(len(vectors), n, replace=False)]
+    return (picked + 0.01 * rng.normal(size=picked.shape)).astype("float32")
+
+
+def exact_top(vectors, ids, query, k=K):
+    distances = ((vectors - query) ** 2).sum(axis=1)
+    order = np.argsort(distances, kind="stable")[:k]
+    return [ids[i] for i in order], distances[order]
+
+
+def hits(qindex, query, k=K):
+    return [(doc.metadata["question_id"], distance) for doc, distance in qindex.search(query, k)]
+
+
+def check_against_exact(qindex, vectors_by_qid, min_recall):
+    # recall@K against brute force over the float32 vectors; the re-scanned question always
+    # comes first, and re-ranked distances are exact ones
+    ids = sorted(vectors_by_qid)
+    vectors = np.array([vectors_by_qid[qid] for qid in ids])
+    reranked = exact_vectors_of(qindex.vs).rerank > 0
+    recalls = []
+    for query in queries(vectors):
+        found = hits(qindex, query)
+        truth, _ = exact_top(vectors, ids, query)
+        assert found[0][0] == truth[0]
+        recalls.append(len({qid for qid, _ in found} & set(truth)) / K)
+        if reranked:
+            for qid, distance in found:
+                assert distance == pytest.approx(((vectors_by_qid[qid] - query) ** 2).sum(), abs=1e-4)
+    assert np.mean(recalls) >= min_recall
+
+
+# Floors for these small, tightly clustered sets (neighbours within a cluster are nearly
+# equidistant), far above the chance of fetching k*rerank of n at random
+@pytest.mark.parametrize("mode,n,config,min_recall", [
+    ("fp16", 1200, {}, 0.99),
+    ("sq8", MIN_TRAIN["sq8"] + 200, {}, 0.95),
+    ("binary", MIN_TRAIN["binary"] + 200, {}, 0.5),
+    # PQ trains one k-means per sub-quantizer, so few of them keep this quick
+    ("pq", MIN_TRAIN["pq"], {"pq_m": 4}, 0.5),
+])
+def test_quantized_search_recall(mode, n, config, min_recall):
+    qindex, vectors = quantized(mode, n, **config)
+    exact = exact_vectors_of(qindex.vs)
+    assert exact is not None and exact.quant["mode"] == mode
+    assert qindex.vs.index.code_size < 4 * D
+
+    check_against_exact(qindex, {f"q{i}": v for i, v in enumerate(vectors)}, min_recall)
+
+
+def test_small_store_stays_float32():
+    qindex, _ = quantized("sq8", MIN_TRAIN["sq8"] - 1)
+    assert exact_vectors_of(qindex.vs) is None
+    assert qindex.vs.index.code_size == 4 * D
+
+
+def test_back_to_float32_restores_vectors():
+    qindex, vectors = quantized("sq8", 1200)
+    assert quantize_store(qindex.vs, resolve_quantization({"quantization": "none"}, D))
+    assert exact_vectors_of(qindex.vs) is None
+    np.testing.assert_array_equal(qindex.vs.index.reconstruct_n(0, len(vectors)), vectors)
+
+
+@pytest.mark.parametrize("mmap", [False, True], ids=["loaded", "mmap"])
+def test_rerank_against_mapped_vectors(tmp_path, mmap):
+    qindex, vectors = quantized("sq8", 1200)
+    before = [hits(qindex, query) for query in queries(vectors)]
+
+    save_snapshot(qindex.vs, tmp_path / "store", MODEL)
+    loaded = QuestionIndex(load_snapshot(tmp_path / "store", HashEmbeddings(D), MODEL, D, mmap=mmap))
+    exact = exact_vectors_of(loaded.vs)
+    # Every exact vector now comes from vectors.npy, paged in from disk
+    assert exact.overlay_size() == 0
+    assert isinstance(exact._base, np.memmap)
+    assert [hits(loaded, query) for query in queries(vectors)] == before
+
+    # The saving store drops its in-memory copies for the file just written
+    reopen_snapshot(qindex.vs, tmp_path / "store")
+    assert exact_vectors_of(qindex.vs).overlay_size() == 0
+    assert [hits(qindex, query) for query in queries(vectors)] == before
+
+
+@pytest.mark.parametrize("mmap", [False, True], ids=["loaded", "mmap"])
+def test_overlay_bookkeeping_after_mutations(tmp_path, mmap):
+    qindex, vectors = quantized("sq8", 1200)
+    save_snapshot(qindex.vs, tmp_path / "store", MODEL)
+    qindex = QuestionIndex(load_snapshot(tmp_path / "store", HashEmbeddings(D), MODEL, D, mmap=mmap))
+    exact = exact_vectors_of(qindex.vs)
+    expected = {f"q{i}": v for i, v in enumerate(vectors)}
+    extra = _synthetic_vectors(3, D, seed=5)
+
+    # Deleted from the mapped rows
+    for qid in ("q0", "q600", "q1199"):
+        assert qindex.delete(qid)
+        del expected[qid]
+    # Replaced: the overlay shadows the mapped row
+    qindex.upsert_many([("q5", "question 5, rescanned", {})], embedded={"question 5, rescanned": extra[0]})
+    expected["q5"] = extra[0]
+    # Added, then one of them deleted again
+    new = [Document(page_content=f"new {i}", metadata={"question_id": f"new{i}"}) for i in (1, 2)]
+    qindex.add(new, embedded={"new 1": extra[1], "new 2": extra[2]})
+    expected["new1"] = extra[1]
+    assert qindex.delete("new2")
+
+    doc_id_of = {doc.metadata["question_id"]: doc_id for doc_id, doc in qindex.vs.docstore._dict.items()}
+    assert exact.overlay_size() == 2
+    assert set(exact._overlay) == {doc_id_of["q5"], doc_id_of["new1"]}
+    assert len(exact._row_by_id) == 1200 - 3
+    np.testing.assert_array_equal(exact.get([doc_id_of["q5"]])[0], extra[0])
+
+    # Position order still lines up with the docstore, and searches with brute force
+    positions = [qindex.vs.docstore._dict[qindex.vs.index_to_docstore_id[i]].metadata["question_id"]
+                 for i in range(qindex.vs.index.ntotal)]
+    np.testing.assert_array_equal(store_vectors(qindex.vs), np.array([expected[qid] for qid in positions]))
+    check_against_exact(qindex, expected, 0.95)
+    (qid, distance), = hits(qindex, extra[1], 1)
+    assert qid == "new1" and distance == pytest.approx(0.0, abs=1e-6)
+
+    # The next snapshot folds the overlay into vectors.npy
+    save_snapshot(qindex.vs, tmp_path / "store", MODEL)
+    reloaded = QuestionIndex(load_snapshot(tmp_path / "store", HashEmbeddings(D), MODEL, D))
+    assert exact_vectors_of(reloaded.vs).overlay_size() == 0
+    check_against_exact(reloaded, expected, 0.95)
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+from conftest import question_docs, unit_vectors
+
+N = 6
+
+
+def positions_of(qindex):
+    # question_id -> vector position, read back through the store's own maps
+    vs = qindex.vs
+    return {
+        vs.docstore._dict[doc_id].metadata["question_id"]: pos
+        for pos, doc_id in vs.index_to_docstore_id.items()
+    }
+
+
+@pytest.mark.parametrize("deleted", [0, N // 2, N - 1], ids=["first", "middle", "last"])
+def test_swap_delete(make_index, deleted):
+    qindex, vectors = make_index(N)
+    query = unit_vectors(1, seed=99)[0]
+    before = {doc.metadata["question_id"]: distance for doc, distance in qindex.search(query, N)}
+    last_qid = f"q{N - 1}"
+
+    assert qindex.delete(f"q{deleted}")
+
+    vs = qindex.vs
+    assert vs.index.ntotal == N - 1
+    assert sorted(vs.index_to_docstore_id) == list(range(N - 1))
+    assert f"q{deleted}" not in qindex
+    assert f"q{deleted}" not in positions_of(qindex)
+
+    # The last question moved into the freed slot (unless it was the one deleted)
+    positions = positions_of(qindex)
+    if deleted != N - 1:
+        assert positions[last_qid] == deleted
+    # Every remaining question's stored vector is still its own
+    for qid, pos in positions.items():
+        np.testing.assert_allclose(vs.index.reconstruct(pos), vectors[int(qid[1:])], atol=1e-6)
+
+    after = {doc.metadata["question_id"]: distance for doc, distance in qindex.search(query, N)}
+    assert set(after) == set(before) - {f"q{deleted}"}
+    for qid, distance in after.items():
+        assert distance == pytest.approx(before[qid], abs=1e-5)
+
+
+def test_delete_everything_then_add(make_index):
+    qindex, vectors = make_index(3)
+    for qid in ("q1", "q2", "q0"):
+        assert qindex.delete(qid)
+    assert qindex.vs.index.ntotal == 0 and len(qindex) == 0
+    assert not qindex.delete("q0")
+
+    docs = question_docs(1)
+    qindex.add(docs, embedded={docs[0].page_content: vectors[0]})
+    (doc, distance), = qindex.search(vectors[0], 1)
+    assert doc.metadata["question_id"] == "q0" and distance == pytest.approx(0.0, abs=1e-6)
+
+
+def test_upsert_replaces_in_place(make_index):
+    qindex, vectors = make_index(N)
+    new_vector = unit_vectors(1, seed=42)[0]
+    position = positions_of(qindex)["q2"]
+
+    stats = qindex.upsert_many(
+        [("q2", "question 2, rescanned", {"topics": ["T"]}), ("q3", None, {"topics": ["U"]})],
+        embedded={"question 2, rescanned": new_vector},
+    )
+
+    assert stats == {"added": 0, "updated": 1, "retagged": 1, "skipped": 0}
+    assert positions_of(qindex)["q2"] == position
+    np.testing.assert_allclose(qindex.vs.index.reconstruct(position), new_vector, atol=1e-6)
+    assert qindex.get("q2").page_content == "question 2, rescanned"
+    assert qindex.get("q3").metadata["topics"] == ["U"]
+
+
+def test_add_of_a_stored_question_replaces_it(make_index):
+    qindex, vectors = make_index(N)
+    new_vector = unit_vectors(1, seed=42)[0]
+    rescanned = Document(page_content="question 2, rescanned", metadata={"question_id": "q2", "topics": ["T"]})
+    new = question_docs(N + 1)[N:]
+    embedded = {"question 2, rescanned": new_vector, new[0].page_content: vectors[0]}
+
+    assert qindex.add([rescanned, *new], embedded=embedded) == 2
+
+    # No second copy of q2: the old vector and doc are gone, not just unreachable
+    assert qindex.vs.index.ntotal == len(qindex.vs.docstore._dict) == len(qindex) == N + 1
+    assert [doc.metadata["question_id"] for doc, _ in qindex.search(vectors[2], N + 1)].count("q2") == 1
+    np.testing.assert_allclose(qindex.vs.index.reconstruct(positions_of(qindex)["q2"]), new_vector, atol=1e-6)
+    assert qindex.get("q2").metadata["topics"] == ["T"]
+
+    # ...so a delete really removes it
+    assert qindex.delete("q2")
+    assert "q2" not in {doc.metadata["question_id"] for doc, _ in qindex.search(new_vector, N + 1)}
+
+    # The same question twice in one batch: the last one wins
+    twice = [Document(page_content=f"q9 take {i}", metadata={"question_id": "q9"}) for i in range(2)]
+    assert qindex.add(twice, embedded={d.page_content: v for d, v in zip(twice, unit_vectors(2, seed=7))}) == 1
+    assert qindex.get("q9").page_content == "q9 take 1" and qindex.vs.index.ntotal == N + 1
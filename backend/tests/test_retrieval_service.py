@@ -0,0 +1,170 @@
+import socket
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from conftest import question_docs, unit_vectors
+from dedup_utils import ExactTextIndex
+from retrieval_service import (
+    _Handler, RemoteRetrieval, RetrievalError, recv_frame, send_frame, pack_vectors, unpack_vectors,
+)
+
+
+class FakeRetrieval:
+    """
+    main.LocalRetrieval's methods over one QuestionIndex, without MongoDB or warmup.
+    """
+
+    def __init__(self, qindex, text_index):
+        self.qindex = qindex
+        self.text_index = text_index
+
+    def status(self):
+        return {"Maths": {"state": "ready", "vectors": len(self.qindex)}}
+
+    def search(self, key, vectors, k):
+        return [self.qindex.search(vector, k) for vector in vectors]
+
+    def topic_votes(self, subject, vectors):
+        return [{"topics": [["T", 0.75]], "voters": 3, "agreement": 0.75, "margin": 0.5} for _ in vectors]
+
+    def predict_topics(self, subject, vectors):
+        return None
+
+    def get(self, subject, question_id):
+        return self.qindex.get(question_id)
+
+    def known_ids(self, subject):
+        return self.qindex.question_ids()
+
+    def lookup_text(self, subject, text):
+        return self.text_index.lookup(text)
+
+    def near_duplicate(self, subject, text):
+        return ("q1", 0.9) if text.startswith("question 1") else None
+
+    def repeat_upload(self, subject, phash):
+        return [("q2", 3, self.qindex.get("q2"))]
+
+    def add(self, subject, docs, vectors):
+        return self.qindex.add(docs, dict(zip([d.page_content for d in docs], vectors)))
+
+    def upsert(self, subject, entries, embedded):
+        return self.qindex.upsert_many(entries, embedded)
+
+    def delete(self, subject, question_ids):
+        return sum(self.qindex.delete(qid) for qid in question_ids)
+
+
+@pytest.fixture
+def served(make_index):
+    """
+    (RemoteRetrieval, the FakeRetrieval it talks to, the service end of the socketpair).
+    """
+    text_index = ExactTextIndex()
+    qindex, vectors = make_index(4, observers=[text_index])
+    fake = FakeRetrieval(qindex, text_index)
+    service, client_sock = socket.socketpair()
+    # The service's own request loop, on one end of the pair
+    handler = threading.Thread(target=_Handler, args=(service, None, SimpleNamespace(retrieval=fake)), daemon=True)
+    handler.start()
+
+    client = RemoteRetrieval("unused")
+    client._local.sock = client_sock
+    yield client, fake, service, vectors
+    client.close()
+    handler.join(timeout=5)
+    service.close()
+
+
+def test_frames_round_trip():
+    a, b = socket.socketpair()
+    blob = np.arange(100000, dtype="<f4").tobytes()
+    header = {"op": "search", "text": "Differentiate x² — ‘twice’", "shape": [1000, 100]}
+
+    # Bigger than the socket buffer, so the reader has to be running while it's sent
+    sender = threading.Thread(target=lambda: (send_frame(a, header, blob), send_frame(a, {"ok": True})))
+    sender.start()
+    assert recv_frame(b) == (header, blob)
+    assert recv_frame(b) == ({"ok": True}, b"")
+    sender.join()
+
+    # A frame cut short by the peer going away is an EOFError, not a partial read
+    a.sendall(b"\x00\x00\x00\x10\x00\x00")
+    a.close()
+    with pytest.raises(EOFError):
+        recv_frame(b)
+    b.close()
+
+
+def test_vectors_keep_shape_and_values():
+    vectors = unit_vectors(3)
+    shape, blob = pack_vectors(vectors)
+    assert shape == [3, vectors.shape[1]]
+    np.testing.assert_array_equal(unpack_vectors(shape, blob), vectors)
+
+
+def test_reads_through_dispatch(served):
+    client, fake, _, vectors = served
+    assert client.status() == {"Maths": {"state": "ready", "vectors": 4}}
+
+    hits, = client.search("Maths", vectors[2:3], 2)
+    (doc, distance), _ = hits
+    assert doc.metadata["question_id"] == "q2" and distance == pytest.approx(0.0, abs=1e-6)
+    assert [d.metadata["question_id"] for d, _ in hits] == [d.metadata["question_id"] for d, _ in fake.search(
+        "Maths", vectors[2:3], 2)[0]]
+
+    assert client.topic_votes("Maths", vectors[:2]) == [
+        {"topics": [("T", 0.75)], "voters": 3, "agreement": 0.75, "margin": 0.5}
+    ] * 2
+    assert client.predict_topics("Maths", vectors[:1]) is None
+
+    assert client.get("Maths", "q3").page_content == "question 3"
+    assert client.get("Maths", "missing") is None
+    assert "q1" in client.known_ids("Maths") and "q9" not in client.known_ids("Maths")
+    assert client.lookup_text("Maths", "Question  3") == "q3"
+    assert client.near_duplicate("Maths", "question 1, rescanned") == ("q1", 0.9)
+    assert client.near_duplicate("Maths", "something else") is None
+
+    (qid, distance, doc), = client.repeat_upload("Maths", "0123456789abcdef")
+    assert (qid, distance, doc.page_content) == ("q2", 3, "question 2")
+
+
+def test_writes_through_dispatch(served):
+    client, fake, _, _ = served
+    new = question_docs(6)[4:]
+    new_vectors = unit_vectors(2, seed=9)
+    assert client.add("Maths", new, new_vectors) == 2
+    np.testing.assert_allclose(fake.qindex.vectors(["q5"])[1][0], new_vectors[1], atol=1e-6)
+
+    rescanned = unit_vectors(1, seed=10)[0]
+    stats = client.upsert("Maths", [("q1", "question 1, rescanned", {"topics": ["T"]}), ("q2", None, {"topics": ["U"]})],
+                          {"question 1, rescanned": rescanned})
+    assert stats == {"added": 0, "updated": 1, "retagged": 1, "skipped": 0}
+    np.testing.assert_allclose(fake.qindex.vectors(["q1"])[1][0], rescanned, atol=1e-6)
+    assert fake.qindex.get("q2").metadata["topics"] == ["U"]
+
+    # Retags only: no vectors to send
+    assert client.upsert("Maths", [("q3", None, {"topics": ["V"]})], {})["retagged"] == 1
+
+    assert client.delete("Maths", ["q0", "q9"]) == 1
+    assert "q0" not in fake.qindex
+
+
+def test_errors_come_back_as_retrieval_errors(served):
+    client, _, service, _ = served
+    with pytest.raises(RetrievalError, match="Unknown op"):
+        client.call("drop_everything")
+    with pytest.raises(RetrievalError, match="KeyError"):
+        client.call("get", subject="Maths")
+    # The connection is still good after an error reply
+    assert client.get("Maths", "q0").page_content == "question 0"
+
+    # Service gone: a write isn't retried, a read retries once on a new connection and fails too
+    service.shutdown(socket.SHUT_RDWR)
+    with pytest.raises(RetrievalError, match="delete failed"):
+        client.delete("Maths", ["q0"])
+    with pytest.raises(RetrievalError, match="status failed"):
+        client.status()
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from conftest import D
+from topic_classifier import classifier_path, TopicClassifier
+
+MODEL = "test-embeddings"
+TOPICS = ["A-1: Alpha", "B-1: Beta", "C-1: Gamma"]
+
+
+def labelled(n_per_topic=40, seed=0):
+    """
+    Unit vectors around one direction per topic; every fourth "A" question is also tagged "B".
+    """
+    rng = np.random.RandomState(seed)
+    vectors, labels = [], []
+    for t, topic in enumerate(TOPICS):
+        for i in range(n_per_topic):
+            vector = np.eye(D)[t] + 0.2 * rng.normal(size=D)
+            vectors.append(vector / np.linalg.norm(vector))
+            labels.append([topic, TOPICS[1]] if t == 0 and i % 4 == 0 else [topic])
+    return np.array(vectors, dtype=np.float32), labels
+
+
+def direction(t, d=D):
+    return np.eye(d, dtype=np.float32)[t]
+
+
+@pytest.fixture(scope="module")
+def trained():
+    classifier = TopicClassifier(D, MODEL)
+    vectors, labels = labelled()
+    # 120 questions are only one batch per epoch, so more epochs than the default
+    classifier.fit(vectors, labels, epochs=200, lr=0.05)
+    return classifier
+
+
+def test_fit_predicts_each_topic(trained):
+    assert trained.topics == sorted(TOPICS)
+    for t, topic in enumerate(TOPICS):
+        topics, confidence = trained.predict(direction(t))
+        assert topics == [topic]
+        assert 0.5 < confidence <= 1.0
+    # Between two topics it's unsure, whatever it picks
+    assert trained.predict(direction(1) + direction(2))[1] < trained.predict(direction(1))[1]
+
+
+def test_save_load_round_trip(trained, tmp_path):
+    path = classifier_path(tmp_path / "biology")
+    assert path.name == "biology.classifier.npz"
+    trained.save(path)
+    assert not trained.unsaved
+
+    loaded = TopicClassifier.load(path, MODEL, D)
+    assert loaded.topics == trained.topics and loaded.updates == trained.updates and not loaded.unsaved
+    for vector in labelled(5, seed=1)[0]:
+        assert loaded.predict(vector) == trained.predict(vector)
+
+    # Another embedding model, dimension, or no (or a broken) file: retrain instead
+    assert TopicClassifier.load(path, "other-model", D) is None
+    assert TopicClassifier.load(path, MODEL, D + 1) is None
+    assert TopicClassifier.load(tmp_path / "missing.npz", MODEL, D) is None
+    (tmp_path / "broken.npz").write_bytes(b"not a zip")
+    assert TopicClassifier.load(tmp_path / "broken.npz", MODEL, D) is None
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_partial_fit_learns_corrections(trained, tmp_path):
+    trained.save(tmp_path / "model.npz")
+    classifier = TopicClassifier.load(tmp_path / "model.npz", MODEL, D)
+
+    # A topic nobody has seen yet, on a direction of its own, in batches that also confirm some
+    # "A" questions (a batch of only the new topic would teach it that everything is "D")
+    new_topic = "D-1: Delta"
+    rng = np.random.RandomState(1)
+    vectors = np.array([direction(3 if i < 8 else 0) + 0.05 * rng.normal(size=D) for i in range(12)],
+                       dtype=np.float32)
+    labels = [[new_topic]] * 8 + [[TOPICS[0]]] * 4
+    for _ in range(20):
+        classifier.partial_fit(vectors, labels)
+
+    assert classifier.topics[-1] == new_topic and classifier.updates == 20 and classifier.unsaved
+    assert classifier.predict(direction(3))[0] == [new_topic]
+    # What it knew before is still there
+    assert classifier.predict(direction(0))[0] == [TOPICS[0]]
+
+    classifier.save(tmp_path / "model.npz")
+    reloaded = TopicClassifier.load(tmp_path / "model.npz", MODEL, D)
+    assert reloaded.topics == classifier.topics and reloaded.updates == 20
+    assert reloaded.predict(direction(3)) == classifier.predict(direction(3))
+
+
+def test_empty_models():
+    classifier = TopicClassifier(D, MODEL)
+    assert classifier.predict(direction(0)) == ([], 0.0)
+    classifier.fit(np.zeros((0, D), dtype=np.float32), [])
+    assert classifier.topics == [] and classifier.predict(direction(0)) == ([], 0.0)
+    classifier.partial_fit(np.zeros((0, D), dtype=np.float32), [])
+    assert classifier.updates == 0
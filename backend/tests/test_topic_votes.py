@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+from conftest import D, HashEmbeddings, question_docs, unit_vectors
+from topic_votes import similarities, TopicMatrix
+from vectorstore_utils import empty_vectorstore, QuestionIndex
+
+
+def doc(question_id, topics=()):
+    return Document(page_content=question_id, metadata={"question_id": question_id, "topics": list(topics)})
+
+
+def distance(similarity):
+    # squared L2 between unit vectors with this cosine similarity
+    return 2.0 - 2.0 * similarity
+
+
+def matrix_of(*docs):
+    matrix = TopicMatrix()
+    for d in docs:
+        matrix.on_add(d.metadata["question_id"], d)
+    return matrix
+
+
+def test_similarities_from_distances():
+    np.testing.assert_allclose(similarities([0.0, 0.4, 2.0, 4.0]), [1.0, 0.8, 0.0, -1.0])
+
+
+def test_vote_weights_topics_and_sets_by_similarity():
+    docs = [doc("q1", ["A"]), doc("q2", ["A", "B"]), doc("q3", ["B"]), doc("untagged"), doc("far", ["A"])]
+    matrix = matrix_of(*docs)
+    hits = [
+        (docs[3], distance(0.95)),  # closest, but has no topics to vote with
+        (docs[0], distance(0.9)),
+        (docs[1], distance(0.8)),
+        (docs[2], distance(0.5)),
+        (docs[4], distance(0.2)),   # below TOPIC_VOTE_MIN_SIMILARITY
+    ]
+
+    vote = matrix.vote(hits, min_similarity=0.3)
+
+    assert vote["voters"] == 3
+    assert [t for t, _ in vote["topics"]] == ["A", "B"]
+    assert [w for _, w in vote["topics"]] == pytest.approx([0.9 + 0.8, 0.8 + 0.5])
+    # Sets {A}: 0.9, {A, B}: 0.8, {B}: 0.5 of 2.2
+    assert vote["consensus"] == ["A"]
+    assert vote["agreement"] == pytest.approx(0.9 / 2.2)
+    assert vote["margin"] == pytest.approx((0.9 - 0.8) / 2.2)
+    assert vote["similarity"] == pytest.approx(0.9)
+
+
+def test_identical_sets_pool_their_votes():
+    docs = [doc("q1", ["A", "B"]), doc("q2", ["B", "A"]), doc("q3", ["C"])]
+    matrix = matrix_of(*docs)
+    vote = matrix.vote([(docs[2], distance(0.95)), (docs[0], distance(0.7)), (docs[1], distance(0.6))])
+
+    # The nearest neighbour alone loses to two that agree
+    assert vote["consensus"] == ["A", "B"]
+    assert vote["agreement"] == pytest.approx(1.3 / 2.25)
+    assert vote["margin"] == pytest.approx((1.3 - 0.95) / 2.25)
+    assert vote["similarity"] == pytest.approx(0.7)
+
+    unanimous = matrix.vote([(docs[0], distance(0.9)), (docs[1], distance(0.8))])
+    assert unanimous["agreement"] == pytest.approx(1.0) and unanimous["margin"] == pytest.approx(1.0)
+
+
+def test_nearest_vote_when_nobody_is_close():
+    docs = [doc("untagged"), doc("q1", ["A"]), doc("q2", ["B"]), doc("q3", ["B"])]
+    matrix = matrix_of(*docs)
+    hits = [(docs[0], distance(0.25)), (docs[1], distance(0.2)), (docs[2], distance(0.1)), (docs[3], distance(0.05))]
+
+    vote = matrix.vote(hits, min_similarity=0.3, min_neighbors=2)
+    # The two nearest *tagged* neighbours, however far
+    assert vote["voters"] == 2
+    assert [t for t, _ in vote["topics"]] == ["A", "B"]
+    assert vote["consensus"] == ["A"] and vote["similarity"] == pytest.approx(0.2)
+
+
+def test_no_tagged_neighbours():
+    matrix = matrix_of(doc("q1", ["A"]))
+    assert matrix.vote([(doc("untagged"), 0.1)]) == {
+        "topics": [], "voters": 0, "consensus": [], "agreement": 0.0, "margin": 0.0, "similarity": 0.0,
+    }
+    assert matrix.vote([])["voters"] == 0
+
+
+def test_rows_follow_adds_retags_and_removes():
+    matrix = matrix_of(doc("q1", ["A"]), doc("q2", ["B"]), doc("untagged"))
+    assert len(matrix) == 2
+
+    matrix.on_remove("q1")
+    matrix.on_add("q3", doc("q3", ["C"]))
+    assert len(matrix) == 2 and matrix._row_by_qid["q3"] == 0  # q1's row is reused
+
+    # Re-tagging replaces the row, it doesn't add to it
+    matrix.on_add("q2", doc("q2", ["A"]))
+    vote = matrix.vote([(doc("q2"), 0.0), (doc("q3"), 0.0)])
+    assert sorted(t for t, _ in vote["topics"]) == ["A", "C"]
+    assert matrix.vote([(doc("q1"), 0.0)])["voters"] == 0
+
+    # Enough topics and questions to grow the matrix
+    for i in range(100):
+        matrix.on_add(f"n{i}", doc(f"n{i}", [f"T{i}", "A"]))
+    assert matrix.vote([(doc("n99"), 0.0)])["consensus"] == ["A", "T99"]
+
+
+def test_matrix_as_question_index_observer():
+    matrix = TopicMatrix()
+    vs = empty_vectorstore(HashEmbeddings(), D)
+    qindex = QuestionIndex(vs, observers=[matrix])
+    docs = question_docs(4, topics=lambda i: ["A"] if i < 3 else ["B"])
+    vectors = unit_vectors(4)
+    qindex.add(docs, embedded={d.page_content: v for d, v in zip(docs, vectors)})
+
+    # Closer to the three "A" questions than to the "B" one
+    query = vectors[:3].sum(axis=0)
+    query /= np.linalg.norm(query)
+    assert matrix.vote(qindex.search(query, 4), min_similarity=-1.0)["consensus"] == ["A"]
+
+    qindex.upsert_many([("q0", None, {"topics": ["B"]}), ("q1", None, {"topics": ["B"]})])
+    qindex.delete("q2")
+    vote = matrix.vote(qindex.search(query, 4), min_similarity=-1.0)
+    assert vote["consensus"] == ["B"] and vote["voters"] == 3 and vote["agreement"] == pytest.approx(1.0)
@@ -0,0 +1,23 @@
+import os
+
+# Every uvicorn worker is its own process with its own OpenMP/BLAS thread pools, each sized
+# to all cores by default, so N workers run N x cores search threads and slow each other
+# down. Split the cores between workers instead: WEB_CONCURRENCY is uvicorn's --workers
+# default, so set it rather than passing --workers (or pin FAISS_THREADS directly).
+WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+FAISS_THREADS = int(
+    os.getenv("FAISS_THREADS") or os.getenv("OMP_NUM_THREADS") or max(1, (os.cpu_count() or 1) // WORKERS)
+)
+
+# The pools are sized when numpy/faiss load, so this module is imported before them
+for _var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(_var, str(FAISS_THREADS))
+
+
+def apply_thread_limits():
+    """
+    Cap faiss's OpenMP pool in case it was loaded before the environment was set.
+    """
+    import faiss
+
+    faiss.omp_set_num_threads(FAISS_THREADS)
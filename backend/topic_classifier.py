@@ -0,0 +1,171 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+# One-vs-rest logistic regression per subject over the stored question embeddings: a
+# (d x topics) weight matrix, so a prediction is one matrix-vector product (~20 us at 1536 x 100).
+# Trained from the classification collection on first load, then nudged by every correction
+# batch and saved next to the subject's snapshot as <snapshot>.classifier.npz whenever the
+# snapshot is written.
+CLASSIFIER_SUFFIX = ".classifier.npz"
+TOPIC_CLASSIFIER_EPOCHS = int(os.getenv("TOPIC_CLASSIFIER_EPOCHS", "20"))
+TOPIC_CLASSIFIER_LR = float(os.getenv("TOPIC_CLASSIFIER_LR", "0.01"))
+TOPIC_CLASSIFIER_L2 = float(os.getenv("TOPIC_CLASSIFIER_L2", "1e-4"))
+# Adam steps taken on each correction batch
+TOPIC_CLASSIFIER_UPDATE_STEPS = int(os.getenv("TOPIC_CLASSIFIER_UPDATE_STEPS", "10"))
+_BATCH = 256
+
+
+def classifier_path(store_path) -> Path:
+    store_path = Path(store_path)
+    return store_path.with_name(store_path.name + CLASSIFIER_SUFFIX)
+
+
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-np.clip(z, -30, 30)))
+
+
+class TopicClassifier:
+    """
+    Multi-label topic model: a topic is predicted when its own logistic output is >= 0.5
+    (the single most likely topic if none is). Updates are serialized and swap in new
+    arrays, so predictions never wait on training.
+    """
+
+    def __init__(self, d: int, model: str, topics=()):
+        self.d = d
+        self.model = model
+        # (topics, (d, topics) weights, bias), replaced as a whole
+        self._state = (list(topics), np.zeros((d, len(topics)), dtype=np.float32), np.zeros(len(topics), dtype=np.float32))
+        self.updates = 0  # correction batches learned since training
+        self.unsaved = False  # learned something since the last save()
+        self._lock = threading.Lock()
+
+    @property
+    def topics(self):
+        return self._state[0]
+
+    def _targets(self, labels, state):
+        # Unseen topics (e.g. named in a correction) get a fresh column
+        topics, weights, bias = state
+        new = sorted({t for row in labels for t in row} - set(topics))
+        if new:
+            topics = topics + new
+            weights = np.hstack([weights, np.zeros((self.d, len(new)), dtype=np.float32)])
+            bias = np.append(bias, np.full(len(new), -4.0, dtype=np.float32))  # rare until shown otherwise
+        column = {t: i for i, t in enumerate(topics)}
+        targets = np.zeros((len(labels), len(topics)), dtype=np.float32)
+        for row, names in enumerate(labels):
+            targets[row, [column[t] for t in names]] = 1.0
+        return (topics, weights, bias), targets
+
+    def _adam(self, vectors, targets, weights, bias, steps_per_batch, epochs, lr, seed=0):
+        weights, bias = weights.astype(np.float32), bias.astype(np.float32)
+        m_w, v_w = np.zeros_like(weights), np.zeros_like(weights)
+        m_b, v_b = np.zeros_like(bias), np.zeros_like(bias)
+        rng = np.random.RandomState(seed)
+        t = 0
+        for _ in range(epochs):
+            order = rng.permutation(len(vectors))
+            for start in range(0, len(vectors), _BATCH):
+                x, y = vectors[order[start:start + _BATCH]], targets[order[start:start + _BATCH]]
+                for _ in range(steps_per_batch):
+                    t += 1
+                    error = _sigmoid(x @ weights + bias) - y
+                    g_w = x.T @ error / len(x) + TOPIC_CLASSIFIER_L2 * weights
+                    g_b = error.mean(axis=0)
+                    m_w = 0.9 * m_w + 0.1 * g_w
+                    v_w = 0.999 * v_w + 0.001 * g_w * g_w
+                    m_b = 0.9 * m_b + 0.1 * g_b
+                    v_b = 0.999 * v_b + 0.001 * g_b * g_b
+                    scale = lr * np.sqrt(1 - 0.999 ** t) / (1 - 0.9 ** t)
+                    weights -= scale * m_w / (np.sqrt(v_w) + 1e-8)
+                    bias -= scale * m_b / (np.sqrt(v_b) + 1e-8)
+        return weights, bias
+
+    def fit(self, vectors, labels, epochs: int = TOPIC_CLASSIFIER_EPOCHS, lr: float = TOPIC_CLASSIFIER_LR):
+        """
+        Train from scratch. vectors: (n, d) embeddings; labels: a list of topic names per row.
+        """
+        with self._lock:
+            empty = ([], np.zeros((self.d, 0), dtype=np.float32), np.zeros(0, dtype=np.float32))
+            self.updates = 0
+            if not len(labels):
+                self._state = empty
+                return
+            (topics, weights, _), targets = self._targets(labels, empty)
+            # Start each topic at its base rate rather than 50/50
+            rate = np.clip(targets.mean(axis=0), 1e-4, 1 - 1e-4)
+            bias = np.log(rate / (1 - rate)).astype(np.float32)
+            vectors = np.asarray(vectors, dtype=np.float32).reshape(len(labels), self.d)
+            weights, bias = self._adam(vectors, targets, weights, bias, 1, epochs, lr)
+            self._state = (topics, weights, bias)
+            self.unsaved = True
+
+    def partial_fit(self, vectors, labels, steps: int = TOPIC_CLASSIFIER_UPDATE_STEPS,
+                    lr: float = TOPIC_CLASSIFIER_LR):
+        """
+        Learn a batch of corrected questions; every topic not in a row's labels is a negative.
+        """
+        if not len(labels):
+            return
+        with self._lock:
+            (topics, weights, bias), targets = self._targets(labels, self._state)
+            vectors = np.asarray(vectors, dtype=np.float32).reshape(len(labels), self.d)
+            weights, bias = self._adam(vectors, targets, weights, bias, steps, 1, lr)
+            self._state = (topics, weights, bias)
+            self.updates += 1
+            self.unsaved = True
+
+    def predict(self, vector):
+        """
+        (topics, confidence) for one embedding. confidence is the least certain of the
+        decisions made: min(p of each chosen topic, 1 - p of each other topic).
+        """
+        topics, weights, bias = self._state
+        if not topics:
+            return [], 0.0
+        p = _sigmoid(np.asarray(vector, dtype=np.float32) @ weights + bias)
+        chosen = p >= 0.5
+        if not chosen.any():
+            chosen[np.argmax(p)] = True
+        confidence = p[chosen].min()
+        if not chosen.all():
+            confidence = min(confidence, 1.0 - p[~chosen].max())
+        return [topics[i] for i in np.flatnonzero(chosen)], float(confidence)
+
+    def save(self, path):
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        # The rename is under the lock too, so two saves can't swap in each other's half-written tmp
+        with self._lock:
+            with open(tmp, "wb") as f:
+                topics, weights, bias = self._state
+                np.savez(
+                    f, weights=weights, bias=bias,
+                    meta=np.frombuffer(json.dumps({
+                        "d": self.d, "model": self.model, "topics": topics, "updates": self.updates,
+                    }).encode("utf-8"), dtype=np.uint8),
+                )
+            os.replace(tmp, path)
+            self.unsaved = False
+
+    @classmethod
+    def load(cls, path, model: str, d: int):
+        """
+        The saved classifier, or None if missing or trained on other embeddings.
+        """
+        try:
+            with np.load(path) as data:
+                meta = json.loads(data["meta"].tobytes().decode("utf-8"))
+                if meta["model"] != model or meta["d"] != d:
+                    return None
+                classifier = cls(d, model)
+                classifier._state = (meta["topics"], data["weights"], data["bias"])
+                classifier.updates = meta["updates"]
+        except (OSError, KeyError, ValueError):
+            return None
+        return classifier
@@ -0,0 +1,106 @@
+import json
+import os
+import re
+
+from db_utils import topic_ids_from_names
+
+# Two-stage classification for subjects whose topics are modules with sub-topics
+# (MS-M1 -> M1.1, M1.2, ...; BIO-M1.1, BIO-M1.2 -> module BIO-M1). The question's module(s)
+# are picked first, from the neighbours' votes or a tiny text-only prompt, and GPT then picks
+# topics from only those modules rather than every candidate. Per subject, e.g.
+#   HIERARCHICAL_CLASSIFY_CONFIG='{"Mathematics Standard": {}, "Biology": {"first_stage": "prompt"}}'
+# first_stage is "votes" (falling back to the prompt when nobody voted) or "prompt".
+HIERARCHICAL_CLASSIFY_CONFIG = json.loads(os.getenv("HIERARCHICAL_CLASSIFY_CONFIG", "{}"))
+
+HIERARCHY_DEFAULTS = {
+    "first_stage": "votes",
+    "model": "gpt-4o-mini",  # for the module prompt
+    "module_share": 0.8,     # keep the best modules until they hold this share of the vote...
+    "max_modules": 2,        # ...but no more than this many
+}
+
+# "M1.2" / "BIO-M1.2" -> "M1" / "BIO-M1"
+_SUBTOPIC = re.compile(r"^(.+)\.\d+$")
+
+
+def hierarchy_config(subject: str):
+    """
+    The subject's two-stage settings, or None if it's classified in one go.
+    """
+    if subject not in HIERARCHICAL_CLASSIFY_CONFIG:
+        return None
+    config = {**HIERARCHY_DEFAULTS, **HIERARCHICAL_CLASSIFY_CONFIG[subject]}
+    if config["first_stage"] not in ("votes", "prompt"):
+        raise ValueError(f"Unknown first_stage {config['first_stage']!r} for {subject}")
+    return config
+
+
+def _short_name(doc):
+    # "M1.1: Practicalities of Measurement (Year 11)" -> "Practicalities of Measurement (Year 11)"
+    name = doc["name"]
+    return name.split(": ", 1)[1] if name.startswith(doc["TopicId"]) and ": " in name else name
+
+
+class TopicHierarchy:
+    """
+    A subject's modules, built from its documents in the topics collection. A sub-topic's
+    module is the topic whose id ends with the same prefix (M1.1 -> MS-M1), or just the prefix
+    (BIO-M1) when there's no such topic. Topics that are neither are modules of their own.
+    """
+
+    def __init__(self, topic_docs):
+        topic_docs = sorted(topic_docs, key=lambda t: t["TopicId"])
+        by_suffix = {t["TopicId"].split("-")[-1]: t for t in topic_docs if not _SUBTOPIC.match(t["TopicId"])}
+
+        self.modules = {}    # module id -> {"name": str, "topics": [topic name]}
+        self.module_of = {}  # TopicId -> module id
+        for t in topic_docs:
+            match = _SUBTOPIC.match(t["TopicId"])
+            parent = by_suffix.get(match.group(1).split("-")[-1]) if match else None
+            if match and parent is None:
+                module_id = match.group(1)
+                self.modules.setdefault(module_id, {"name": None, "topics": []})
+            else:
+                parent = parent or t
+                module_id = parent["TopicId"]
+                self.modules.setdefault(module_id, {"name": None, "topics": []})["name"] = _short_name(parent)
+            self.modules[module_id]["topics"].append(t["name"])
+            self.module_of[t["TopicId"]] = module_id
+
+        # Prefix-only modules are described by their sub-topics
+        for module_id, module in self.modules.items():
+            if module["name"] is None:
+                module["name"] = "; ".join(
+                    _short_name(t) for t in topic_docs if self.module_of[t["TopicId"]] == module_id
+                )
+
+    def module_votes(self, topic_votes):
+        """
+        [(module id, votes)] best first, summing the neighbours' topic votes per module.
+        """
+        scores = {}
+        for (topic, votes), topic_id in zip(topic_votes, topic_ids_from_names([t for t, _ in topic_votes])):
+            module_id = self.module_of.get(topic_id)
+            if module_id is not None:
+                scores[module_id] = scores.get(module_id, 0.0) + votes
+        return sorted(scores.items(), key=lambda kv: -kv[1])
+
+    def topics_of(self, module_ids):
+        """
+        Topic names of the given modules, always in the same (module id, TopicId) order.
+        """
+        return [name for module_id in sorted(module_ids) for name in self.modules[module_id]["topics"]]
+
+
+def pick_modules(module_votes, config):
+    """
+    The fewest best-voted modules holding `module_share` of the vote, at most `max_modules`.
+    """
+    total = sum(votes for _, votes in module_votes)
+    picked, held = [], 0.0
+    for module_id, votes in module_votes[:config["max_modules"]]:
+        picked.append(module_id)
+        held += votes
+        if held >= config["module_share"] * total:
+            break
+    return picked
@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+
+# Neighbours closer than this (cosine similarity) vote on an upload's topics, up to
+# TOPIC_VOTE_MAX_NEIGHBORS of them; if none are that close, the nearest
+# TOPIC_VOTE_MIN_NEIGHBORS vote anyway so GPT always gets a candidate list
+TOPIC_VOTE_MIN_SIMILARITY = float(os.getenv("TOPIC_VOTE_MIN_SIMILARITY", "0.3"))
+TOPIC_VOTE_MAX_NEIGHBORS = int(os.getenv("TOPIC_VOTE_MAX_NEIGHBORS", "150"))
+TOPIC_VOTE_MIN_NEIGHBORS = int(os.getenv("TOPIC_VOTE_MIN_NEIGHBORS", "10"))
+
+
+def similarities(distances):
+    """
+    Cosine similarity from the squared L2 distances search_store returns; the stored
+    embeddings are unit length, so |a - b|^2 = 2 - 2 cos.
+    """
+    return 1.0 - np.asarray(distances, dtype="float32") / 2.0
+
+
+class TopicMatrix:
+    """
+    Multi-hot question x topic matrix over metadata["topics"], so an upload's topic priors are
+    one product of its neighbours' similarities with their rows. A QuestionIndex observer:
+    rows are reused after deletes and columns added as new topic names appear.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._matrix = np.zeros((0, 0), dtype=np.uint8)
+        self._row_by_qid = {}
+        self._free_rows = []
+        self._column_by_topic = {}
+        self.topics = []  # column -> topic name
+
+    def _grow(self, rows: int, columns: int):
+        have_rows, have_columns = self._matrix.shape
+        if rows <= have_rows and columns <= have_columns:
+            return
+        grown = np.zeros(
+            (max(rows, 2 * have_rows, 64), max(columns, 2 * have_columns, 16)), dtype=np.uint8,
+        )
+        grown[:have_rows, :have_columns] = self._matrix
+        self._matrix = grown
+
+    def _column(self, topic: str) -> int:
+        column = self._column_by_topic.get(topic)
+        if column is None:
+            column = self._column_by_topic[topic] = len(self.topics)
+            self.topics.append(topic)
+        return column
+
+    def on_add(self, question_id: str, doc):
+        self.on_remove(question_id)
+        topics = doc.metadata.get("topics") or []
+        if not topics:
+            return
+        columns = [self._column(t) for t in topics]
+        if self._free_rows:
+            row = self._free_rows.pop()
+        else:
+            row = len(self._row_by_qid)
+        self._grow(row + 1, len(self.topics))
+        self._matrix[row, columns] = 1
+        self._row_by_qid[question_id] = row
+
+    def on_remove(self, question_id: str):
+        row = self._row_by_qid.pop(question_id, None)
+        if row is not None:
+            self._matrix[row] = 0
+            self._free_rows.append(row)
+
+    def vote(self, hits, min_similarity: float = TOPIC_VOTE_MIN_SIMILARITY,
+             min_neighbors: int = TOPIC_VOTE_MIN_NEIGHBORS) -> dict:
+        """
+        hits: [(Document, squared L2 distance)] nearest first, as from QuestionIndex.search.
+
+            {"topics": [(topic, similarity-weighted votes)] best first,
+             "voters": number of neighbours that voted,
+             "consensus": topics of the topic set with the most vote weight,
+             "agreement": that set's share of the vote weight,
+             "margin": agreement minus the runner-up set's share,
+             "similarity": similarity of the nearest voter with that set}
+        """
+        rows = [self._row_by_qid.get(str(doc.metadata.get("question_id"))) for doc, _ in hits]
+        sims = similarities([distance for _, distance in hits])
+        tagged = np.array([row is not None for row in rows], dtype=bool)
+        voters = tagged & (sims >= min_similarity)
+        if not voters.any():
+            voters = tagged & (np.cumsum(tagged) <= min_neighbors)
+        if not voters.any():
+            return {"topics": [], "voters": 0, "consensus": [], "agreement": 0.0, "margin": 0.0, "similarity": 0.0}
+
+        rows = np.array([row for row, keep in zip(rows, voters) if keep])
+        weights = np.maximum(sims[voters], 1e-6).astype(np.float64)
+        hot = self._matrix[rows, :len(self.topics)]
+        scores = weights @ hot
+        order = np.flatnonzero(scores)[np.argsort(-scores[scores > 0], kind="stable")]
+
+        # Whole topic sets: voters with identical rows agree
+        sets, which = np.unique(hot, axis=0, return_inverse=True)
+        set_weights = np.bincount(which.ravel(), weights=weights) / weights.sum()
+        ranked = np.argsort(-set_weights, kind="stable")
+        best = ranked[0]
+        runner_up = set_weights[ranked[1]] if len(ranked) > 1 else 0.0
+        return {
+            "topics": [(self.topics[c], float(scores[c])) for c in order],
+            "voters": int(voters.sum()),
+            "consensus": [self.topics[c] for c in np.flatnonzero(sets[best])],
+            "agreement": float(set_weights[best]),
+            "margin": float(set_weights[best] - runner_up),
+            "similarity": float(sims[voters][which.ravel() == best].max()),
+        }
+
+    def __len__(self) -> int:
+        return len(self._row_by_qid)
@@ -0,0 +1,397 @@
+import base64
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from concurrency_utils import SubjectLocks
+from vectorstore_utils import clone_vectorstore
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, so a single worker is assumed
+    fcntl = None
+
+# A subject's snapshot is rewritten once this many mutations are pending in its WAL,
+# or once the oldest pending mutation is this many seconds old, whichever comes first
+SNAPSHOT_EVERY_MUTATIONS = int(os.getenv("SNAPSHOT_EVERY_MUTATIONS", "200"))
+SNAPSHOT_EVERY_SECONDS = float(os.getenv("SNAPSHOT_EVERY_SECONDS", "60"))
+# fsync every WAL append (durable across power loss, ~ms per request); 0 = flush only
+WAL_FSYNC = os.getenv("WAL_FSYNC", "1") == "1"
+
+WAL_SUFFIX = ".wal"
+ROTATED_SUFFIX = ".flushing"
+LOCK_SUFFIX = ".lock"
+
+# Each uvicorn worker logs to its own WAL (faiss_indexes/advanced.<worker>.wal), so workers
+# never interleave records; a log whose worker is gone is replayed by the next one to start
+WORKER_ID = f"{os.getpid()}-{int(time.time() * 1000)}"
+
+
+def _worker_alive(worker_id: str) -> bool:
+    try:
+        pid = int(worker_id.split("-")[0])
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        # Same pid, earlier start: a previous run (containers reuse pids)
+        return worker_id == WORKER_ID
+    if os.name == "nt":
+        return False  # os.kill would signal it rather than probe it
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+@contextmanager
+def snapshot_lock(path):
+    """
+    Exclusive lock on one store's snapshot across worker processes (and threads), held while
+    it is loaded and recovered at startup and while a flush writes it: faiss_indexes/advanced.lock.
+    """
+    path = Path(path)
+    lock_path = path.with_name(path.name + LOCK_SUFFIX)
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _encode(record: dict) -> dict:
+    if "vector" not in record:
+        return record
+    vector = np.asarray(record["vector"], dtype="float32")
+    return {**record, "vector": base64.b64encode(vector.tobytes()).decode("ascii")}
+
+
+def _decode(record: dict) -> dict:
+    if "vector" not in record:
+        return record
+    return {**record, "vector": np.frombuffer(base64.b64decode(record["vector"]), dtype="float32")}
+
+
+class WriteAheadLog:
+    """
+    Append-only JSON-lines log of one subject's QuestionIndex mutations in one worker, kept
+    next to its snapshot folder (faiss_indexes/advanced.<worker>.wal). Vectors are stored
+    with each record, so replaying never calls the embeddings API.
+
+    A snapshot flush rotates the live log to .wal.flushing and deletes that file only once
+    the snapshot is on disk. A crash at any point leaves snapshot + logs that replay to the
+    latest state, because replaying a record the snapshot already has is a no-op.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.rotated = self.path.with_name(self.path.name + ROTATED_SUFFIX)
+        self.pending = 0
+        self.first_pending_at = None
+        self._lock = threading.Lock()
+        self._file = None
+
+    def append(self, record: dict):
+        line = json.dumps(_encode(record), ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+            if WAL_FSYNC:
+                os.fsync(self._file.fileno())
+            self.pending += 1
+            if self.first_pending_at is None:
+                self.first_pending_at = time.monotonic()
+
+    def records(self, rotated_only: bool = False):
+        """
+        Every logged record, oldest first (rotated log, then live log).
+        """
+        for path in (self.rotated,) if rotated_only else (self.rotated, self.path):
+            if not path.exists():
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for n, line in enumerate(f, 1):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Only the last line can be torn (crash mid-append); nothing after it was acknowledged
+                        print(f"⚠️ Ignoring torn record at {path}:{n}")
+                        break
+                    yield _decode(record)
+
+    def exists(self) -> bool:
+        return self.path.exists() or self.rotated.exists()
+
+    def rotate(self) -> int:
+        """
+        Start a fresh live log. The old one is kept as .wal.flushing until
+        discard_rotated(). Returns how many pending records were rotated out.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self.path.exists():
+                if self.rotated.exists():
+                    # An earlier flush failed; its records still need the next snapshot too
+                    with open(self.rotated, "a", encoding="utf-8") as dst, \
+                            open(self.path, "r", encoding="utf-8") as src:
+                        dst.write(src.read())
+                        dst.flush()
+                        os.fsync(dst.fileno())
+                    os.remove(self.path)
+                else:
+                    os.replace(self.path, self.rotated)
+            rotated, self.pending, self.first_pending_at = self.pending, 0, None
+            return rotated
+
+    def requeue(self, count: int):
+        """
+        Count rotated records as pending again after a failed snapshot.
+        """
+        with self._lock:
+            self.pending += count
+            if self.first_pending_at is None:
+                self.first_pending_at = time.monotonic()
+
+    def discard_rotated(self):
+        if self.rotated.exists():
+            os.remove(self.rotated)
+
+    def discard(self):
+        """
+        Delete both files (a recovered log whose records are now in the snapshot).
+        """
+        self.close()
+        for path in (self.rotated, self.path):
+            if path.exists():
+                os.remove(path)
+
+    def reset(self):
+        """
+        Drop everything logged so far (the caller has just saved a snapshot that has it).
+        """
+        self.rotate()
+        self.discard_rotated()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def _worker_logs(path: Path):
+    """
+    (WriteAheadLogs next to a snapshot whose workers are gone, ids of other live workers
+    with logs there). The single <store>.wal of versions before per-worker logs counts as gone.
+    """
+    orphans, live = {}, set()
+    prefix = path.name + "."
+    for file in path.parent.glob(prefix + "*"):
+        name = file.name
+        if name.endswith(ROTATED_SUFFIX):
+            name = name[:-len(ROTATED_SUFFIX)]
+        if not name.endswith(WAL_SUFFIX) or name in orphans:
+            continue
+        worker_id = name[len(prefix):-len(WAL_SUFFIX)]
+        if worker_id and _worker_alive(worker_id):
+            if worker_id != WORKER_ID:
+                live.add(worker_id)
+            continue
+        orphans[name] = WriteAheadLog(file.with_name(name))
+    return list(orphans.values()), live
+
+
+class WriteBehindPersister:
+    """
+    Keeps request handlers off the snapshot path. Mutations go to each subject's
+    WriteAheadLog (via QuestionIndex.journal); a background thread writes full snapshots
+    when SNAPSHOT_EVERY_MUTATIONS / SNAPSHOT_EVERY_SECONDS say so, and stop() does a
+    final flush on shutdown.
+
+    Mutate a subject only inside `with persister.writing(subject) as qindex:`, which holds
+    the subject's write lock. A flush holds the read lock just long enough to clone the
+    store and rotate the log, so searches carry on while the snapshot is written.
+
+    With a merge_fn (memory-mapped stores shared by several workers), a flush doesn't write
+    this worker's copy of the store: merge_fn(subject, path, records) applies the rotated
+    records to the snapshot currently on disk, which other workers may have written since,
+    and writes that. If nobody else had, the merged snapshot is exactly this worker's store,
+    so rebase_fn(vs, path) maps it in place of the in-memory delta.
+
+    extras_fn(subject) saves whatever else is kept beside a subject's snapshot (its topic
+    model). It runs on the snapshot writer after every snapshot and once more in stop(), so
+    request threads never write those files.
+    """
+
+    def __init__(self, save_fn, locks: SubjectLocks = None,
+                 every_mutations: int = SNAPSHOT_EVERY_MUTATIONS,
+                 every_seconds: float = SNAPSHOT_EVERY_SECONDS,
+                 merge_fn=None, rebase_fn=None, extras_fn=None):
+        self.save_fn = save_fn  # save_fn(vs, path, ann)
+        self.merge_fn = merge_fn  # merge_fn(subject, path, records) -> generation merged onto
+        self.rebase_fn = rebase_fn  # rebase_fn(vs, path)
+        self.extras_fn = extras_fn  # extras_fn(subject)
+        self.locks = locks if locks is not None else SubjectLocks()
+        self.every_mutations = every_mutations
+        self.every_seconds = every_seconds
+        self._subjects = {}     # subject -> (QuestionIndex, snapshot path, WriteAheadLog)
+        self._orphans = {}      # subject -> WriteAheadLogs of workers that are gone
+        self._flush_locks = {}  # subject -> one snapshot write at a time
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def register(self, subject, qindex, path) -> WriteAheadLog:
+        """
+        Start this worker's WAL for a subject and pick up the logs of workers that are gone
+        (call under snapshot_lock, so two starting workers don't both claim them).
+        """
+        path = Path(path)
+        wal = WriteAheadLog(path.with_name(f"{path.name}.{WORKER_ID}{WAL_SUFFIX}"))
+        qindex.journal = wal
+        self._subjects[subject] = (qindex, path, wal)
+        self._orphans[subject], live = _worker_logs(path)
+        if live and self.merge_fn is None:
+            print(f"⚠️ {len(live)} other worker(s) also write {path}; without VECTORSTORE_MMAP=1 "
+                  f"their snapshots overwrite each other")
+        self._flush_locks[subject] = threading.Lock()
+        return wal
+
+    def replay(self, subject) -> int:
+        """
+        Apply the logs left by workers that are gone on top of the snapshot.
+        """
+        qindex, _, _ = self._subjects[subject]
+        count = 0
+        with self.locks.write(subject):
+            for orphan in self._orphans[subject]:
+                for record in orphan.records():
+                    qindex.apply(record)
+                    count += 1
+        return count
+
+    def has_orphans(self, subject) -> bool:
+        return bool(self._orphans[subject])
+
+    def discard_orphans(self, subject):
+        """
+        Delete the recovered logs once a snapshot holds their records.
+        """
+        for orphan in self._orphans.pop(subject, []):
+            orphan.discard()
+        self._orphans[subject] = []
+
+    @contextmanager
+    def writing(self, subject):
+        qindex, _, wal = self._subjects[subject]
+        with self.locks.write(subject):
+            yield qindex
+        if wal.pending >= self.every_mutations:
+            self._wake.set()
+
+    def _due(self, wal: WriteAheadLog) -> bool:
+        if wal.pending >= self.every_mutations:
+            return True
+        started = wal.first_pending_at
+        return started is not None and time.monotonic() - started >= self.every_seconds
+
+    def flush(self, subject) -> bool:
+        """
+        Snapshot one subject now if anything is pending. Returns True if a snapshot was written.
+        """
+        qindex, path, wal = self._subjects[subject]
+        with self._flush_locks[subject], snapshot_lock(path):
+            with self.locks.read(subject):
+                if wal.pending == 0 and not wal.rotated.exists():
+                    return False
+                if self.merge_fn is None:
+                    snapshot = clone_vectorstore(qindex.vs)
+                    ann = qindex.ann.clone() if qindex.ann is not None else None
+                rotated = wal.rotate()
+
+            started = time.perf_counter()
+            try:
+                if self.merge_fn is None:
+                    self.save_fn(snapshot, path, ann)
+                else:
+                    merged_onto = self.merge_fn(subject, path, wal.records(rotated_only=True))
+            except Exception as e:
+                # The rotated log stays on disk and is folded into the next attempt
+                wal.requeue(rotated)
+                print(f"⚠️ Snapshot of {subject} failed, will retry: {e}")
+                return False
+
+            wal.discard_rotated()
+            print(f"💾 Snapshot of {subject}: {rotated} mutations in {time.perf_counter() - started:.2f}s")
+
+            if self.merge_fn is not None:
+                with self.locks.write(subject):
+                    # Nothing changed here since the rotate and nobody else wrote before us
+                    if wal.pending == 0 and getattr(qindex.vs, "generation", None) == merged_onto:
+                        try:
+                            self.rebase_fn(qindex.vs, path)
+                        except Exception as e:
+                            # Still correct, just keeps the delta in memory until the next flush
+                            print(f"⚠️ Could not map the new snapshot of {subject}: {e}")
+            self._save_extras(subject)
+            return True
+
+    def _save_extras(self, subject):
+        if self.extras_fn is None:
+            return
+        try:
+            self.extras_fn(subject)
+        except Exception as e:
+            # Retried after the next snapshot
+            print(f"⚠️ Saving {subject}'s extras failed: {e}")
+
+    def flush_all(self):
+        for subject in list(self._subjects):
+            self.flush(subject)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(timeout=1.0)
+            self._wake.clear()
+            # Subjects register while the server warms up, so iterate over a copy
+            for subject, (_, _, wal) in list(self._subjects.items()):
+                if self._stop.is_set():
+                    break
+                if self._due(wal):
+                    self.flush(subject)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background writer and flush whatever is still pending.
+        """
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush_all()
+        for subject, (_, _, wal) in self._subjects.items():
+            # Also covers extras that changed without a snapshot to write
+            self._save_extras(subject)
+            wal.close()
@@ -0,0 +1,905 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+
+from ann_index import build_ann
+from db_utils import topic_ids_from_names
+from quantization import ExactVectors, effective_quantization, new_codes_index, rerank, same_quantization
+
+# Bump this whenever the on-disk layout changes
+SNAPSHOT_VERSION = 2
+# Older layouts load_snapshot still reads (1: docstore.json instead of the flat docstore)
+READABLE_SNAPSHOT_VERSIONS = (1, 2)
+
+MANIFEST_FILE = "manifest.json"
+INDEX_FILE = "index.faiss"
+DOCSTORE_FILE = "docstore.json"  # version 1 only
+
+# Streaming index builds: texts are grouped into batches of roughly this many tokens
+# (estimated at 4 chars/token) and up to EMBED_CONCURRENCY batches are embedded at once
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "50000"))
+EMBED_BATCH_MAX_TEXTS = 1000
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+
+# metadata["origin"] of questions /classify/ added to a store but that only reach MongoDB
+# once corrected; sync_vectorstore doesn't delete them for being missing from MongoDB
+CLASSIFY_ORIGIN = "classify"
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot is missing, incomplete or fails verification."""
+
+
+class SnapshotMismatchError(SnapshotError):
+    """Raised when a snapshot is intact but was built with a different embedding model."""
+
+
+def _sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _fsync_dir(path: Path):
+    # Make the rename durable; not supported on every platform, so best effort
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _backup_path(folder: Path) -> Path:
+    return folder.with_name(folder.name + ".old")
+
+
+def _store_classes():
+    # langchain_community is slow to import, so it's only pulled in once a store is built or loaded
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+    return FAISS, InMemoryDocstore
+
+
+def _mapped_store():
+    # Same reason: mapped_store subclasses langchain_community's docstore
+    import mapped_store
+    return mapped_store
+
+
+def is_mapped(vs: "FAISS") -> bool:
+    """
+    True for a store loaded with load_snapshot(mmap=True) (a mapped_store.DeltaIndex).
+    """
+    return hasattr(vs.index, "swap_remove")
+
+
+def empty_vectorstore(embeddings, dimension: int) -> "FAISS":
+    """
+    Build an empty FAISS store without calling the embeddings API.
+    """
+    FAISS, InMemoryDocstore = _store_classes()
+    return FAISS(
+        embedding_function=embeddings,
+        index=faiss.IndexFlatL2(dimension),
+        docstore=InMemoryDocstore({}),
+        index_to_docstore_id={},
+    )
+
+
+def clone_vectorstore(vs: "FAISS") -> "FAISS":
+    """
+    Point-in-time copy of a store that can be serialized while the original keeps
+    changing. Vectors are memcpy'd and docs shallow-copied, so this is cheap next to
+    save_snapshot itself.
+    """
+    FAISS, InMemoryDocstore = _store_classes()
+    if is_mapped(vs):
+        # Only the in-memory delta is copied; the mapped snapshot is shared
+        index, docstore = vs.index.clone(), vs.docstore.clone()
+    else:
+        index = faiss.clone_index(vs.index)
+        docstore = InMemoryDocstore({
+            doc_id: Document(page_content=doc.page_content, metadata=dict(doc.metadata))
+            for doc_id, doc in vs.docstore._dict.items()
+        })
+    clone = FAISS(
+        embedding_function=vs.embedding_function,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=dict(vs.index_to_docstore_id),
+        normalize_L2=getattr(vs, "_normalize_L2", False),
+        distance_strategy=vs.distance_strategy,
+    )
+    exact = exact_vectors_of(vs)
+    clone.exact_vectors = exact.clone() if exact is not None else None
+    return clone
+
+
+def exact_vectors_of(vs: "FAISS"):
+    """
+    The quantization.ExactVectors behind a quantized store, or None for a float32 one.
+    """
+    return getattr(vs, "exact_vectors", None)
+
+
+def store_vectors(vs: "FAISS"):
+    """
+    Full-precision vectors of a store in position order, as an (ntotal, d) array (a copy).
+    """
+    exact = exact_vectors_of(vs)
+    if exact is not None:
+        ids = [vs.index_to_docstore_id[i] for i in range(vs.index.ntotal)]
+        return exact.get(ids)
+    if vs.index.ntotal == 0:
+        return np.empty((0, vs.index.d), dtype="float32")
+    return vs.index.reconstruct_n(0, vs.index.ntotal)
+
+
+def quantize_store(vs: "FAISS", quant: dict) -> bool:
+    """
+    Re-encode a store's index for a quantization (see quantization.resolve_quantization),
+    from the vectors it already holds: float32 -> codes keeps the originals as ExactVectors,
+    codes -> float32 restores them from there. Nothing is re-embedded. Returns True if the
+    index changed.
+    """
+    quant = effective_quantization(quant, vs.index.ntotal)
+    if same_quantization(vs.index, quant):
+        exact = exact_vectors_of(vs)
+        if exact is not None:
+            exact.quant = quant  # rerank depth is a search setting, no re-encode needed
+        return False
+
+    ids = [vs.index_to_docstore_id[i] for i in range(vs.index.ntotal)]
+    vectors = store_vectors(vs)
+    if quant["mode"] == "none":
+        index = faiss.IndexFlatL2(vs.index.d)
+        exact = None
+    else:
+        index = new_codes_index(quant, vs.index.d, vectors)
+        exact = ExactVectors.from_array(vs.index.d, quant, ids, vectors)
+    if len(vectors):
+        index.add(vectors)
+    vs.index = index
+    vs.exact_vectors = exact
+    return True
+
+
+def reopen_snapshot(vs: "FAISS", folder, mmap: bool = False):
+    """
+    Point a store at the snapshot just saved from it to `folder`, dropping what it holds in
+    memory: a quantized store's ExactVectors overlay and, with mmap=True, the index and
+    docstore, which are mapped instead. Only valid while nothing has changed since that save.
+    """
+    ids = [vs.index_to_docstore_id[i] for i in range(vs.index.ntotal)]
+    if mmap:
+        snapshot = load_snapshot(folder, vs.embedding_function, None, mmap=True, verify=False)
+        if [snapshot.index_to_docstore_id[i] for i in range(snapshot.index.ntotal)] != ids:
+            raise SnapshotError(f"Snapshot in {folder} does not match the store it was saved from")
+        vs.index, vs.docstore = snapshot.index, snapshot.docstore
+        vs.exact_vectors, vs.generation = snapshot.exact_vectors, snapshot.generation
+        return
+    exact = exact_vectors_of(vs)
+    if exact is not None and exact.overlay_size():
+        vs.exact_vectors = ExactVectors.open(folder, exact.quant, ids)
+
+
+def save_snapshot(vs: "FAISS", folder, model: str, ann=None):
+    """
+    Write a versioned snapshot of a FAISS store:
+
+        manifest.json         -> version, model, dimension, count, generation, sha256 per file
+        index.faiss           -> raw FAISS index (always a flat(-codes) one, so it can be mapped)
+        docstore.jsonl        -> docstore ids in position order, then [page_content, metadata] per position
+        docstore_offsets.npy  -> byte offset of each doc line, so the docstore can be mapped (mapped_store.py)
+        vectors.npy           -> float32 vectors of a quantized index, described under manifest["quantization"]
+        ann.*                 -> optional ann_index.AnnIndex, described under manifest["ann"]
+
+    Everything is written to a temp directory next to `folder` and renamed into place,
+    so a crash mid-write leaves the previous snapshot untouched.
+    """
+    folder = Path(folder)
+    folder.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=f".{folder.name}.tmp-", dir=folder.parent))
+
+    try:
+        # A mapped store's vectors are spread over the snapshot it was loaded from and its delta
+        index = vs.index.materialize() if is_mapped(vs) else vs.index
+        faiss.write_index(index, str(tmp / INDEX_FILE))
+        del index
+
+        # Vector positions are contiguous (0..ntotal-1), so a list is enough for the id map
+        ids = [vs.index_to_docstore_id[i] for i in range(len(vs.index_to_docstore_id))]
+        files = [INDEX_FILE] + _mapped_store().write_docs(tmp, ids, vs.docstore._dict)
+        files += ann.write(tmp) if ann is not None else []
+        exact = exact_vectors_of(vs)
+        if exact is not None:
+            files += exact.write(tmp, ids)
+        manifest = {
+            "version": SNAPSHOT_VERSION,
+            "model": model,
+            "dimension": vs.index.d,
+            "count": vs.index.ntotal,
+            # Changes with every write, so a worker can tell whether the snapshot on disk is
+            # still the one it loaded
+            "generation": uuid.uuid4().hex,
+            "created_at": time.time(),
+            "checksums": {name: _sha256_file(tmp / name) for name in files},
+        }
+        if ann is not None:
+            manifest["ann"] = ann.describe()
+        if exact is not None:
+            manifest["quantization"] = exact.describe(vs.index)
+        # The manifest is written last: a directory without one is never a valid snapshot
+        with open(tmp / MANIFEST_FILE, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Swap into place: current -> .old, tmp -> current, drop .old
+        backup = _backup_path(folder)
+        if backup.exists():
+            shutil.rmtree(backup)
+        if folder.exists():
+            os.rename(folder, backup)
+        os.rename(tmp, folder)
+        _fsync_dir(folder.parent)
+        shutil.rmtree(backup, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    vs.generation = manifest["generation"]
+
+
+def read_manifest(folder) -> dict:
+    path = Path(folder) / MANIFEST_FILE
+    if not path.exists():
+        raise SnapshotError(f"No manifest in {folder}")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f"Unreadable manifest in {folder}: {e}")
+
+
+def verify_snapshot(folder, model: str = None, dimension: int = None) -> dict:
+    """
+    Check the manifest, versions and checksums of a snapshot. Returns the manifest.
+    """
+    folder = Path(folder)
+    manifest = read_manifest(folder)
+
+    if manifest.get("version") not in READABLE_SNAPSHOT_VERSIONS:
+        raise SnapshotError(
+            f"Snapshot version {manifest.get('version')} in {folder} is not one of {READABLE_SNAPSHOT_VERSIONS}"
+        )
+    if model is not None and manifest.get("model") != model:
+        raise SnapshotMismatchError(
+            f"Snapshot in {folder} was built with '{manifest.get('model')}', expected '{model}'"
+        )
+    if dimension is not None and manifest.get("dimension") != dimension:
+        raise SnapshotMismatchError(
+            f"Snapshot in {folder} has dimension {manifest.get('dimension')}, expected {dimension}"
+        )
+
+    for name, expected in manifest.get("checksums", {}).items():
+        path = folder / name
+        if not path.exists():
+            raise SnapshotError(f"Snapshot in {folder} is missing {name}")
+        if _sha256_file(path) != expected:
+            raise SnapshotError(f"Checksum mismatch for {name} in {folder}")
+
+    return manifest
+
+
+def _recover_interrupted_swap(folder: Path):
+    # A crash between the two renames in save_snapshot leaves only the .old copy behind
+    backup = _backup_path(folder)
+    if backup.exists() and not (folder / MANIFEST_FILE).exists():
+        if folder.exists():
+            shutil.rmtree(folder)
+        os.rename(backup, folder)
+        print(f"Recovered snapshot {folder} from interrupted write.")
+
+
+def load_snapshot(folder, embeddings, model: str, dimension: int = None,
+                  mmap: bool = False, verify: bool = True) -> "FAISS":
+    """
+    Load a snapshot written by save_snapshot. Raises SnapshotError (or
+    SnapshotMismatchError for a different model/dimension) instead of returning
+    a half-loaded store.
+
+    With mmap=True the index and docstore are memory-mapped read-only rather than read
+    (see mapped_store.py); changes after that stay in memory until the next snapshot.
+    Version 1 snapshots predate the flat docstore and are always read into memory.
+    verify=False skips the checksums, for re-opening a snapshot this process just wrote.
+    """
+    folder = Path(folder)
+    _recover_interrupted_swap(folder)
+    if verify:
+        manifest = verify_snapshot(folder, model=model, dimension=dimension)
+    else:
+        manifest = read_manifest(folder)
+
+    FAISS, InMemoryDocstore = _store_classes()
+    if manifest.get("version") == 1:
+        index = faiss.read_index(str(folder / INDEX_FILE))
+        with open(folder / DOCSTORE_FILE, "r", encoding="utf-8") as f:
+            payload = json.load(f)
+        ids = payload["ids"]
+        docstore = InMemoryDocstore({
+            doc_id: Document(page_content=content, metadata=metadata)
+            for doc_id, (content, metadata) in payload["docs"].items()
+        })
+    elif mmap:
+        mapped_store = _mapped_store()
+        index = mapped_store.DeltaIndex.open(folder / INDEX_FILE)
+        docstore, ids = mapped_store.MappedDocstore.open(folder)
+    else:
+        index = faiss.read_index(str(folder / INDEX_FILE))
+        ids, docs = _mapped_store().read_docs(folder)
+        docstore = InMemoryDocstore(docs)
+
+    if len(ids) != index.ntotal:
+        raise SnapshotError(f"Snapshot in {folder} has {index.ntotal} vectors but {len(ids)} ids")
+
+    vs = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=dict(enumerate(ids)),
+    )
+    quant = manifest.get("quantization")
+    vs.exact_vectors = None
+    if quant:
+        quant = {key: value for key, value in quant.items() if key != "bytes_per_vector"}
+        vs.exact_vectors = ExactVectors.open(folder, quant, ids)
+    vs.generation = manifest.get("generation")
+    return vs
+
+
+def content_hash(text: str, topic_ids) -> str:
+    """
+    Hash of what a question contributes to the index: its text plus its topic ids.
+    """
+    h = hashlib.sha256()
+    h.update((text or "").strip().encode("utf-8"))
+    h.update(b"\x00")
+    h.update("\x1f".join(sorted(str(t) for t in topic_ids or [])).encode("utf-8"))
+    return h.hexdigest()
+
+
+def doc_content_hash(doc: Document) -> str:
+    # Docs added by /classify/ before topic_ids were stored only carry topic names
+    topic_ids = doc.metadata.get("topic_ids")
+    if topic_ids is None:
+        topic_ids = topic_ids_from_names(doc.metadata.get("topics", []))
+    return content_hash(doc.page_content, topic_ids)
+
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def batch_documents(docs, max_tokens: int = EMBED_BATCH_TOKENS, max_texts: int = EMBED_BATCH_MAX_TEXTS):
+    """
+    Group an iterable of Documents into lists bounded by estimated tokens and count.
+    """
+    batch = []
+    tokens = 0
+    for doc in docs:
+        doc_tokens = _estimate_tokens(doc.page_content)
+        if batch and (tokens + doc_tokens > max_tokens or len(batch) >= max_texts):
+            yield batch
+            batch = []
+            tokens = 0
+        batch.append(doc)
+        tokens += doc_tokens
+    if batch:
+        yield batch
+
+
+def add_documents_streaming(vs: "FAISS", docs, max_tokens: int = EMBED_BATCH_TOKENS,
+                            concurrency: int = EMBED_CONCURRENCY) -> int:
+    """
+    Embed and append `docs` (any iterable, e.g. a Mongo cursor) to `vs` batch by batch.
+
+    At most `concurrency` batches are in flight, and each batch is added to the index as
+    soon as its embeddings come back, so memory stays flat however many docs there are.
+    Returns the number of docs added.
+    """
+    added = 0
+    in_flight = deque()
+
+    def _drain_one():
+        nonlocal added
+        batch, future = in_flight.popleft()
+        vectors = future.result()
+        ids = vs.add_embeddings(
+            list(zip((d.page_content for d in batch), vectors)),
+            metadatas=[d.metadata for d in batch],
+        )
+        exact = exact_vectors_of(vs)
+        if exact is not None:
+            exact.put(ids, vectors)
+        added += len(batch)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for batch in batch_documents(docs, max_tokens=max_tokens):
+            future = pool.submit(vs.embeddings.embed_documents, [d.page_content for d in batch])
+            in_flight.append((batch, future))
+            if len(in_flight) >= concurrency:
+                _drain_one()
+        while in_flight:
+            _drain_one()
+
+    return added
+
+
+def sync_vectorstore(vs: "FAISS", docs, prepare=None, batch_size: int = 500) -> dict:
+    """
+    Bring `vs` in line with `docs` (the source of truth, one Document per question_id)
+    without re-embedding what is already there:
+
+      - new question_id            -> embed + add
+      - text changed               -> delete old vector, embed + add
+      - only topics changed        -> update metadata in place (no embedding)
+      - question_id no longer in docs -> delete, unless metadata["origin"] is
+                                         CLASSIFY_ORIGIN (not written to the source yet)
+
+    `docs` can be a generator; it is consumed once and new/changed docs are streamed
+    straight into add_documents_streaming. prepare(batch), if given, is called on each
+    batch of new/changed docs before they are embedded, for work only they need (e.g.
+    fetching their images). Returns counts of what changed.
+    """
+    # question_id -> docstore id for what the index already holds
+    existing = {}
+    stale_ids = []
+    for doc_id, doc in vs.docstore._dict.items():
+        qid = doc.metadata.get("question_id")
+        if qid is None or str(qid) in existing:
+            # placeholders / duplicate copies of the same question
+            stale_ids.append(doc_id)
+            continue
+        existing[str(qid)] = doc_id
+
+    stats = {"added": 0, "changed": 0, "retagged": 0, "removed": 0}
+    seen = set()
+
+    def _pending():
+        for doc in docs:
+            qid = str(doc.metadata["question_id"])
+            if qid in seen:
+                continue
+            seen.add(qid)
+
+            doc_id = existing.pop(qid, None)
+            if doc_id is None:
+                stats["added"] += 1
+                yield doc
+                continue
+
+            current = vs.docstore._dict[doc_id]
+            if doc_content_hash(current) == doc_content_hash(doc):
+                continue
+
+            if current.page_content.strip() == doc.page_content.strip():
+                # Merged, so what only the store knows (image_hash, phash) is kept
+                current.metadata = {**current.metadata, **doc.metadata}
+                # Docs of a mapped store are decoded per read, so write it back
+                vs.docstore._dict[doc_id] = current
+                stats["retagged"] += 1
+            else:
+                stale_ids.append(doc_id)
+                stats["changed"] += 1
+                yield doc
+
+    def _prepared():
+        batch = []
+        for doc in _pending():
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                prepare(batch)
+                yield from batch
+                batch = []
+        if batch:
+            prepare(batch)
+            yield from batch
+
+    add_documents_streaming(vs, _prepared() if prepare is not None else _pending())
+
+    # Whatever is left in `existing` is no longer in the source, except questions that
+    # /classify/ added and nobody has corrected (so written to the source) yet
+    removed = [
+        doc_id for doc_id in existing.values()
+        if vs.docstore._dict[doc_id].metadata.get("origin") != CLASSIFY_ORIGIN
+    ]
+    stats["removed"] = len(removed)
+    stale_ids.extend(removed)
+    if stale_ids:
+        vs.delete(stale_ids)
+        exact = exact_vectors_of(vs)
+        if exact is not None:
+            exact.discard(stale_ids)
+
+    return stats
+
+
+def search_store(vs: "FAISS", vector, k: int, ann=None):
+    """
+    The k nearest docs to an already-embedded query, through `ann` (an ann_index.AnnIndex
+    over vs.index) when given. Returns [(Document, L2 distance)], nearest first.
+
+    For a quantized store with a rerank depth, k*rerank candidates are fetched from the
+    compressed index and re-scored against their exact vectors.
+    """
+    if vs.index.ntotal == 0:
+        return []
+    query = np.asarray(vector, dtype="float32").reshape(1, -1)
+    if getattr(vs, "_normalize_L2", False):
+        faiss.normalize_L2(query)
+    exact = exact_vectors_of(vs)
+    fetch = k * exact.rerank if exact is not None and exact.rerank > 1 else k
+    if ann is not None:
+        distances, positions = ann.search(query, fetch)
+    else:
+        distances, positions = vs.index.search(query, min(fetch, vs.index.ntotal))
+
+    doc_ids = [vs.index_to_docstore_id[int(pos)] for pos in positions[0] if pos >= 0]
+    if exact is not None and exact.rerank:
+        doc_ids, distances = rerank(exact, query, doc_ids, k)
+    else:
+        distances = distances[0][positions[0] >= 0]
+    return [(vs.docstore._dict[doc_id], float(distance)) for doc_id, distance in zip(doc_ids, distances)]
+
+
+def _code_rows(index):
+    """
+    Writable (ntotal, code_size) byte view over a flat-codes index (IndexFlatL2 or a
+    quantized one from quantization.new_codes_index), or None for other index types.
+    """
+    if not isinstance(index, faiss.IndexFlatCodes) or index.ntotal == 0:
+        return None
+    size = index.ntotal * index.code_size
+    return faiss.rev_swig_ptr(index.codes.data(), size).reshape(index.ntotal, index.code_size)
+
+
+class QuestionIndex:
+    """
+    question_id -> docstore id -> vector position for one FAISS store.
+
+    Every add/upsert/delete that goes through this class keeps the maps in step, so
+    finding, re-embedding or removing a question never scans the docstore. Anything
+    that mutates the store behind its back (e.g. sync_vectorstore) must call rebuild().
+
+    Observers (e.g. dedup_utils.ExactTextIndex) get on_add(question_id, doc),
+    on_remove(question_id) and clear() for every change, so derived lookups stay in step too.
+
+    If a journal is set (see vectorstore_persistence.WriteAheadLog), every mutation is also
+    appended to it as a self-contained record, vector included, that apply() can replay:
+
+        {"op": "put",    "question_id", "text", "metadata", "vector"[, "doc_id"]}
+        {"op": "meta",   "question_id", "metadata"}
+        {"op": "delete", "question_id"}
+
+    Replaying a record that is already reflected in the store is a no-op. Puts that added a
+    question carry its docstore id, so replaying a log onto the snapshot it started from
+    rebuilds the same store, ids and positions included.
+
+    With an ann_config (see ann_index.resolve_config) searches go through an IVF/HNSW
+    ann_index.AnnIndex that every mutation here keeps in step with the flat vectors.
+    """
+
+    def __init__(self, vs: "FAISS", observers=(), journal=None, ann_config: dict = None, ann=None):
+        self.vs = vs
+        self.observers = list(observers)
+        self.journal = journal
+        self.ann_config = ann.config if ann is not None else ann_config
+        self.ann = ann
+        self._index_docstore()
+
+    def rebuild(self, ann: bool = True):
+        """
+        Re-derive the maps, observers and (unless ann=False) the ANN index after the store
+        changed behind our back.
+        """
+        self._index_docstore()
+        if ann and self.ann_config is not None:
+            self.ann = build_ann(self.ann_config, store_vectors(self.vs))
+
+    def _index_docstore(self):
+        for obs in self.observers:
+            obs.clear()
+        self._docstore_id_by_qid = {}
+        for doc_id, doc in self.vs.docstore._dict.items():
+            qid = doc.metadata.get("question_id")
+            if qid is not None:
+                self._docstore_id_by_qid[str(qid)] = doc_id
+                self._notify_add(str(qid), doc)
+        self._position_by_docstore_id = {
+            doc_id: pos for pos, doc_id in self.vs.index_to_docstore_id.items()
+        }
+
+    def _notify_add(self, question_id: str, doc: Document):
+        for obs in self.observers:
+            obs.on_add(question_id, doc)
+
+    def _notify_remove(self, question_id: str):
+        for obs in self.observers:
+            obs.on_remove(question_id)
+
+    def _log(self, record: dict):
+        if self.journal is not None:
+            self.journal.append(record)
+
+    def __contains__(self, question_id) -> bool:
+        return str(question_id) in self._docstore_id_by_qid
+
+    def __len__(self) -> int:
+        return len(self._docstore_id_by_qid)
+
+    def question_ids(self):
+        return self._docstore_id_by_qid.keys()
+
+    def get(self, question_id):
+        doc_id = self._docstore_id_by_qid.get(str(question_id))
+        return self.vs.docstore._dict.get(doc_id) if doc_id is not None else None
+
+    def vectors(self, question_ids):
+        """
+        (the question ids that are stored, their full-precision vectors as an (n, d) array).
+        """
+        qids = [str(q) for q in question_ids if str(q) in self._docstore_id_by_qid]
+        doc_ids = [self._docstore_id_by_qid[q] for q in qids]
+        exact = exact_vectors_of(self.vs)
+        if exact is not None:
+            return qids, exact.get(doc_ids)
+        out = np.empty((len(qids), self.vs.index.d), dtype="float32")
+        for row, doc_id in enumerate(doc_ids):
+            out[row] = self.vs.index.reconstruct(self._position_by_docstore_id[doc_id])
+        return qids, out
+
+    def _embed(self, texts, embedded=None):
+        # embedded: text -> vector the caller already has (e.g. sent by a retrieval_service client)
+        if embedded is not None and all(t in embedded for t in texts):
+            vectors = np.array([embedded[t] for t in texts], dtype="float32").reshape(len(texts), -1)
+        else:
+            vectors = np.asarray(self.vs.embeddings.embed_documents(texts), dtype="float32")
+        if getattr(self.vs, "_normalize_L2", False):
+            faiss.normalize_L2(vectors)
+        return vectors
+
+    def _append(self, texts, metadatas, vectors, doc_ids=None):
+        start = self.vs.index.ntotal
+        ids = self.vs.add_embeddings(list(zip(texts, vectors.tolist())), metadatas=metadatas, ids=doc_ids)
+        exact = exact_vectors_of(self.vs)
+        if exact is not None:
+            exact.put(ids, vectors)
+        if self.ann is not None:
+            self.ann.add(range(start, start + len(ids)), vectors)
+        for offset, (doc_id, metadata) in enumerate(zip(ids, metadatas)):
+            qid = str(metadata["question_id"])
+            doc = self.vs.docstore._dict[doc_id]
+            self._docstore_id_by_qid[qid] = doc_id
+            self._position_by_docstore_id[doc_id] = start + offset
+            self._notify_add(qid, doc)
+            self._log({
+                "op": "put", "question_id": qid, "text": doc.page_content,
+                "metadata": doc.metadata, "vector": vectors[offset], "doc_id": doc_id,
+            })
+
+    def _replace(self, doc_id, text: str, metadata: dict, vector):
+        """
+        Swap a stored question's text and vector, keeping its docstore id where possible.
+        """
+        doc = self.vs.docstore._dict[doc_id]
+        qid = str(doc.metadata["question_id"])
+        index = self.vs.index
+        rows = _code_rows(index)
+        if rows is None and not is_mapped(self.vs):
+            # Index types without in-place writes: remove and re-append
+            merged = {**doc.metadata, **metadata}
+            self.delete(qid)
+            self._append([text], [merged], vector.reshape(1, -1))
+            return
+
+        self._notify_remove(qid)
+        doc.page_content = text
+        doc.metadata.update(metadata)
+        self.vs.docstore._dict[doc_id] = doc
+        pos = self._position_by_docstore_id[doc_id]
+        if rows is not None:
+            rows[pos] = index.sa_encode(np.asarray(vector, dtype="float32").reshape(1, -1))[0]
+        else:
+            # The mapped snapshot is read-only: the position is pointed at a new delta row
+            index.replace(pos, vector)
+        exact = exact_vectors_of(self.vs)
+        if exact is not None:
+            exact.put([doc_id], vector)
+        if self.ann is not None:
+            self.ann.add([pos], vector)
+            self._maybe_retrain_ann()
+        self._notify_add(qid, doc)
+        self._log({
+            "op": "put", "question_id": qid, "text": text,
+            "metadata": doc.metadata, "vector": vector,
+        })
+
+    def _set_metadata(self, doc_id, metadata: dict):
+        doc = self.vs.docstore._dict[doc_id]
+        qid = str(doc.metadata["question_id"])
+        self._notify_remove(qid)
+        doc.metadata.update(metadata)
+        self.vs.docstore._dict[doc_id] = doc
+        self._notify_add(qid, doc)
+        self._log({"op": "meta", "question_id": qid, "metadata": doc.metadata})
+
+    def add(self, docs, embedded: dict = None) -> int:
+        """
+        Embed and add new questions (one embedding call for the whole batch, none for
+        texts found in `embedded`). Returns how many questions were stored.
+        """
+        docs = list(docs)
+        if not docs:
+            return 0
+        qids = [str(d.metadata["question_id"]) for d in docs]
+        if len(set(qids)) < len(qids) or any(qid in self._docstore_id_by_qid for qid in qids):
+            # Appending a question that's already stored would leave its old doc and vector
+            # in the store with nothing pointing at them: replace it instead
+            stats = self.upsert_many(((qid, d.page_content, d.metadata) for qid, d in zip(qids, docs)), embedded)
+            return stats["added"] + stats["updated"] + stats["retagged"]
+        texts = [d.page_content for d in docs]
+        self._append(texts, [d.metadata for d in docs], self._embed(texts, embedded))
+        return len(docs)
+
+    def upsert_many(self, entries, embedded: dict = None) -> dict:
+        """
+        entries: iterable of (question_id, text or None, metadata updates).
+
+        - unknown question_id with text  -> embedded and added
+        - known question_id, text changed -> re-embedded, vector replaced in place
+        - known question_id otherwise     -> metadata updated, nothing embedded
+        - unknown question_id, no text    -> skipped
+
+        All texts that need embedding go out in a single call, so a batch of N
+        corrections costs O(N) regardless of corpus size. Texts found in `embedded`
+        (text -> vector) aren't embedded again.
+        """
+        stats = {"added": 0, "updated": 0, "retagged": 0, "skipped": 0}
+
+        # Last entry wins if a question appears twice in one batch
+        pending = {}
+        for question_id, text, metadata in entries:
+            pending[str(question_id)] = (text, metadata or {})
+
+        to_replace = []  # (doc_id, text, metadata)
+        to_add = []      # (text, metadata)
+        for qid, (text, metadata) in pending.items():
+            doc_id = self._docstore_id_by_qid.get(qid)
+            if doc_id is None:
+                if not text:
+                    stats["skipped"] += 1
+                    continue
+                to_add.append((text, {**metadata, "question_id": qid}))
+                continue
+
+            doc = self.vs.docstore._dict[doc_id]
+            if text and text.strip() != doc.page_content.strip():
+                to_replace.append((doc_id, text, metadata))
+            else:
+                self._set_metadata(doc_id, metadata)
+                stats["retagged"] += 1
+
+        texts = [t for _, t, _ in to_replace] + [t for t, _ in to_add]
+        if not texts:
+            return stats
+        vectors = self._embed(texts, embedded)
+
+        for (doc_id, text, metadata), vector in zip(to_replace, vectors):
+            self._replace(doc_id, text, metadata, vector)
+            stats["updated"] += 1
+
+        if to_add:
+            self._append(
+                [t for t, _ in to_add],
+                [m for _, m in to_add],
+                vectors[len(to_replace):],
+            )
+            stats["added"] += len(to_add)
+
+        return stats
+
+    def delete(self, question_id) -> bool:
+        """
+        Remove a question's doc and vector. For flat(-codes) indexes the last vector is moved
+        into the freed slot and the tail dropped, so nothing else is renumbered.
+        """
+        doc_id = self._docstore_id_by_qid.pop(str(question_id), None)
+        if doc_id is None:
+            return False
+        self._notify_remove(str(question_id))
+        self._log({"op": "delete", "question_id": str(question_id)})
+
+        index = self.vs.index
+        exact = exact_vectors_of(self.vs)
+        if exact is not None:
+            exact.discard([doc_id])
+        rows = _code_rows(index)
+        if rows is None and not is_mapped(self.vs):
+            self.vs.delete([doc_id])
+            self.rebuild()
+            return True
+
+        pos = self._position_by_docstore_id.pop(doc_id)
+        last = index.ntotal - 1
+        if self.ann is not None:
+            self.ann.remove(pos)
+        if pos != last:
+            last_doc_id = self.vs.index_to_docstore_id[last]
+            self.vs.index_to_docstore_id[pos] = last_doc_id
+            self._position_by_docstore_id[last_doc_id] = pos
+            if self.ann is not None:
+                self.ann.move(last, pos)
+
+        if rows is not None:
+            rows[pos] = rows[last]
+            index.remove_ids(faiss.IDSelectorRange(last, last + 1))
+        else:
+            index.swap_remove(pos)
+        del self.vs.index_to_docstore_id[last]
+        self.vs.docstore.delete([doc_id])
+        self._maybe_retrain_ann()
+        return True
+
+    def apply(self, record: dict):
+        """
+        Replay one journal record (see the class docstring) without journaling it again.
+        """
+        journal, self.journal = self.journal, None
+        try:
+            qid = str(record["question_id"])
+            doc_id = self._docstore_id_by_qid.get(qid)
+            if record["op"] == "put":
+                vector = np.asarray(record["vector"], dtype="float32")
+                if doc_id is None:
+                    doc_ids = [record["doc_id"]] if record.get("doc_id") else None
+                    self._append([record["text"]], [record["metadata"]], vector.reshape(1, -1), doc_ids)
+                else:
+                    self._replace(doc_id, record["text"], record["metadata"], vector)
+            elif record["op"] == "meta":
+                if doc_id is not None:
+                    self._set_metadata(doc_id, record["metadata"])
+            elif record["op"] == "delete":
+                self.delete(qid)
+            else:
+                raise ValueError(f"Unknown journal op {record['op']!r}")
+        finally:
+            self.journal = journal
+
+    def _maybe_retrain_ann(self):
+        # Replaced/deleted vectors leave tombstones in the ANN index; retrain once they pile up
+        if self.ann is not None and self.ann.needs_rebuild():
+            self.ann = build_ann(self.ann_config, store_vectors(self.vs))
+
+    def search(self, vector, k: int):
+        """
+        The k nearest questions to an already-embedded query (see search_store).
+        """
+        return search_store(self.vs, vector, k, self.ann)